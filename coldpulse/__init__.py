@@ -3,5 +3,13 @@
 Created on Tue Apr 21 11:57:24 2020
 
 @author: rguil
+
+The main functions are imported on first use, so that importing the package
+does not import numpy, xarray or pandas.
 """
 
+def __getattr__(name):
+    if name in ('upwelling_cold_pulses_detection', 'detect'):
+        from . import coldpulse
+        return getattr(coldpulse, name)
+    raise AttributeError("module %r has no attribute %r"%(__name__, name))
@@ -0,0 +1,151 @@
+"""
+Alignment of the loggers of a station on a common time grid.
+
+Timestamps are handled as int64 nanoseconds. Each logger is deduplicated
+with a sort and unique pass, and all loggers are resampled at once into a
+preallocated (depth, time) array, either by linear interpolation or by
+averaging the samples falling in each time step.
+"""
+import numpy as np
+
+STRATEGIES = ['interp', 'mean']
+
+
+def dedupe_samples(times, values):
+    """
+    Sorts the samples of a logger by time and keeps one sample per timestamp,
+    the first non NaN one
+
+    Parameters
+    ----------
+    times  : 1darray
+        Timestamps as int64 nanoseconds
+    values : 1darray
+        Temperature values
+
+    Returns
+    -------
+    times  : 1darray
+        Sorted unique timestamps
+    values : 1darray
+        Temperature values at these timestamps
+    """
+    times = np.asarray(times).view(np.int64)
+    order = np.lexsort((np.isnan(values), times))
+    times = times[order]
+    is_first = np.ones(times.size, dtype=bool)
+    is_first[1:] = times[1:] != times[:-1]
+    return times[is_first], np.asarray(values)[order][is_first]
+
+def common_time_grid(samples):
+    """
+    Common time grid of several loggers: their time intersection, sampled at
+    the coarsest interval
+
+    Parameters
+    ----------
+    samples : list of tuples
+        Sorted unique times (int64 ns) and values of each logger
+
+    Returns
+    -------
+    grid : 1darray
+        Timestamps of the grid as int64 nanoseconds
+    """
+    start = max([times[0] for times, values in samples])
+    end = min([times[-1] for times, values in samples])
+    # Interval of each logger from its first two samples, in whole seconds
+    step = max([(times[1] - times[0])//10**9 for times, values in samples])*10**9
+    return start + step*np.arange((end - start)//step + 1, dtype=np.int64)
+
+def align_samples(samples, grid, strategy='interp'):
+    """
+    Resamples several loggers on a time grid
+
+    Parameters
+    ----------
+    samples  : list of tuples
+        Sorted unique times (int64 ns) and values of each logger
+    grid     : 1darray
+        Timestamps of the grid as int64 nanoseconds
+    strategy : String
+        'interp' for linear interpolation of each logger at the grid times.
+        'mean' to average the samples of loggers sampled faster than the
+        grid over each time step (centered on the grid times), interpolation
+        being used for time steps without samples and for the other loggers.
+
+    Returns
+    -------
+    temperature : 2darray
+        Temperature data with dimensions (logger, time)
+    """
+    assert strategy in STRATEGIES,\
+        "Unknown alignment strategy %s, use one of %s."%(strategy, STRATEGIES)
+    temperature = np.empty((len(samples), grid.size))
+    batched_interp(samples, grid, out=temperature)
+    if strategy == 'mean' and grid.size > 1:
+        step = grid[1] - grid[0]
+        for index, (times, values) in enumerate(samples):
+            if times[1] - times[0] < step:
+                block_mean(times, values, grid, step, out=temperature[index])
+    return temperature
+
+def batched_interp(samples, grid, out):
+    """
+    Linearly interpolates all loggers at the grid times with a single
+    np.interp call, each logger being shifted to its own time range
+
+    Parameters
+    ----------
+    samples : list of tuples
+        Sorted unique times (int64 ns) and values of each logger
+    grid    : 1darray
+        Timestamps of the grid as int64 nanoseconds
+    out     : 2darray
+        Output array with dimensions (logger, time)
+    """
+    origin = grid[0]
+    span = max([times[-1] for times, values in samples] + [grid[-1]]) \
+         - min([times[0] for times, values in samples] + [origin])
+    # Times in seconds from the grid start, each logger shifted by a
+    # multiple of the whole time span so that their ranges do not overlap
+    shifts = np.ceil(span/1e9 + 1)*np.arange(len(samples))
+    sample_times = np.concatenate([(times - origin)/1e9 + shift
+                                   for (times, values), shift in zip(samples, shifts)])
+    sample_values = np.concatenate([values for times, values in samples])
+    grid_times = (grid - origin)[None, :]/1e9 + shifts[:, None]
+    out[:] = np.interp(grid_times.reshape(-1),
+                       sample_times,
+                       sample_values).reshape(out.shape)
+    return out
+
+def block_mean(times, values, grid, step, out):
+    """
+    Averages the non NaN samples of a logger over each time step of the grid,
+    from grid - step/2 (included) to grid + step/2 (excluded). Time steps
+    without samples are left unchanged in out.
+
+    Parameters
+    ----------
+    times  : 1darray
+        Sorted unique timestamps as int64 nanoseconds
+    values : 1darray
+        Temperature values
+    grid   : 1darray
+        Timestamps of the grid as int64 nanoseconds
+    step   : int
+        Time step of the grid in nanoseconds
+    out    : 1darray
+        Values at the grid times, updated in place
+    """
+    is_valid = ~np.isnan(values)
+    times = times[is_valid]
+    values = values[is_valid]
+    edges = np.searchsorted(times, np.append(grid - step//2, grid[-1] + step - step//2))
+    counts = np.diff(edges)
+    has_samples = counts > 0
+    if has_samples.any():
+        values = values[edges[0]:edges[-1]]
+        sums = np.add.reduceat(values, edges[:-1][has_samples] - edges[0])
+        out[has_samples] = sums/counts[has_samples]
+    return out
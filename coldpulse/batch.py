@@ -0,0 +1,291 @@
+"""
+Batch processing of many run directories over a pool of processes.
+
+Each directory is processed by upwelling_cold_pulses_detection in a worker
+process. A failure in one directory is recorded in the manifest and does
+not stop the others. Workers are reused between directories, so the GODAS
+grid and other per-process data are loaded once per worker. With a writer,
+workers send their outputs back and this process writes them, one
+directory at a time, so that workers never wait for each other to write to
+a shared store.
+"""
+import os
+import sys
+import time
+import argparse
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+from .coldpulse import upwelling_cold_pulses_detection
+from .writers import SiteStoreWriter, CollectingWriter, station_name
+from .profiling import Profiler, print_event, QUIET
+from .threshold import THRESHOLD_METHODS
+from .alignment import STRATEGIES
+
+MANIFEST_COLUMNS = ['input_dir',
+                    'status',
+                    'duration',
+                    'number_pulses',
+                    'error']
+
+
+def run_batch(list_input_dir, workers=None, manifest_path=None, **kwargs):
+    """
+    Detects cold pulses in several run directories in parallel
+
+    Parameters
+    ----------
+    list_input_dir : list of String
+        Paths of the input directories which contain csv files
+    workers : int
+        Number of worker processes. os.cpu_count() if None. If 1,
+        directories are processed one after the other in this process.
+    manifest_path : String
+        If not None, the manifest is also saved as a csv file at this path.
+    **kwargs :
+        Keyword arguments passed to upwelling_cold_pulses_detection. With
+        several workers, the outputs of the writer are written by this
+        process.
+
+    Returns
+    -------
+    manifest : pandas DataFrame
+        One row per directory, in the order of list_input_dir, with the
+        status ('done', 'skipped' or 'failed'), the duration in seconds,
+        the number of pulses in the outputs (only with the default writer)
+        and the error message of failed runs. Runs of a worker which died
+        fail with a BrokenProcessPool error. The manifest is saved even if
+        the batch is interrupted, runs without an outcome being failed.
+
+    """
+    if workers is None:
+        workers = os.cpu_count()
+    rows = dict()
+    writer = kwargs.get('writer')
+    try:
+        if workers == 1:
+            # Background writes of a run overlap with the next run
+            for input_dir in list_input_dir:
+                rows[input_dir] = process_run(input_dir, kwargs,
+                                              flush=writer is None or not writer.background)
+                print_row(rows[input_dir])
+            if writer is not None:
+                writer.flush()
+        else:
+            worker_kwargs = kwargs
+            if writer is not None:
+                worker_kwargs = dict(kwargs, writer=CollectingWriter())
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = dict([(executor.submit(process_run, input_dir, worker_kwargs),
+                                 input_dir)
+                                for input_dir in list_input_dir])
+                for future in as_completed(futures):
+                    try:
+                        row = future.result()
+                    except Exception as error:
+                        # process_run did not return, e.g. a worker died
+                        # (BrokenProcessPool) and this run and all the runs
+                        # still pending fail
+                        row = failed_row(futures[future], error)
+                    if 'outputs' in row:
+                        write_run(row, writer)
+                    rows[row['input_dir']] = row
+                    print_row(row)
+    finally:
+        # Runs without an outcome, if the batch was interrupted
+        manifest = pd.DataFrame([rows.get(input_dir,
+                                          failed_row(input_dir, 'not processed'))
+                                 for input_dir in list_input_dir],
+                                columns=MANIFEST_COLUMNS)
+        if manifest_path is not None:
+            manifest.to_csv(manifest_path, index=False)
+    return manifest
+
+def process_run(input_dir, kwargs, flush=True):
+    """
+    Processes one run directory and reports its outcome, errors included
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+    kwargs : dict
+        Keyword arguments passed to upwelling_cold_pulses_detection.
+    flush : bool
+        If True, pending writes of the writer in kwargs are waited for, and
+        their errors recorded as errors of this run.
+
+    Returns
+    -------
+    row : dict
+        Manifest row of input_dir, with the outputs of the run in 'outputs'
+        if the writer is a CollectingWriter.
+
+    """
+    row = dict(input_dir=input_dir, number_pulses=None, error=None)
+    start_time = time.perf_counter()
+    writer = kwargs.get('writer')
+    try:
+        if upwelling_cold_pulses_detection(input_dir, **kwargs):
+            row['status'] = 'done'
+        else:
+            row['status'] = 'skipped'
+        if writer is None:
+            row['number_pulses'] = count_pulses(input_dir)
+        elif isinstance(writer, CollectingWriter):
+            row['outputs'], writer.outputs = writer.outputs, []
+        elif flush:
+            writer.flush()
+    except Exception as error:
+        row['status'] = 'failed'
+        row['error'] = '%s: %s'%(type(error).__name__, error)
+        traceback.print_exc()
+    row['duration'] = time.perf_counter() - start_time
+    return row
+
+def failed_row(input_dir, error):
+    """
+    Manifest row of a run which failed outside of process_run
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory
+    error : Exception or String
+        Cause of the failure
+
+    Returns
+    -------
+    row : dict
+        Manifest row of input_dir.
+
+    """
+    if isinstance(error, Exception):
+        error = '%s: %s'%(type(error).__name__, error)
+    return dict(input_dir=input_dir, status='failed', duration=None,
+                number_pulses=None, error=error)
+
+def write_run(row, writer):
+    """
+    Writes the outputs collected by process_run with a CollectingWriter,
+    and records write errors as errors of the run
+
+    Parameters
+    ----------
+    row : dict
+        Manifest row returned by process_run, its outputs are removed.
+    writer : writers.OutputWriter
+        Writer of the outputs.
+
+    """
+    start_time = time.perf_counter()
+    try:
+        for outputs in row.pop('outputs', []):
+            writer.write(*outputs)
+        writer.flush()
+    except Exception as error:
+        row['status'] = 'failed'
+        row['error'] = '%s: %s'%(type(error).__name__, error)
+        traceback.print_exc()
+    row['duration'] += time.perf_counter() - start_time
+
+def count_pulses(input_dir):
+    """
+    Counts the pulses in the pulse table of a run directory
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory
+
+    Returns
+    -------
+    number_pulses : int
+        Number of rows of the pulse table, None if it does not exist.
+
+    """
+    path = '%s_TSI_out/%s_pulse_stats_.csv'%(os.path.normpath(input_dir),
+                                             station_name(input_dir))
+    if not os.path.exists(path):
+        return None
+    return len(pd.read_csv(path, usecols=[0]))
+
+def print_row(row):
+    """
+    Prints the outcome of a run
+    """
+    if row['duration'] is None:
+        print('\n%s: %s'%(row['input_dir'], row['status']))
+    else:
+        print('\n%s: %s in %.1fs'%(row['input_dir'], row['status'], row['duration']))
+    if row['error'] is not None:
+        print('  %s'%row['error'])
+
+# =============================================================================
+# Console entry point
+# =============================================================================
+
+def main(argv=None):
+    """
+    Console entry point: coldpulse-batch DIR [DIR ...] [options]
+    """
+    parser = argparse.ArgumentParser(
+        prog='coldpulse-batch',
+        description='Detects upwelling-induced cold pulses in several run '
+                    'directories in parallel.')
+    parser.add_argument('input_dirs', nargs='+',
+                        help='run directories containing csv files')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='number of worker processes (default: all cores)')
+    parser.add_argument('-m', '--manifest', default='coldpulse_manifest.csv',
+                        help='path of the csv manifest')
+    parser.add_argument('--reprocess', action='store_true',
+                        help='process directories which already have outputs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only process rows added since the last run')
+    parser.add_argument('--chunk-size', type=int, default=None,
+                        help='process csv files by chunks of time steps')
+    parser.add_argument('--store', default=None,
+                        help='append all outputs to a shared Parquet/Zarr '
+                             'store in this directory')
+    parser.add_argument('--threshold', default='godas',
+                        help="TSI threshold: 'godas' (default), 'global', "
+                             "'rolling' or 'seasonal' to compute it from the "
+                             "record itself, or a number")
+    parser.add_argument('--strategy', default='interp', choices=STRATEGIES,
+                        help="resampling of the loggers on the common time "
+                             "grid: 'interp' (default) or 'mean' to average "
+                             "loggers sampled faster than the grid")
+    parser.add_argument('--checkpoint', action='store_true',
+                        help='save each stage and reuse the stages whose '
+                             'inputs did not change')
+    parser.add_argument('--profile', action='store_true',
+                        help='save the timing of each stage in the output '
+                             'directory of each run')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='only print the outcome of each directory')
+    arguments = parser.parse_args(argv)
+    threshold = arguments.threshold
+    if threshold not in THRESHOLD_METHODS:
+        threshold = float(threshold)
+    writer = None
+    if arguments.store is not None:
+        writer = SiteStoreWriter(arguments.store)
+    manifest = run_batch(arguments.input_dirs,
+                         workers=arguments.workers,
+                         manifest_path=arguments.manifest,
+                         ignore_double=not arguments.reprocess,
+                         incremental=arguments.incremental,
+                         chunk_size=arguments.chunk_size,
+                         writer=writer,
+                         threshold=threshold,
+                         strategy=arguments.strategy,
+                         checkpoint=arguments.checkpoint,
+                         profiler=QUIET if arguments.quiet
+                                  else Profiler(callback=print_event),
+                         save_profile=arguments.profile)
+    print(manifest.to_string(index=False))
+    return int((manifest.status == 'failed').any())
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+"""
+Benchmark of each stage of the detection on synthetic moorings.
+
+Each stage is timed separately for several record lengths, so that a
+regression can be traced to the stage that caused it. The TSI threshold is
+computed from the record itself (synthetic.self_climatology_threshold), so
+the benchmark runs without network access. Results can be saved as csv and
+compared to the results of an earlier version:
+    python -m coldpulse.benchmark --sizes 10000 100000 --output new.csv \
+        --reference old.csv
+The features can also be timed for an increasing number of depths, to
+check that their cost stays linear in the number of loggers, e.g. for
+thermistor chains:
+    python -m coldpulse.benchmark --sizes 1000000 --depth-counts 4 16 64
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+from . import synthetic
+from .inputs import prepare_darray
+from .features import DetectionFeatures
+from .detection import (get_potential_pulses_start_end_from_TSI, shift_starts,
+                        remove_potential_pulse_if_not_from_bottom_logger,
+                        shift_ends)
+from .outputs import split_pulses, prepare_output
+
+STAGES = ['prepare_darray',
+          'features',
+          'threshold',
+          'potential_pulses',
+          'shift_starts',
+          'bottom_logger_filter',
+          'shift_ends',
+          'split_pulses',
+          'prepare_output']
+RESULT_COLUMNS = ['size', 'stage', 'seconds', 'items']
+DEPTH_RESULT_COLUMNS = ['size', 'depths', 'stage', 'seconds', 'seconds_per_depth']
+
+
+def benchmark_stages(sizes=(10**4, 10**5, 10**6), repeat=3, input_limit=10**6,
+                     **mooring_kwargs):
+    """
+    Times each stage of the detection on synthetic moorings
+
+    Parameters
+    ----------
+    sizes          : list of int
+        Numbers of time steps of the moorings
+    repeat         : int
+        Number of runs of each stage, the fastest one is kept
+    input_limit    : int
+        prepare_darray is only timed up to this number of time steps, as
+        writing the csv files of larger moorings takes long.
+    **mooring_kwargs :
+        Keyword arguments passed to synthetic.make_mooring
+
+    Returns
+    -------
+    results : pandas DataFrame
+        One row per size and stage, with the best time in seconds and the
+        number of items returned by the stage (time steps, pulses or
+        subpulses).
+    """
+    rows = []
+    for size in sizes:
+        darray, pulses = synthetic.make_mooring(size, **mooring_kwargs)
+        for stage, seconds, items in time_stages(darray, repeat, size <= input_limit):
+            rows.append(dict(size=size, stage=stage, seconds=seconds, items=items))
+            print('%10d %-22s %10.4fs'%(size, stage, seconds))
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+def time_stages(darray, repeat, with_inputs=True):
+    """
+    Runs the stages of the detection one after the other on darray
+
+    Parameters
+    ----------
+    darray      : xarray DataArray
+        Temperature data
+    repeat      : int
+        Number of runs of each stage, the fastest one is kept
+    with_inputs : bool
+        If True, darray is also written as csv files to time prepare_darray
+
+    Returns
+    -------
+    timings : list of tuples
+        Stage name, best time in seconds and number of items of each stage
+    """
+    timings = []
+    if with_inputs:
+        input_dir = tempfile.mkdtemp(prefix='coldpulse_benchmark_')
+        try:
+            synthetic.write_mooring(darray, input_dir)
+            seconds, loaded = best_time(prepare_darray, repeat, input_dir,
+                                        use_cache=False)
+        finally:
+            shutil.rmtree(input_dir)
+        timings.append(('prepare_darray', seconds, loaded.sizes['time']))
+    seconds, features = best_time(DetectionFeatures.from_darray, repeat, darray)
+    timings.append(('features', seconds, darray.sizes['time']))
+    seconds, threshold = best_time(synthetic.self_climatology_threshold, repeat,
+                                   darray)
+    timings.append(('threshold', seconds, 1))
+    seconds, (starts, ends) = best_time(get_potential_pulses_start_end_from_TSI,
+                                        repeat, darray, threshold=threshold,
+                                        features=features)
+    timings.append(('potential_pulses', seconds, starts.size))
+    phi = features.phi
+    seconds, shifted_starts = best_time(shift_starts, repeat, starts, ends,
+                                        darray, phi,
+                                        use_increasing_temp=False,
+                                        features=features)
+    timings.append(('shift_starts', seconds, shifted_starts.size))
+    seconds, (starts, ends) = best_time(remove_potential_pulse_if_not_from_bottom_logger,
+                                        repeat, shifted_starts, ends, darray,
+                                        phi, features=features)
+    timings.append(('bottom_logger_filter', seconds, starts.size))
+    seconds, ends = best_time(shift_ends, repeat, ends, darray, phi,
+                              features=features)
+    timings.append(('shift_ends', seconds, ends.size))
+    seconds, subpulses = best_time(split_pulses, repeat,
+                                   features.bottom_temperature, starts, ends)
+    timings.append(('split_pulses', seconds, len(subpulses)))
+    seconds, (df_subpulse, ds_output, df_pulse) = best_time(prepare_output,
+                                                            repeat, darray,
+                                                            starts, ends,
+                                                            features=features)
+    timings.append(('prepare_output', seconds, len(df_subpulse)))
+    return timings
+
+def benchmark_depths(depth_counts=(4, 8, 16, 32, 64), size=10**5, repeat=3,
+                     **mooring_kwargs):
+    """
+    Times the features of synthetic moorings with more and more loggers,
+    with the single pass computation ('features_chain') and without it
+    ('features')
+
+    Parameters
+    ----------
+    depth_counts   : list of int
+        Numbers of loggers, evenly spaced between 2 and 60 m
+    size           : int
+        Number of time steps of the moorings
+    repeat         : int
+        Number of runs of each computation, the fastest one is kept
+    **mooring_kwargs :
+        Keyword arguments passed to synthetic.make_mooring
+
+    Returns
+    -------
+    results : pandas DataFrame
+        One row per number of loggers and computation, with the best time
+        in seconds and the time per logger.
+    """
+    rows = []
+    for depth_count in depth_counts:
+        darray, pulses = synthetic.make_mooring(size,
+                                                depths=tuple(np.linspace(2., 60., depth_count)),
+                                                **mooring_kwargs)
+        for stage, chain in [('features', False), ('features_chain', True)]:
+            seconds, features = best_time(DetectionFeatures.from_darray, repeat,
+                                          darray, chain=chain)
+            rows.append(dict(size=size, depths=depth_count, stage=stage,
+                             seconds=seconds,
+                             seconds_per_depth=seconds/depth_count))
+            print('%10d %4d %-22s %10.4fs'%(size, depth_count, stage, seconds))
+    return pd.DataFrame(rows, columns=DEPTH_RESULT_COLUMNS)
+
+def depth_scaling(results, tolerance=1.25):
+    """
+    Checks that the time of each computation of benchmark_depths grows at
+    most linearly with the number of loggers
+
+    Parameters
+    ----------
+    results   : pandas DataFrame
+        Results of benchmark_depths
+    tolerance : float
+        A computation is superlinear if its time per logger with the most
+        loggers is more than tolerance times its lowest time per logger.
+
+    Returns
+    -------
+    scaling : pandas DataFrame
+        One row per computation, with the lowest time per logger, the time
+        per logger with the most loggers, their ratio and a superlinear
+        column.
+    """
+    rows = []
+    for stage, stage_results in results.groupby('stage', sort=False):
+        stage_results = stage_results.sort_values('depths')
+        lowest = stage_results.seconds_per_depth.min()
+        largest = stage_results.seconds_per_depth.iloc[-1]
+        rows.append(dict(stage=stage,
+                         lowest_seconds_per_depth=lowest,
+                         seconds_per_depth=largest,
+                         ratio=largest/lowest,
+                         superlinear=largest/lowest > tolerance))
+    return pd.DataFrame(rows)
+
+def best_time(function, repeat, *args, **kwargs):
+    """
+    Fastest of repeat calls of function
+
+    Returns
+    -------
+    seconds : float
+        Best wall time in seconds
+    result  :
+        Value returned by the last call
+    """
+    best = np.inf
+    for i in range(max(repeat, 1)):
+        start_time = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start_time)
+    return best, result
+
+def compare_results(results, reference, tolerance=1.25):
+    """
+    Compares benchmark results to reference results
+
+    Parameters
+    ----------
+    results   : pandas DataFrame
+        Results of benchmark_stages
+    reference : pandas DataFrame
+        Earlier results of benchmark_stages
+    tolerance : float
+        A stage is a regression if it is more than tolerance times slower
+        than in the reference, and more than a millisecond slower so that
+        the noise of very short stages is ignored.
+
+    Returns
+    -------
+    comparison : pandas DataFrame
+        Sizes and stages found in both results, with both times, their
+        ratio and a regression column.
+    """
+    comparison = pd.merge(results, reference, on=['size', 'stage'],
+                          suffixes=('', '_reference'))
+    comparison['ratio'] = comparison.seconds/comparison.seconds_reference
+    comparison['regression'] = (comparison.ratio > tolerance) \
+        & (comparison.seconds - comparison.seconds_reference > 1e-3)
+    return comparison[['size', 'stage', 'seconds_reference', 'seconds',
+                       'ratio', 'regression']]
+
+def save_results(results, path):
+    """
+    Saves benchmark results as a csv file, creating its directory if needed
+    """
+    output_dir = os.path.dirname(path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    results.to_csv(path, index=False)
+
+# =============================================================================
+# Console entry point
+# =============================================================================
+
+def main(argv=None):
+    """
+    Console entry point: python -m coldpulse.benchmark [options]
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m coldpulse.benchmark',
+        description='Times each stage of the cold pulse detection on '
+                    'synthetic moorings.')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10**4, 10**5, 10**6],
+                        help='numbers of time steps (default: 1e4 1e5 1e6)')
+    parser.add_argument('--depths', type=float, nargs='+',
+                        default=[5., 10., 20., 30.],
+                        help='depths of the loggers')
+    parser.add_argument('--time-step', type=int, default=120,
+                        help='sampling interval in seconds')
+    parser.add_argument('--noise', type=float, default=0.05,
+                        help='noise standard deviation in degrees')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of each stage, the fastest is kept')
+    parser.add_argument('--input-limit', type=int, default=10**6,
+                        help='largest size for which prepare_darray is timed')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-o', '--output', default=None,
+                        help='path of the csv file of the results')
+    parser.add_argument('-r', '--reference', default=None,
+                        help='csv file of earlier results to compare to')
+    parser.add_argument('--tolerance', type=float, default=1.25,
+                        help='slowdown ratio counted as a regression')
+    parser.add_argument('--depth-counts', type=int, nargs='+', default=None,
+                        help='only time the features for these numbers of '
+                             'loggers, at the first size, and check that '
+                             'their time is linear in the number of loggers')
+    arguments = parser.parse_args(argv)
+    if arguments.depth_counts is not None:
+        results = benchmark_depths(arguments.depth_counts,
+                                   size=arguments.sizes[0],
+                                   repeat=arguments.repeat,
+                                   time_step=arguments.time_step,
+                                   noise=arguments.noise,
+                                   seed=arguments.seed)
+        if arguments.output is not None:
+            save_results(results, arguments.output)
+        scaling = depth_scaling(results, tolerance=arguments.tolerance)
+        print(scaling.to_string(index=False))
+        return int(scaling.superlinear.any())
+    results = benchmark_stages(arguments.sizes,
+                               repeat=arguments.repeat,
+                               input_limit=arguments.input_limit,
+                               depths=arguments.depths,
+                               time_step=arguments.time_step,
+                               noise=arguments.noise,
+                               seed=arguments.seed)
+    if arguments.output is not None:
+        save_results(results, arguments.output)
+    if arguments.reference is None:
+        print(results.to_string(index=False))
+        return 0
+    comparison = compare_results(results, pd.read_csv(arguments.reference),
+                                 tolerance=arguments.tolerance)
+    print(comparison.to_string(index=False))
+    return int(comparison.regression.any())
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,401 @@
+"""
+Persistent cache of NCEP-GODAS climatology extracts, TSI thresholds and
+parsed csv files.
+
+Extracts are stored in a cache directory shared by all runs, by default
+'~/.cache/coldpulse' or the COLDPULSE_CACHE_DIR environment variable. An
+index file lists them by (grid longitude, grid latitude, max depth), with
+their size, creation and last use times, and the TSI thresholds already
+derived from them for each set of logger depths. The index is only
+modified under a lock file, and extracts are written under a temporary
+name then renamed, so several processes can share the cache.
+
+Parsed csv files are kept as npz copies in its 'csv' subdirectory, one per
+csv file path, with the size and modification time of the csv file they
+were parsed from. Their modification time is their last use time. evict
+removes both kinds of entries.
+"""
+import os
+import json
+import time
+import hashlib
+from contextlib import contextmanager
+import numpy as np
+
+INDEX_FILE_NAME = 'godas_index.json'
+CSV_DIR_NAME = 'csv'
+
+
+def default_cache_dir(cache_dir=None):
+    """
+    Resolves the cache directory and creates it if needed
+
+    Parameters
+    ----------
+    cache_dir : String
+        Cache directory. COLDPULSE_CACHE_DIR or '~/.cache/coldpulse' if None.
+
+    Returns
+    -------
+    cache_dir : String
+        Path of the cache directory
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('COLDPULSE_CACHE_DIR',
+                                   os.path.join('~', '.cache', 'coldpulse'))
+    cache_dir = os.path.expanduser(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def climatology_key(longitude, latitude, max_depth):
+    """
+    Index key of the climatology extract of a GODAS grid point
+
+    Parameters
+    ----------
+    longitude : float
+        Longitude of the GODAS grid point
+    latitude  : float
+        Latitude of the GODAS grid point
+    max_depth : float
+        Depth of the deepest logger
+
+    Returns
+    -------
+    key : String
+        Key of the extract in the index, also used as its file name
+    """
+    return "NCEP-GODAS_potential-temperature_%.01fE_%.01fN_%dm"%(longitude,
+                                                                 latitude,
+                                                                 max_depth)
+
+def depths_key(depths):
+    """
+    Key of a set of logger depths in the thresholds of an index entry
+    """
+    return ','.join(['%g'%depth for depth in sorted(depths)])
+
+@contextmanager
+def cache_lock(cache_dir, name='index', stale_after=60):
+    """
+    Holds an exclusive lock file in the cache directory
+
+    Parameters
+    ----------
+    cache_dir   : String
+        Cache directory
+    name        : String
+        Name of the lock
+    stale_after : float
+        Age in seconds after which a lock is considered left by a crashed
+        process and removed
+    """
+    path = os.path.join(cache_dir, '%s.lock'%name)
+    while True:
+        try:
+            descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > stale_after:
+                    os.remove(path)
+                    continue
+            except FileNotFoundError:
+                continue
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.close(descriptor)
+        os.remove(path)
+
+def read_index(cache_dir):
+    """
+    Reads the index of the cache directory, an empty index if there is none
+    """
+    try:
+        with open(os.path.join(cache_dir, INDEX_FILE_NAME)) as file:
+            return json.load(file)
+    except (FileNotFoundError, ValueError):
+        return dict()
+
+def write_index(cache_dir, index):
+    """
+    Replaces the index of the cache directory. Must be called under the lock.
+    """
+    path = os.path.join(cache_dir, INDEX_FILE_NAME)
+    temporary_path = '%s.%d.tmp'%(path, os.getpid())
+    with open(temporary_path, 'w') as file:
+        json.dump(index, file, indent=1)
+    os.replace(temporary_path, path)
+
+# =============================================================================
+# Climatology extracts
+# =============================================================================
+
+def get_climatology(key, download, cache_dir=None):
+    """
+    Returns the path of a climatology extract, downloading it if it is not
+    in the cache
+
+    Parameters
+    ----------
+    key       : String
+        Key of the extract, from climatology_key
+    download  : function
+        Function writing the extract at the path given as argument
+    cache_dir : String
+        Cache directory
+
+    Returns
+    -------
+    path : String
+        Path of the extract in the cache
+    """
+    cache_dir = default_cache_dir(cache_dir)
+    path = os.path.join(cache_dir, '%s.nc'%key)
+    # Only one process downloads a given extract, the others wait for it
+    with cache_lock(cache_dir, name=key, stale_after=4*3600):
+        if os.path.exists(path) and key in read_index(cache_dir):
+            print("Data already downloaded")
+        else:
+            temporary_path = '%s.%d.tmp'%(path, os.getpid())
+            download(temporary_path)
+            os.replace(temporary_path, path)
+            with cache_lock(cache_dir):
+                index = read_index(cache_dir)
+                index[key] = dict(file='%s.nc'%key,
+                                  size=os.path.getsize(path),
+                                  created=time.time(),
+                                  last_used=time.time(),
+                                  thresholds=dict())
+                write_index(cache_dir, index)
+            return path
+    touch(cache_dir, key)
+    return path
+
+def touch(cache_dir, key):
+    """
+    Updates the last use time of an index entry
+    """
+    with cache_lock(cache_dir):
+        index = read_index(cache_dir)
+        if key in index:
+            index[key]['last_used'] = time.time()
+            write_index(cache_dir, index)
+
+def get_threshold(key, depths, cache_dir=None):
+    """
+    Returns the TSI threshold memoized for a climatology extract and a set of
+    logger depths, None if there is none
+
+    Parameters
+    ----------
+    key       : String
+        Key of the extract, from climatology_key
+    depths    : 1darray
+        Depths of the loggers
+    cache_dir : String
+        Cache directory
+
+    Returns
+    -------
+    threshold : float
+        TSI threshold, None if not memoized
+    """
+    cache_dir = default_cache_dir(cache_dir)
+    entry = read_index(cache_dir).get(key)
+    if entry is None or not os.path.exists(os.path.join(cache_dir, entry['file'])):
+        return None
+    threshold = entry['thresholds'].get(depths_key(depths))
+    if threshold is not None:
+        touch(cache_dir, key)
+    return threshold
+
+def store_threshold(key, depths, threshold, cache_dir=None):
+    """
+    Memoizes the TSI threshold of a climatology extract and a set of logger
+    depths
+
+    Parameters
+    ----------
+    key       : String
+        Key of the extract, from climatology_key
+    depths    : 1darray
+        Depths of the loggers
+    threshold : float
+        TSI threshold
+    cache_dir : String
+        Cache directory
+    """
+    cache_dir = default_cache_dir(cache_dir)
+    with cache_lock(cache_dir):
+        index = read_index(cache_dir)
+        if key in index:
+            index[key]['thresholds'][depths_key(depths)] = float(threshold)
+            write_index(cache_dir, index)
+
+def evict(cache_dir=None, max_size=None, max_age=None):
+    """
+    Removes climatology extracts and copies of csv files from the cache.
+    Copies of csv files which were deleted or modified since they were
+    parsed are always removed.
+
+    Parameters
+    ----------
+    cache_dir : String
+        Cache directory
+    max_size  : int
+        Maximum total size of the extracts and copies of csv files in bytes.
+        Least recently used entries are removed first. No limit if None.
+    max_age   : float
+        Maximum age of the entries in days, from their download for
+        extracts and from their last use for copies of csv files. No limit
+        if None.
+
+    Returns
+    -------
+    removed : list of String
+        Keys of the removed extracts, and paths of the removed copies of
+        csv files relative to the cache directory
+    """
+    cache_dir = default_cache_dir(cache_dir)
+    removed = []
+    with cache_lock(cache_dir):
+        index = read_index(cache_dir)
+        entries = [dict(key=key,
+                        size=entry['size'],
+                        created=entry['created'],
+                        last_used=entry['last_used'],
+                        is_stale=False)
+                   for key, entry in index.items()]
+        entries += csv_copy_entries(cache_dir)
+        entries.sort(key=lambda entry: entry['last_used'])
+        removed += [entry['key'] for entry in entries if entry['is_stale']]
+        if max_age is not None:
+            oldest = time.time() - max_age*86400
+            removed += [entry['key'] for entry in entries
+                        if entry['created'] < oldest and entry['key'] not in removed]
+        if max_size is not None:
+            total_size = sum([entry['size'] for entry in entries
+                              if entry['key'] not in removed])
+            for entry in entries:
+                if total_size <= max_size:
+                    break
+                if entry['key'] not in removed:
+                    removed.append(entry['key'])
+                    total_size -= entry['size']
+        for key in removed:
+            if key in index:
+                path = os.path.join(cache_dir, index.pop(key)['file'])
+            else:
+                path = os.path.join(cache_dir, key)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        write_index(cache_dir, index)
+    return removed
+
+# =============================================================================
+# Parsed csv files
+# =============================================================================
+
+def csv_copy_path(path, cache_dir=None):
+    """
+    Path of the npz copy of a parsed csv file, named after a hash of its
+    absolute path
+    """
+    directory = os.path.join(default_cache_dir(cache_dir), CSV_DIR_NAME)
+    os.makedirs(directory, exist_ok=True)
+    key = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()
+    return os.path.join(directory, '%s.npz'%key)
+
+def load_csv_copy(path, cache_dir=None):
+    """
+    Loads the parsed time and temperature columns of a csv file from the
+    cache, if they were parsed from its current version
+
+    Parameters
+    ----------
+    path      : String
+        Path of the csv file
+    cache_dir : String
+        Cache directory
+
+    Returns
+    -------
+    columns : tuple of numpy 1d arrays
+        Timestamps and temperature values, None if the cache does not hold
+        the current version of the file
+    """
+    status = os.stat(path)
+    copy_path = csv_copy_path(path, cache_dir=cache_dir)
+    try:
+        with np.load(copy_path) as copy:
+            if copy['size'] == status.st_size \
+                and copy['mtime'] == status.st_mtime_ns:
+                columns = copy['times'], copy['values']
+            else:
+                return None
+        # Last use time, see evict
+        os.utime(copy_path)
+        return columns
+    except (OSError, KeyError, ValueError):
+        return None
+
+def store_csv_copy(path, times, values, cache_dir=None):
+    """
+    Saves the parsed time and temperature columns of a csv file in the
+    cache, with the size and modification time of the file
+    """
+    status = os.stat(path)
+    copy_path = csv_copy_path(path, cache_dir=cache_dir)
+    temporary_path = '%s.%d.tmp.npz'%(copy_path, os.getpid())
+    np.savez(temporary_path, times=times, values=values,
+             size=status.st_size, mtime=status.st_mtime_ns,
+             path=os.path.abspath(path))
+    os.replace(temporary_path, copy_path)
+
+def csv_copy_entries(cache_dir):
+    """
+    Size, last use time and staleness of the copies of csv files of the
+    cache, in the form of evict, a copy being stale when its csv file was
+    deleted or modified
+    """
+    directory = os.path.join(cache_dir, CSV_DIR_NAME)
+    if not os.path.isdir(directory):
+        return []
+    entries = []
+    for name in sorted(os.listdir(directory)):
+        # Temporary files are being written by a run
+        if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+            continue
+        copy_path = os.path.join(directory, name)
+        try:
+            status = os.stat(copy_path)
+        except FileNotFoundError:
+            continue
+        try:
+            with np.load(copy_path) as copy:
+                is_stale = csv_copy_is_stale(str(copy['path']), copy['size'],
+                                             copy['mtime'])
+        except (OSError, KeyError, ValueError):
+            # Unreadable copy, or without the path of its csv file
+            is_stale = True
+        entries.append(dict(key=os.path.join(CSV_DIR_NAME, name),
+                            size=status.st_size,
+                            created=status.st_mtime,
+                            last_used=status.st_mtime,
+                            is_stale=is_stale))
+    return entries
+
+def csv_copy_is_stale(path, size, mtime):
+    """
+    True if the csv file a copy was parsed from was deleted or modified
+    """
+    try:
+        status = os.stat(path)
+    except FileNotFoundError:
+        return True
+    return bool(size != status.st_size or mtime != status.st_mtime_ns)
@@ -0,0 +1,297 @@
+"""
+Stage checkpoints of a run, for resumable runs and cheap reruns.
+
+get_output_checkpointed runs the same pipeline as prepare_darray and
+get_output, saving the result of each stage in a checkpoint directory under
+a key hashing everything it depends on:
+- 'darray', the aligned temperature data: the contents of the csv files and
+  the reading and alignment parameters,
+- 'threshold': the key of darray and the threshold parameter,
+- 'potential_pulses': the key of the threshold,
+- 'shifted_starts': the key of the potential pulses and the start criteria,
+- 'filtered_pulses' (bottom logger filter): the key of the shifted starts,
+- 'shifted_ends': the key of the filtered pulses and the end criteria,
+- 'subpulses', the subpulse table and series: the key of the shifted ends
+  and low_memory.
+A stage is only computed when its key has no checkpoint, so a run which
+failed midway resumes after the last saved stage, and a rerun which changes
+a parameter only computes the stages which depend on it. The output tables
+and Dataset are always made again from the subpulses, so changing the
+output format or writer costs nothing else.
+"""
+import os
+import hashlib
+import numpy as np
+import xarray as xr
+from .inputs import prepare_darray, list_station_files
+from .threshold import (make_tsi_threshold, start_station_threshold,
+                        stop_station_threshold)
+from .features import DetectionFeatures
+from .outputs import format_output
+from .profiling import QUIET
+from . import engine
+
+# Part of every key, to be changed when the content of checkpoints changes
+CHECKPOINT_VERSION = 1
+STAGES = ['darray',
+          'threshold',
+          'potential_pulses',
+          'shifted_starts',
+          'filtered_pulses',
+          'shifted_ends',
+          'subpulses']
+
+
+def get_output_checkpointed(input_dir, checkpoint_dir=None, threshold='godas',
+                            start_flags=None, end_flags=None, low_memory=False,
+                            time_format=None, strategy='interp', profiler=QUIET):
+    """
+    Generates output from the TSI method, reusing the stages checkpointed
+    by earlier runs with the same inputs
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+    checkpoint_dir : String
+        Directory of the checkpoints. '[input_dir]_TSI_out/checkpoints' if
+        None.
+    threshold : String, float or numpy 1d array
+        TSI threshold or how it is computed, see
+        threshold.make_tsi_threshold.
+    start_flags : dict
+        Criteria of engine.shift_starts, missing criteria taking their value
+        in engine.DEFAULT_START_FLAGS.
+    end_flags : dict
+        Criteria of engine.shift_ends, missing criteria taking their value
+        in engine.DEFAULT_END_FLAGS.
+    low_memory : bool
+        If True, the output Dataset is sparse, see
+        outputs.sparse_series_dataset.
+    time_format : String
+        strftime format of the timestamps, see inputs.prepare_darray.
+    strategy : String
+        Alignment strategy, see inputs.prepare_darray.
+    profiler : profiling.Profiler
+        Receives the timing of each stage, and a message for each stage
+        loaded from a checkpoint.
+
+    Returns
+    -------
+    df_output_sub : pandas DataFrame
+        DataFrame containing information about individual subpulses.
+    ds_output : xarrray Dataset
+        Dataset including drops and degree cooling hours data.
+    df_output : pandas DataFrame
+        DataFrame containing information about individual pulses.
+
+    """
+    if checkpoint_dir is None:
+        checkpoint_dir = os.path.join('%s_TSI_out'%os.path.normpath(input_dir),
+                                      'checkpoints')
+    checkpoints = Checkpoints(checkpoint_dir, profiler=profiler)
+    start_flags = dict(engine.DEFAULT_START_FLAGS, **(start_flags or dict()))
+    end_flags = dict(engine.DEFAULT_END_FLAGS, **(end_flags or dict()))
+
+    key = stage_key('darray', input_files_key(input_dir), time_format, strategy)
+    threshold_key = stage_key(key, threshold)
+    pending_threshold = threshold
+    if isinstance(threshold, str) and threshold == 'godas' \
+            and not os.path.exists(checkpoints.path('threshold', threshold_key)):
+        # Retrieved while the csv files are read
+        pending_threshold = start_station_threshold(input_dir)
+    try:
+        darray = checkpoints.step('darray', key,
+                                  lambda: prepare_darray(input_dir,
+                                                         time_format=time_format,
+                                                         strategy=strategy,
+                                                         profiler=profiler))
+        with profiler.stage('features') as record:
+            features = DetectionFeatures.from_darray(darray)
+            record['items'] = features.phi.size
+        dt = darray.time.diff('time').values[0].astype('timedelta64[s]').astype(int)/3600
+
+        key = threshold_key
+        tsi_threshold = checkpoints.step(
+            'threshold', key,
+            lambda: dict(threshold=np.asarray(make_tsi_threshold(darray, input_dir,
+                                                                 pending_threshold,
+                                                                 phi=features.phi))))
+    finally:
+        stop_station_threshold(pending_threshold)
+    tsi_threshold = tsi_threshold['threshold']
+    key = stage_key(key)
+    potential = checkpoints.step(
+        'potential_pulses', key,
+        lambda: dict(zip(['starts', 'ends'],
+                         engine.potential_pulses(features, tsi_threshold))))
+    key = stage_key(key, sorted(start_flags.items()))
+    shifted = checkpoints.step(
+        'shifted_starts', key,
+        lambda: dict(starts=engine.shift_starts(features, potential['starts'],
+                                                **start_flags)))
+    key = stage_key(key)
+    filtered = checkpoints.step(
+        'filtered_pulses', key,
+        lambda: dict(zip(['starts', 'ends'],
+                         engine.remove_if_not_from_bottom_logger(features,
+                                                                 shifted['starts'],
+                                                                 potential['ends']))))
+    key = stage_key(key, sorted(end_flags.items()))
+    ends = checkpoints.step(
+        'shifted_ends', key,
+        lambda: dict(ends=engine.shift_ends(features, filtered['ends'],
+                                            **end_flags)))
+    profiler.message('%d Pulses detected !'%filtered['starts'].size)
+    key = stage_key(key, low_memory)
+    subpulses = checkpoints.step(
+        'subpulses', key,
+        lambda: describe_arrays(*engine.describe_pulses(features.bottom_temperature,
+                                                        filtered['starts'],
+                                                        ends['ends'],
+                                                        dt,
+                                                        sparse=low_memory)))
+    subpulse_table, series = split_arrays(subpulses)
+    return format_output(darray, subpulse_table, series, dt,
+                         low_memory=low_memory, source=input_dir,
+                         profiler=profiler)
+
+class Checkpoints:
+    """
+    Directory of stage checkpoints. Each checkpoint is a file named after
+    its stage and key, written under a temporary name then renamed, so an
+    interrupted run never leaves a partial checkpoint.
+
+    Parameters
+    ----------
+    directory : String
+        Directory of the checkpoints, created if needed
+    profiler  : profiling.Profiler
+        Receives the timing of each stage, computed and saved or loaded
+    """
+    def __init__(self, directory, profiler=QUIET):
+        self.directory = directory
+        self.profiler = profiler
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, stage, key):
+        """
+        Path of the checkpoint of a stage, NetCDF for the temperature data
+        and npz for the arrays of other stages
+        """
+        extension = 'nc' if stage == 'darray' else 'npz'
+        return os.path.join(self.directory, '%s_%s.%s'%(stage, key, extension))
+
+    def step(self, stage, key, compute):
+        """
+        Result of a stage, loaded from its checkpoint if there is one,
+        otherwise computed and checkpointed
+
+        Parameters
+        ----------
+        stage   : String
+            Name of the stage
+        key     : String
+            Key of the inputs and parameters of the stage, see stage_key
+        compute : function
+            Computes the stage without argument. Returns a DataArray for
+            the 'darray' stage, a dict of numpy arrays otherwise.
+
+        Returns
+        -------
+        result : xarray DataArray or dict of numpy arrays
+            Result of the stage
+        """
+        path = self.path(stage, key)
+        if os.path.exists(path):
+            with self.profiler.stage(stage):
+                if stage == 'darray':
+                    result = xr.load_dataarray(path)
+                else:
+                    with np.load(path) as arrays:
+                        result = dict(arrays)
+            self.profiler.message('%s loaded from checkpoint'%stage)
+            return result
+        with self.profiler.stage(stage):
+            result = compute()
+            temporary_path = '%s.%d.tmp'%(path, os.getpid())
+            if stage == 'darray':
+                result.to_netcdf(temporary_path, format='NETCDF4')
+            else:
+                with open(temporary_path, 'wb') as file:
+                    np.savez(file, **result)
+            os.replace(temporary_path, path)
+        return result
+
+def stage_key(*parts):
+    """
+    Key hashing the inputs and parameters of a stage, usually the key of
+    the stage it depends on and its own parameters
+
+    Parameters
+    ----------
+    *parts :
+        Numpy arrays, or values with a deterministic repr
+
+    Returns
+    -------
+    key : String
+        Hexadecimal digest
+    """
+    digest = hashlib.sha256(b'%d'%CHECKPOINT_VERSION)
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            digest.update(('%s%s'%(part.dtype.str, part.shape)).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+def input_files_key(input_dir, block_size=2**20):
+    """
+    Key hashing the names and contents of the csv files of input_dir, which
+    changes whenever a file is added, removed, renamed or modified
+
+    Parameters
+    ----------
+    input_dir  : String
+        Path of the input directory which contains csv files
+    block_size : int
+        Number of bytes hashed at once
+
+    Returns
+    -------
+    key : String
+        Hexadecimal digest
+    """
+    list_csv_files, depths_dict, location = list_station_files(input_dir)
+    digest = hashlib.sha256()
+    for file in sorted(list_csv_files):
+        digest.update(file.encode() + b'\0')
+        with open(os.path.join(input_dir, file), 'rb') as stream:
+            for block in iter(lambda: stream.read(block_size), b''):
+                digest.update(block)
+        digest.update(b'\0')
+    return digest.hexdigest()[:32]
+
+def describe_arrays(subpulse_table, series):
+    """
+    Subpulse table and series of engine.describe_pulses as a single dict of
+    arrays, see split_arrays
+    """
+    arrays = dict([('table_%s'%name, value) for name, value in subpulse_table.items()])
+    arrays.update([('series_%s'%name, value) for name, value in series.items()])
+    return arrays
+
+def split_arrays(arrays):
+    """
+    Subpulse table and series from the dict of describe_arrays
+    """
+    subpulse_table = dict([(name[len('table_'):], value)
+                           for name, value in arrays.items()
+                           if name.startswith('table_')])
+    series = dict([(name[len('series_'):], value)
+                   for name, value in arrays.items()
+                   if name.startswith('series_')])
+    return subpulse_table, series
@@ -0,0 +1,155 @@
+"""
+Out-of-core detection over time chunks.
+
+The temperature record is read one block of chunk_size time steps at a
+time, e.g. from a dask-backed DataArray or a memory-mapped array. Each block
+is detected together with a halo of the previous time steps: pulses still
+open at the end of a block, or which the next block could change, are
+detected again with it, the same way incremental runs stitch new data to the
+existing record. The pulses found are those of a single in-memory run,
+whatever chunk_size and context_length.
+
+Only the subpulse table and the series during subpulses are kept, as in
+low_memory outputs, so memory use depends on chunk_size, on pulse durations
+and on the number of pulses, not on the length of the record.
+"""
+import numpy as np
+from .threshold import make_tsi_threshold, chunked_record_threshold
+from .features import stratification_index
+from .outputs import subpulse_dataframe, pulse_dataframe, sparse_series_dataset
+from .incremental import detect_new_block
+from . import engine
+
+
+def get_output_chunked(darray, input_dir=None, chunk_size=100000,
+                       context_length=720, threshold='godas'):
+    """
+    Generates output from the TSI method by chunks of time steps
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Temperature input data, possibly backed by dask or a file.
+    input_dir : String
+        Path of the input directory, referenced by the sparse Dataset.
+    chunk_size : int
+        Number of time steps loaded in memory at once, at least 2.
+    context_length : int
+        Number of time steps of the previous chunk detected again with each
+        chunk, at least 1.
+    threshold : String or float
+        TSI threshold, or how it is computed: from the GODAS climatology
+        ('godas'), which only reads the location and depths of darray, or
+        from the TSI of each chunk in a first pass over the record
+        ('global'), see threshold.chunked_record_threshold. The 'rolling' and
+        'seasonal' thresholds need the whole record.
+
+    Returns
+    -------
+    df_output_sub : pandas DataFrame
+        DataFrame containing information about individual subpulses.
+    ds_output : xarrray Dataset
+        Sparse dataset of drops and degree cooling hours data, as returned
+        by outputs.get_output with low_memory, see
+        outputs.dense_series_dataset to rebuild the full Dataset.
+    df_output : pandas DataFrame
+        DataFrame containing information about individual pulses.
+
+    """
+    darray = darray.transpose('depth', 'time')
+    if isinstance(threshold, str) and threshold == 'global':
+        tsi_threshold = chunked_record_threshold(
+            stratification_index(np.asarray(darray[:, start:start + chunk_size],
+                                            dtype=float),
+                                 darray.depth.values)
+            for start in range(0, darray.time.size, chunk_size))
+    else:
+        assert not isinstance(threshold, str) or threshold == 'godas',\
+            "The %s threshold needs the whole record, use 'godas', 'global' "\
+            "or a number."%threshold
+        tsi_threshold = make_tsi_threshold(darray, input_dir, threshold)
+    time_step = darray.time.diff('time').values[0].astype('timedelta64[s]').astype(int)
+    subpulse_table, series = detect_chunked(darray, darray.depth.values,
+                                            tsi_threshold,
+                                            time_step=time_step/3600,
+                                            chunk_size=chunk_size,
+                                            context_length=context_length)
+    df_output_sub = subpulse_dataframe(subpulse_table)
+    df_output = pulse_dataframe(df_output_sub, darray.time.values,
+                                time_step/3600)
+    ds_output = sparse_series_dataset(darray, subpulse_table, series,
+                                      source=input_dir)
+    return df_output_sub, ds_output, df_output
+
+def detect_chunked(temperature, depths, threshold, time_step=1.,
+                   chunk_size=100000, context_length=720, keep_series=True):
+    """
+    Runs the full detection pipeline chunk by chunk
+
+    Parameters
+    ----------
+    temperature    : 2d array like
+        Temperature data with dimensions (depth, time). Any object which can
+        be sliced along time and converted with numpy.asarray, such as a dask
+        array or a DataArray.
+    depths         : 1darray
+        Depth of each row of temperature, positive down
+    threshold      : float
+        TSI threshold
+    time_step      : float
+        Time step of the data in hours, used for degree cooling hours
+    chunk_size     : int
+        Number of time steps loaded in memory at once, at least 2
+    context_length : int
+        Number of time steps of the previous chunk detected again with each
+        chunk, at least 1
+    keep_series    : bool
+        If False, instantaneous series are not kept and None is returned
+        instead.
+
+    Returns
+    -------
+    subpulse_table : dict of 1darrays
+        Subpulse table, with SUBPULSE_COLUMNS and METRIC_COLUMNS as keys
+    series         : dict of 1darrays
+        Sparse instantaneous series, with SERIES_NAMES as keys: the time
+        steps of each subpulse, one subpulse after the other, as given by
+        engine.describe_pulses with sparse=True
+    """
+    assert chunk_size >= 2, "chunk_size must be at least 2, not %d."%chunk_size
+    size = temperature.shape[1]
+    state = dict(threshold=threshold,
+                 time_step=time_step*3600,
+                 depths=np.asarray(depths, dtype=float),
+                 size=0,
+                 context_start=0,
+                 boundary=0,
+                 next_pulse_id=0,
+                 subpulse_rows=0)
+    context = np.zeros((temperature.shape[0], 0))
+    tables = []
+    series_parts = []
+    for chunk_start in range(0, size, chunk_size):
+        chunk_stop = min(chunk_start + chunk_size, size)
+        block = np.asarray(temperature[:, chunk_start:chunk_stop], dtype=float)
+        block_table, is_committed, block_series, context = \
+            detect_new_block(state, context, block, context_length,
+                             final=chunk_stop == size, sparse=True)
+        tables.append(dict([(column, values[is_committed])
+                            for column, values in block_table.items()]))
+        if keep_series:
+            is_committed_sample = np.repeat(is_committed,
+                                            block_table['end_subpulse']
+                                            - block_table['start_subpulse'])
+            series_parts.append(dict([(name, values[is_committed_sample])
+                                      for name, values in block_series.items()]))
+    subpulse_table = dict([(column, np.concatenate([table[column]
+                                                    for table in tables]))
+                           for column in engine.SUBPULSE_COLUMNS
+                                       + engine.METRIC_COLUMNS])
+    series = None
+    if keep_series:
+        series = dict([(name, np.concatenate([part[name]
+                                              for part in series_parts]))
+                       for name in engine.SERIES_NAMES])
+    return subpulse_table, series
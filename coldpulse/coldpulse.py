@@ -5,26 +5,198 @@ Created on Tue Apr 21 09:08:42 2020
 @author: rguil
 """
 import os
+import logging
+from collections import namedtuple
 from .inputs import prepare_darray
 from .outputs import get_output, save_output
+from .incremental import update_station, state_paths
+from .checkpoints import get_output_checkpointed
+from .writers import station_name
+from .threshold import start_station_threshold, stop_station_threshold
+from .profiling import Profiler, QUIET
+
+DetectionOutput = namedtuple('DetectionOutput', ['pulses', 'subpulses', 'series'])
 
 
 # =============================================================================
 # Main functions
 # =============================================================================
-def upwelling_cold_pulses_detection(input_dir, ignore_double=True):
+def upwelling_cold_pulses_detection(input_dir, ignore_double=True,
+                                    incremental=False, context_length=720,
+                                    chunk_size=None, low_memory=False,
+                                    writer=None, profiler=None,
+                                    threshold='godas', checkpoint=False,
+                                    save_profile=False, strategy='interp'):
+    """
+    Detects cold pulses in the csv files of input_dir and saves the outputs
+    in '[input_dir]_TSI_out'
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+    ignore_double : bool
+        If True, directories that already have an output directory are not
+        processed again. Not used in incremental mode, nor with checkpoint.
+    incremental : bool
+        If True, only the rows appended to the csv files since the last
+        incremental run are processed, and the outputs are updated.
+    context_length : int
+        Incremental mode only, number of time steps at the end of the record
+        during which pulses are provisional and detected again on the next run,
+        at least 1. Also the halo of previous time steps detected again with
+        each chunk. Pulses which new data could still change are also
+        provisional, so the outputs do not depend on it.
+    chunk_size : int
+        If not None, csv files are read and processed by chunks of chunk_size
+        time steps, so that memory use does not depend on the record length.
+    low_memory : bool
+        If True, the series are saved sparsely as float32, without a copy of
+        the temperature data. See outputs.sparse_series_dataset. Not used in
+        incremental or chunked mode.
+    writer : writers.OutputWriter
+        Writer of the outputs, e.g. to save them as Parquet and Zarr or to a
+        store shared by several stations. Outputs are saved with save_output
+        in '[input_dir]_TSI_out' if None. Not used in incremental or chunked
+        mode.
+    profiler : profiling.Profiler
+        Receives the timing of each stage and the progress of the run, see
+        profiler.report() for the profile of the run. If None, events are
+        logged at INFO level by the logger of this module, which prints
+        nothing unless logging is configured. profiling.QUIET for a run
+        which does not measure anything.
+    threshold : String or float
+        TSI threshold, or how it is computed: from the GODAS climatology
+        ('godas'), which needs internet access on the first run at a
+        location and is retrieved while the csv files are read, or from the
+        record itself ('global', 'rolling' or
+        'seasonal'), see threshold.make_tsi_threshold. Only 'godas' or a
+        number in incremental or chunked mode, where the whole record is
+        never in memory.
+    checkpoint : bool
+        If True, each stage is saved in '[input_dir]_TSI_out/checkpoints'
+        and reused by later runs while its inputs and parameters do not
+        change, see checkpoints.get_output_checkpointed. A failed run
+        resumes after its last saved stage. Not used in incremental or
+        chunked mode.
+    save_profile : bool
+        If True, the stages of the run recorded by the profiler are saved in
+        '[input_dir]_TSI_out/[input_dir]_profile_.csv'.
+    strategy : String
+        How the loggers are resampled on the common time grid, 'interp' or
+        'mean', see alignment.align_samples. Only 'interp' in incremental
+        or chunked mode.
+
+    Returns
+    -------
+    process : bool
+        False if the directory was skipped because it was already processed.
+
+    """
+    if profiler is None:
+        profiler = Profiler(callback=logging.getLogger(__name__))
+    number_records = len(profiler.records)
     process = True
-    list_dir= os.listdir()
-    if '%s_TSI_out'%input_dir in list_dir and ignore_double:
+    output_dir = '%s_TSI_out'%os.path.normpath(input_dir)
+    if os.path.isdir(output_dir) and ignore_double and not incremental \
+            and not checkpoint:
         process = False
-    if not('%s_TSI_out'%input_dir in list_dir):
-        os.mkdir('%s_TSI_out'%input_dir)
-    if process:
-        darray = prepare_darray(input_dir)
-        df_output, ds_output, df_output_sub = get_output(darray, input_dir)
-        save_output(df_output, 
-                    df_output_sub,
-                    ds_output,
-                    input_dir,
-                    dir_name='%s_TSI_out'%input_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    if incremental or chunk_size is not None:
+        assert not isinstance(threshold, str) or threshold == 'godas',\
+            "The %s threshold needs the whole record, it cannot be used in "\
+            "incremental or chunked mode."%threshold
+        assert strategy == 'interp',\
+            "The %s alignment strategy cannot be used in incremental or "\
+            "chunked mode."%strategy
+    if incremental:
+        update_station(input_dir,
+                       dir_name=output_dir,
+                       context_length=context_length,
+                       chunk_size=chunk_size,
+                       profiler=profiler,
+                       threshold=threshold)
+    elif process and chunk_size is not None:
+        for path in state_paths(output_dir, input_dir):
+            if os.path.exists(path):
+                os.remove(path)
+        update_station(input_dir,
+                       dir_name=output_dir,
+                       context_length=context_length,
+                       chunk_size=chunk_size,
+                       profiler=profiler,
+                       threshold=threshold)
+        for path in state_paths(output_dir, input_dir):
+            os.remove(path)
+    elif process:
+        if checkpoint:
+            df_output, ds_output, df_output_sub = \
+                get_output_checkpointed(input_dir, threshold=threshold,
+                                        low_memory=low_memory,
+                                        strategy=strategy,
+                                        profiler=profiler)
+        else:
+            if isinstance(threshold, str) and threshold == 'godas':
+                # Retrieved while the csv files are read
+                threshold = start_station_threshold(input_dir)
+            try:
+                darray = prepare_darray(input_dir, strategy=strategy,
+                                        profiler=profiler)
+                df_output, ds_output, df_output_sub = \
+                    get_output(darray, input_dir, low_memory=low_memory,
+                               profiler=profiler, threshold=threshold)
+            finally:
+                stop_station_threshold(threshold)
+        if writer is None:
+            save_output(df_output, 
+                        df_output_sub,
+                        ds_output,
+                        station_name(input_dir),
+                        dir_name=output_dir)
+        else:
+            writer.write(input_dir, df_output, df_output_sub, ds_output)
+    if save_profile and len(profiler.records) > number_records:
+        profiler.report().iloc[number_records:].to_csv(
+            '%s/%s_profile_.csv'%(output_dir, station_name(input_dir)),
+            index=False)
+    return process
+
+def detect(darray, threshold='godas', low_memory=False, profiler=QUIET):
+    """
+    Detects cold pulses in temperature data already in memory. Nothing is
+    read or written, except the GODAS climatology cache when the threshold
+    is computed from it.
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Temperature data with dimensions (depth, time), depths positive
+        down. With the 'godas' threshold, longitude and latitude
+        coordinates give the location of the station.
+    threshold : String, float or numpy 1d array
+        TSI threshold or how it is computed, see threshold.make_tsi_threshold.
+    low_memory : bool
+        If True, the series are sparse, see outputs.sparse_series_dataset.
+    profiler : profiling.Profiler
+        Receives the timing of each stage. Nothing is reported by default.
+
+    Returns
+    -------
+    output : DetectionOutput
+        Named tuple of the pulse table (pulses), the subpulse table
+        (subpulses) and the Dataset of drops and degree cooling hours
+        (series).
 
+    """
+    assert set(darray.dims) == {'depth', 'time'},\
+        "darray must have dimensions depth and time, not %s."%(darray.dims,)
+    assert not (isinstance(threshold, str) and threshold == 'godas') \
+        or ('longitude' in darray.coords and 'latitude' in darray.coords),\
+        "The GODAS threshold needs longitude and latitude coordinates, "\
+        "give another threshold otherwise."
+    darray = darray.transpose('depth', 'time')
+    df_output_sub, ds_output, df_output = get_output(darray, None,
+                                                     low_memory=low_memory,
+                                                     profiler=profiler,
+                                                     threshold=threshold)
+    return DetectionOutput(df_output, df_output_sub, ds_output)
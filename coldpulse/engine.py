@@ -0,0 +1,940 @@
+"""
+Detection engine working on plain NumPy arrays. 
+
+The whole start/filter/shift/split/metric pipeline runs on a contiguous
+(depth, time) temperature array, without any xarray object, and returns 
+compact index arrays. pulses_detection and get_output are xarray wrappers 
+around these functions.
+
+The stages also run on (depth, site, time) arrays of several sites sharing
+a time axis, see detect_sites. Indexes then refer to the flattened
+(site, time) grid, site*size + time, and breakpoints never cross sites.
+"""
+from collections import namedtuple
+import numpy as np
+from .features import DetectionFeatures
+
+SUBPULSE_COLUMNS = ['pulse_id', 
+                    'start_pulse', 
+                    'end_pulse', 
+                    'start_subpulse', 
+                    'end_subpulse']
+METRIC_COLUMNS = ['dch_subpulse', 
+                  'drop_subpulse', 
+                  'min_temp_subpulse']
+SERIES_NAMES = ['dch', 
+                'drops', 
+                'min_temp', 
+                'pulse_temp']
+
+DetectionResult = namedtuple('DetectionResult', 
+                             ['starts', 'ends', 'subpulses', 'series'])
+DetectionResult.__doc__ = """
+Output of detect
+
+Attributes
+----------
+starts    : 1darray
+    Final start indexes of pulses detected
+ends      : 1darray
+    Final end indexes of pulses detected
+subpulses : dict of 1darrays
+    Subpulse table, with SUBPULSE_COLUMNS and METRIC_COLUMNS as keys
+series    : dict of 1darrays
+    Instantaneous series, with SERIES_NAMES as keys
+"""
+
+def detect(temperature, depths, threshold, time_step=1.,
+           features=None):
+    """
+    Runs the full detection pipeline on a temperature array
+
+    Parameters
+    ----------
+    temperature : 2darray
+        Temperature data with dimensions (depth, time)
+    depths      : 1darray
+        Depth of each row of temperature, positive down
+    threshold   : float
+        TSI threshold
+    time_step   : float
+        Time step of the data in hours, used for degree cooling hours
+    features    : DetectionFeatures
+        Precomputed features of temperature
+
+    Returns
+    -------
+    result : DetectionResult
+        Pulses, subpulse table and instantaneous series
+    """
+    if features is None:
+        features = DetectionFeatures(temperature, depths)
+    starts, ends = detect_pulses(features, threshold)
+    subpulse_table, series = describe_pulses(features.bottom_temperature,
+                                             starts, ends, time_step)
+    return DetectionResult(starts, ends, subpulse_table, series)
+
+def detect_sites(temperature, depths, thresholds, time_step=1., sparse=False):
+    """
+    Runs the full detection pipeline on several sites sharing a time axis,
+    all sites being processed by the same array operations
+
+    Parameters
+    ----------
+    temperature : 3darray
+        Temperature data with dimensions (site, depth, time)
+    depths      : 1darray
+        Depth of each depth row of temperature, positive down
+    thresholds  : float or 1darray
+        TSI threshold, or TSI threshold of each site
+    time_step   : float
+        Time step of the data in hours, used for degree cooling hours
+    sparse      : bool
+        If True, series only hold the time steps of subpulses, see
+        compute_subpulse_metrics.
+
+    Returns
+    -------
+    result : DetectionResult
+        Pulses, subpulse table and instantaneous series. starts and ends
+        are indexes in the flattened (site, time) grid. The subpulse table
+        has a 'site' column, the index of the site of each subpulse, and
+        its indexes are relative to the site. Dense series have dimensions
+        (site, time).
+    """
+    temperature = np.asarray(temperature)
+    features = DetectionFeatures(np.moveaxis(temperature, 1, 0), depths)
+    thresholds = np.asarray(thresholds, dtype=float)
+    if thresholds.ndim == 1:
+        thresholds = thresholds[:, None]
+    size = features.size
+    starts, ends = detect_pulses(features, thresholds)
+    subpulse_table, series = describe_pulses(features.bottom_temperature.reshape(-1),
+                                             starts, ends, time_step,
+                                             sparse=sparse,
+                                             segment_size=size)
+    site = subpulse_table['start_pulse']//size
+    for name in SUBPULSE_COLUMNS[1:]:
+        subpulse_table[name] = subpulse_table[name] - site*size
+    subpulse_table = dict(site=site, **subpulse_table)
+    if not sparse:
+        series = dict([(name, values.reshape(-1, size))
+                       for name, values in series.items()])
+    return DetectionResult(starts, ends, subpulse_table, series)
+
+def detect_pulses(features, threshold):
+    """
+    Detects pulse start and end indexes from features
+
+    Parameters
+    ----------
+    features  : DetectionFeatures
+        Features of the temperature data
+    threshold : float
+        TSI threshold
+
+    Returns
+    -------
+    filtered_starts : 1darray
+        final start indexes of pulses detected
+    shifted_filtered_ends : 1darray
+        final end indexes of pulses detected
+    """
+    list_starts, list_ends = potential_pulses(features, threshold)
+    shifted_starts = shift_starts(features, list_starts, **DEFAULT_START_FLAGS)
+    filtered_starts, filtered_ends = \
+        remove_if_not_from_bottom_logger(features, shifted_starts, list_ends)
+    shifted_filtered_ends = shift_ends(features, filtered_ends,
+                                       **DEFAULT_END_FLAGS)
+    return filtered_starts, shifted_filtered_ends
+
+# =============================================================================
+# Detection stages
+# =============================================================================
+
+# Criteria of shift_starts and shift_ends used by detect_pulses and
+# detection.pulses_detection
+DEFAULT_START_FLAGS = dict(use_positive_phi = True,
+                           use_increasing_phi = True,
+                           use_increasing_temp = False,
+                           use_minimum_water_column_temp = True)
+DEFAULT_END_FLAGS = dict(use_positive_phi = True,
+                         use_decreasing_phi = True,
+                         use_decreasing_temp = True,
+                         use_maximum_water_column_temp = True)
+
+def potential_pulses(features, threshold):
+    """
+    Extract start and end indexes of potential pulses from TSI below a 
+    threshold
+    
+    Parameters
+    ----------
+    features  : DetectionFeatures
+        Features of the temperature data
+    threshold : float
+        TSI threshold
+    
+    Returns
+    -------
+    list_starts  : 1darray 
+        Array of indexes representing the start of the TSI variability detected
+    list_ends    : 1darray
+        Array of indexes representing the end of the TSI variability detected
+    """
+    is_potential_pulse_present = features.bottom_is_min & (features.phi<threshold)
+    size = features.size
+    # Padded with absent time steps at both ends of each site, so that
+    # pulses present on the first or last time step start at 0 or end at
+    # size-1
+    padding = np.zeros(is_potential_pulse_present.shape[:-1] + (1,), dtype=bool)
+    presence_change = np.diff(np.concatenate([padding,
+                                              is_potential_pulse_present,
+                                              padding], axis=-1).astype(np.int8),
+                              axis=-1).reshape(-1, size+1)
+    site_starts, list_starts = np.nonzero(presence_change>0)
+    site_ends, list_ends = np.nonzero(presence_change<0)
+    list_starts = site_starts*size + np.maximum(list_starts-1, 0)
+    list_ends = site_ends*size + np.minimum(list_ends, size-1)
+    return list_starts, list_ends
+
+def shift_starts(features, list_starts,
+                 use_positive_phi = True,
+                 use_increasing_phi = True,
+                 use_increasing_temp = True,
+                 use_minimum_water_column_temp = True):
+    """
+    Shifts starts indexes to get the real start of potential pulses, see
+    coldpulse.detection.shift_starts for the meaning of each criterion
+    
+    Parameters
+    ----------
+    features    : DetectionFeatures
+        Features of the temperature data
+    list_starts : 1darray 
+        Array of indexes representing the start of the TSI variability detected
+        
+    Returns
+    -------
+    new_list_starts : 1darray
+        List of shifted start indexes with chosen parameters
+    """
+    potential_new_starts = start_breakpoints(features,
+                                             use_positive_phi = use_positive_phi,
+                                             use_increasing_phi = use_increasing_phi,
+                                             use_increasing_temp = use_increasing_temp,
+                                             use_minimum_water_column_temp = \
+                                                 use_minimum_water_column_temp)
+    return snap_to_breakpoints(list_starts, potential_new_starts,
+                               direction='backward')
+
+def start_breakpoints(features,
+                      use_positive_phi = True,
+                      use_increasing_phi = True,
+                      use_increasing_temp = True,
+                      use_minimum_water_column_temp = True):
+    """
+    Indexes pulse starts are shifted back to, which only depend on the
+    features and the criteria, see shift_starts
+    
+    Parameters
+    ----------
+    features    : DetectionFeatures
+        Features of the temperature data
+        
+    Returns
+    -------
+    potential_new_starts : 1darray
+        Sorted indexes where a pulse can start
+    """
+    not_a_pulse = np.zeros(features.phi.shape, dtype=bool)
+    if use_positive_phi:
+        not_a_pulse |= features.phi >= 0
+    if use_increasing_phi:
+        not_a_pulse |= align_difference(features.phi_diff, lag=1) >= 0
+    if use_increasing_temp:
+        not_a_pulse |= \
+            align_difference(features.bottom_temperature_diff, lag=1) >= 0
+    if use_minimum_water_column_temp:
+        not_a_pulse |= ~features.bottom_is_min
+    not_a_pulse[..., 0] = True
+    return np.flatnonzero(not_a_pulse)
+
+def remove_if_not_from_bottom_logger(features, list_starts, list_ends,
+                                     phi_range_argmin=None):
+    """
+    Filters potential pulses that do not pass the bottom logger test
+    
+    Parameters
+    ----------
+    features         : DetectionFeatures
+        Features of the temperature data
+    list_starts      : 1darray 
+        Array of indexes representing the start of the TSI variability detected
+    list_ends        : 1darray
+        Array of indexes representing the end of the TSI variability detected
+    phi_range_argmin : RangeArgmin
+        Prebuilt index of the minima of phi, faster for long windows when
+        the filter runs many times on the same features
+    
+    Returns
+    -------
+    new_list_starts : 1darray
+    new_list_ends   : 1darray
+    
+    Returns new list_starts and list_ends list with indexes from potential 
+    pulse that are not linked with cooling in the bottom logger removed.
+    """
+    list_starts = np.asarray(list_starts, dtype=int)
+    list_ends = np.asarray(list_ends, dtype=int)
+    if list_starts.size == 0:
+        return list_starts, list_ends
+    index_bottom_logger = features.index_bottom_logger
+    temperature = features.temperature.reshape(features.depths.size, -1)
+    if phi_range_argmin is None:
+        phi_argmin = windowed_argmin(features.phi.reshape(-1), list_starts, list_ends)
+    else:
+        phi_argmin = phi_range_argmin.query(list_starts, list_ends)
+    has_phi = phi_argmin >= 0
+    temp_difference_till_phi_argmin = \
+        temperature[:, list_starts] - temperature[:, phi_argmin]
+    absolute_difference = np.abs(temp_difference_till_phi_argmin)
+    # Same outcome as the single pulse test: NaN differences are skipped when
+    # looking for the largest cooling, and a window without any valid
+    # difference fails the test.
+    absolute_difference[np.isnan(absolute_difference)] = -np.inf
+    bottom_difference = temp_difference_till_phi_argmin[index_bottom_logger]
+    is_from_bottom_logger = has_phi \
+        & (bottom_difference != 0) \
+        & ~np.isnan(bottom_difference) \
+        & (absolute_difference.argmax(axis=0) == index_bottom_logger)
+    return list_starts[is_from_bottom_logger], list_ends[is_from_bottom_logger]
+
+def shift_ends(features, list_ends,
+               use_positive_phi = True,
+               use_decreasing_phi = True,
+               use_decreasing_temp = True,
+               use_maximum_water_column_temp = True):
+    """
+    Shifts ends indexes to get the real end of potential pulses, see
+    coldpulse.detection.shift_ends for the meaning of each criterion
+    
+    Parameters
+    ----------
+    features  : DetectionFeatures
+        Features of the temperature data
+    list_ends : 1darray
+        Array of indexes representing the end of the TSI variability detected
+        
+    Returns
+    -------
+    new_list_ends : 1darray
+        List of shifted end indexes with chosen parameters
+    """
+    potential_new_ends = end_breakpoints(features,
+                                         use_positive_phi = use_positive_phi,
+                                         use_decreasing_phi = use_decreasing_phi,
+                                         use_decreasing_temp = use_decreasing_temp,
+                                         use_maximum_water_column_temp = \
+                                             use_maximum_water_column_temp)
+    return snap_to_breakpoints(list_ends, potential_new_ends,
+                               direction='forward')
+
+def end_breakpoints(features,
+                    use_positive_phi = True,
+                    use_decreasing_phi = True,
+                    use_decreasing_temp = True,
+                    use_maximum_water_column_temp = True):
+    """
+    Indexes pulse ends are shifted forward to, which only depend on the
+    features and the criteria, see shift_ends
+    
+    Parameters
+    ----------
+    features  : DetectionFeatures
+        Features of the temperature data
+        
+    Returns
+    -------
+    potential_new_ends : 1darray
+        Sorted indexes where a pulse can end
+    """
+    not_a_pulse = np.isnan(features.phi)
+    if use_positive_phi:
+        not_a_pulse |= features.phi >= 0
+    if use_decreasing_temp:
+        not_a_pulse |= \
+            align_difference(features.bottom_temperature_diff, lag=1) <= 0
+    if use_decreasing_phi:
+        not_a_pulse |= align_difference(features.phi_diff, lag=0) <= 0
+    if use_maximum_water_column_temp:
+        not_a_pulse |= features.bottom_is_max
+    if use_decreasing_temp or use_decreasing_phi:
+        # Differences only exist from the second time step on: the mask, and
+        # therefore the breakpoint positions, start there. Ends after the
+        # last breakpoint are set to the last time step.
+        not_a_pulse = not_a_pulse[..., 1:]
+        not_a_pulse[..., -1] = True
+        not_a_pulse = np.concatenate([not_a_pulse,
+                                      np.ones(not_a_pulse.shape[:-1] + (1,),
+                                              dtype=bool)], axis=-1)
+    else:
+        not_a_pulse[..., -1] = True
+    return np.flatnonzero(not_a_pulse)
+
+# =============================================================================
+# Pulse splitting and metrics
+# =============================================================================
+
+def describe_pulses(temperature, list_starts, list_ends, time_step,
+                    sparse=False, segment_size=None):
+    """
+    Splits pulses into subpulses and computes their metrics
+
+    Parameters
+    ----------
+    temperature : numpy 1d array
+        Bottom temperature data.
+    list_starts : numpy 1d array
+        Array containing start indexes of found pulses.
+    list_ends : numpy 1d array
+        Array containing end indexes of found pulses.
+    time_step : float
+        Time step in hours.
+    sparse : bool
+        If True, series only hold the time steps of subpulses, see
+        compute_subpulse_metrics.
+    segment_size : int
+        Number of time steps of each site when temperature holds several
+        sites one after the other, see split_pulses.
+
+    Returns
+    -------
+    subpulse_table : dict of numpy 1d arrays
+        Subpulse table, with SUBPULSE_COLUMNS and METRIC_COLUMNS as keys.
+    series : dict of numpy 1d arrays
+        Instantaneous series, with SERIES_NAMES as keys.
+
+    """
+    subpulses = split_pulses(temperature, list_starts, list_ends,
+                             segment_size=segment_size)
+    metrics, series = compute_subpulse_metrics(temperature,
+                                               subpulses[1],
+                                               subpulses[3],
+                                               subpulses[4],
+                                               time_step,
+                                               sparse=sparse)
+    subpulse_table = dict(zip(SUBPULSE_COLUMNS + METRIC_COLUMNS, 
+                              subpulses + metrics))
+    return subpulse_table, dict(zip(SERIES_NAMES, series))
+
+def split_pulses(temperature, list_starts, list_ends, segment_size=None):
+    """
+    Splits pulses following method for DCH computation
+
+    Parameters
+    ----------
+    temperature : numpy 1d array
+        Bottom temperature data.
+    list_starts : numpy 1d array
+        Array containing start indexes of found pulses.
+    list_ends : numpy 1d array
+        Array containing end indexes of found pulses.
+    segment_size : int
+        If not None, temperature holds several sites of segment_size time
+        steps one after the other, and pulses are bounded by their site.
+        
+    Returns
+    -------
+    subpulses : tuple of numpy 1d arrays
+        Pulse id, start and end of the pulse, start and end of the subpulse,
+        for each subpulse
+
+    """
+    temperature = np.asarray(temperature, dtype=float)
+    starts_no_overlap, ends_no_overlap = \
+        merge_overlapping_pulses(list_starts, list_ends, temperature.size,
+                                 segment_size=segment_size)
+    starts_no_overlap_split, ends_no_overlap_split = \
+        split_warmer_than_initial(temperature,
+                                  starts_no_overlap,
+                                  ends_no_overlap)
+    return find_subpulses(temperature,
+                          starts_no_overlap_split,
+                          ends_no_overlap_split)
+
+def compute_subpulse_metrics(temperature, start_pulses, start_subpulses,
+                             end_subpulses, dt, sparse=False):
+    """
+    Computes DCH, drop and minimum temperature of all subpulses in one
+    batched pass with segment reductions
+
+    Parameters
+    ----------
+    temperature : numpy 1d array
+        Bottom temperature data.
+    start_pulses : numpy 1d array
+        Start index of the pulse of each subpulse.
+    start_subpulses : numpy 1d array
+        Start index of each subpulse.
+    end_subpulses : numpy 1d array
+        End index of each subpulse (excluded), greater than its start.
+    dt : float
+        Time step in hours.
+    sparse : bool
+        If True, series only hold the time steps of subpulses, one subpulse
+        after the other, instead of the whole time series.
+
+    Returns
+    -------
+    subpulse_metrics : tuple of numpy 1d arrays
+        DCH, drop and minimum temperature of each subpulse.
+    series : tuple of numpy 1d arrays
+        Instantaneous DCH, drops, minimum temperature and pulse temperature,
+        NaN outside of subpulses.
+
+    """
+    start_pulses = np.asarray(start_pulses, dtype=int)
+    start_subpulses = np.asarray(start_subpulses, dtype=int)
+    lengths = np.asarray(end_subpulses, dtype=int) - start_subpulses
+    offsets = np.cumsum(lengths) - lengths
+    flat_index = concatenated_ranges(start_subpulses, lengths)
+    pulse_temperature = temperature[flat_index]
+    drop_values = pulse_temperature - np.repeat(temperature[start_pulses],
+                                                lengths)
+    dch_values = -drop_values*dt
+    if lengths.size:
+        dch = np.add.reduceat(np.where(np.isnan(dch_values), 0, dch_values),
+                              offsets)
+        drops = np.fmin.reduceat(drop_values, offsets)
+        min_temp = np.fmin.reduceat(pulse_temperature, offsets)
+    else:
+        dch = drops = min_temp = np.zeros(0)
+    if sparse:
+        return (dch, drops, min_temp), \
+            (dch_values, np.repeat(drops, lengths), np.repeat(min_temp, lengths),
+             pulse_temperature)
+    dch_series = np.full(temperature.size, np.nan)
+    drops_series = np.full(temperature.size, np.nan)
+    min_temp_series = np.full(temperature.size, np.nan)
+    temp_series = np.full(temperature.size, np.nan)
+    dch_series[flat_index] = dch_values
+    drops_series[flat_index] = np.repeat(drops, lengths)
+    min_temp_series[flat_index] = np.repeat(min_temp, lengths)
+    temp_series[flat_index] = pulse_temperature
+    return (dch, drops, min_temp), \
+        (dch_series, drops_series, min_temp_series, temp_series)
+
+def merge_overlapping_pulses(list_starts, list_ends, size, segment_size=None):
+    """
+    Combines pulses if they overlap, with one sort and one scan
+
+    Parameters
+    ----------
+    list_starts : numpy 1d array
+        Array containing start indexes of found pulses.
+    list_ends : numpy 1d array
+        Array containing end indexes of found pulses.
+    size : int
+        Length of the time series.
+    segment_size : int
+        Length of each site when the time series holds several sites one
+        after the other. Pulses are bounded by their site. size if None.
+        
+    Returns
+    -------
+    starts_no_overlap : numpy 1d array
+        Start indexes of merged pulses.
+    ends_no_overlap : numpy 1d array
+        End indexes of merged pulses.
+
+    """
+    if segment_size is None:
+        segment_size = size
+    list_starts = np.asarray(list_starts, dtype=int)
+    segment_starts = list_starts//segment_size*segment_size
+    list_ends = np.minimum(np.asarray(list_ends, dtype=int),
+                           segment_starts + segment_size)
+    is_not_empty = list_starts < list_ends
+    list_starts = list_starts[is_not_empty]
+    list_ends = list_ends[is_not_empty]
+    segment_starts = segment_starts[is_not_empty]
+    order = np.argsort(list_starts, kind='stable')
+    list_starts = list_starts[order]
+    list_ends = list_ends[order]
+    segment_starts = segment_starts[order]
+    running_end = np.maximum.accumulate(list_ends)
+    is_new_pulse = np.ones(list_starts.size, dtype=bool)
+    is_new_pulse[1:] = list_starts[1:] > running_end[:-1]
+    first_of_pulse = np.flatnonzero(is_new_pulse)
+    covered_starts = list_starts[first_of_pulse]
+    if first_of_pulse.size:
+        covered_ends = np.maximum.reduceat(list_ends, first_of_pulse)
+    else:
+        covered_ends = list_ends[:0]
+    # Pulses cover [start, end[. Merged pulses are bounded by the changes of
+    # the covering mask, i.e. one time step before its first and last
+    # covered indexes, unless the mask is set from the first index.
+    segment_starts = segment_starts[first_of_pulse]
+    starts_no_overlap = np.maximum(covered_starts - 1, segment_starts)
+    ends_no_overlap = np.minimum(covered_ends,
+                                 segment_starts + segment_size - 1) - 1
+    return starts_no_overlap, ends_no_overlap
+
+def split_warmer_than_initial(temperature, list_starts, list_ends):
+    """
+    Divides pulses if the temperature gets warmer than the initial 
+    temperature. Pulses start at their first temperature decrease and pulses
+    without any decrease are discarded.
+
+    Parameters
+    ----------
+    temperature : numpy 1d array
+        Bottom temperature data.
+    list_starts : numpy 1d array
+        Array containing start indexes of merged pulses.
+    list_ends : numpy 1d array
+        Array containing end indexes of merged pulses.
+        
+    Returns
+    -------
+    split_starts : numpy 1d array
+        Start indexes of split pulses.
+    split_ends : numpy 1d array
+        End indexes of split pulses.
+
+    """
+    decreasing_positions = np.flatnonzero(np.diff(temperature) < 0)
+    split_starts = []
+    split_ends = []
+    for start, end in zip(list_starts, list_ends):
+        init_start = find_next_decrease(decreasing_positions, start, end)
+        while init_start >= 0:
+            new_end = find_first_warmer(temperature, init_start, end)
+            if new_end < 0:
+                split_starts.append(init_start)
+                split_ends.append(end)
+                break
+            split_starts.append(init_start)
+            split_ends.append(new_end)
+            init_start = find_next_decrease(decreasing_positions, new_end, end)
+    return np.array(split_starts, dtype=int), np.array(split_ends, dtype=int)
+
+def find_next_decrease(decreasing_positions, start, end):
+    """
+    Finds the first temperature decrease between start and end
+
+    Parameters
+    ----------
+    decreasing_positions : numpy 1d array
+        Sorted indexes i where temperature[i+1] < temperature[i].
+    start : int
+        Index where the search starts.
+    end : int
+        Index at which the search stops (excluded).
+        
+    Returns
+    -------
+    index : int
+        Index of the last temperature before the decrease, -1 if the 
+        temperature does not decrease between start and end.
+
+    """
+    position = np.searchsorted(decreasing_positions, start)
+    if position < decreasing_positions.size \
+        and decreasing_positions[position] < end-1:
+        return decreasing_positions[position]
+    return -1
+
+def find_first_warmer(temperature, start, end, block_size=64):
+    """
+    Finds the first index between start and end where the temperature is 
+    warmer than at start. The search runs on blocks of increasing size so 
+    that its cost only depends on the distance to the found index.
+
+    Parameters
+    ----------
+    temperature : numpy 1d array
+        Bottom temperature data.
+    start : int
+        Index of the initial temperature.
+    end : int
+        Index at which the search stops (excluded).
+    block_size : int
+        Size of the first block searched.
+        
+    Returns
+    -------
+    index : int
+        Index of the first warmer temperature, -1 if none is found.
+
+    """
+    initial_temperature = temperature[start]
+    position = start + 1
+    while position < end:
+        stop = min(position + block_size, end)
+        warmer = np.flatnonzero(temperature[position:stop] 
+                                > initial_temperature)
+        if warmer.size:
+            return position + warmer[0]
+        position = stop
+        block_size *= 2
+    return -1
+
+def find_subpulses(temperature, list_starts, list_ends):
+    """
+    Divides pulses into subpulses between local maxima of the temperature,
+    found in a single pass over the whole series.
+
+    Parameters
+    ----------
+    temperature : numpy 1d array
+        Bottom temperature data.
+    list_starts : numpy 1d array
+        Array containing start indexes of split pulses.
+    list_ends : numpy 1d array
+        Array containing end indexes of split pulses.
+        
+    Returns
+    -------
+    subpulses : tuple of numpy 1d arrays
+        Pulse id, start and end of the pulse, start and end of the subpulse,
+        for each subpulse
+
+    """
+    local_maxima = strict_local_maxima(temperature)
+    # Maxima of a pulse extract cannot be on its first or last index
+    first_maximum = np.searchsorted(local_maxima, list_starts, side='right')
+    last_maximum = np.searchsorted(local_maxima, list_ends-1, side='left')
+    number_maxima = np.maximum(last_maximum - first_maximum, 0)
+    number_subpulses = number_maxima + 1
+    pulse_maxima = local_maxima[concatenated_ranges(first_maximum,
+                                                    number_maxima)]
+    first_subpulse = np.cumsum(number_subpulses) - number_subpulses
+    is_first_subpulse = np.zeros(number_subpulses.sum(), dtype=bool)
+    is_first_subpulse[first_subpulse] = True
+    is_last_subpulse = np.zeros(number_subpulses.sum(), dtype=bool)
+    is_last_subpulse[first_subpulse + number_maxima] = True
+    start_subpulses = np.empty(number_subpulses.sum(), dtype=int)
+    start_subpulses[is_first_subpulse] = list_starts
+    start_subpulses[~is_first_subpulse] = pulse_maxima
+    end_subpulses = np.empty(number_subpulses.sum(), dtype=int)
+    end_subpulses[is_last_subpulse] = list_ends
+    end_subpulses[~is_last_subpulse] = pulse_maxima
+    return np.repeat(np.arange(list_starts.size), number_subpulses), \
+        np.repeat(list_starts, number_subpulses), \
+        np.repeat(list_ends, number_subpulses), \
+        start_subpulses, \
+        end_subpulses
+
+# =============================================================================
+# Boundary engine and segment reductions
+# =============================================================================
+
+def strict_local_maxima(series):
+    """
+    Indexes of the values strictly greater than both their neighbours, as
+    scipy.signal.argrelmax(series)[0], the first and last values never
+    being maxima
+    """
+    is_maximum = (series[1:-1] > series[:-2]) & (series[1:-1] > series[2:])
+    return np.flatnonzero(is_maximum) + 1
+
+def snap_to_breakpoints(indexes, breakpoints, direction='backward',
+                        fill_value=None):
+    """
+    Snaps all indexes to their closest breakpoint in one vectorized call
+    
+    Parameters
+    ----------
+    indexes     : 1darray
+        Indexes to snap, e.g. starts or ends of potential pulses
+    breakpoints : 1darray
+        Sorted array of candidate indexes
+    direction   : str
+        'backward' to snap to the last breakpoint lower or equal to each index,
+        'forward' to snap to the first breakpoint greater or equal to it
+    fill_value  : int
+        Value used when no breakpoint is found in the given direction
+        
+    Returns
+    -------
+    snapped_indexes : 1darray
+        Array of snapped indexes
+    """
+    indexes = np.asarray(indexes, dtype=int)
+    breakpoints = np.asarray(breakpoints, dtype=int)
+    if direction == 'backward':
+        positions = np.searchsorted(breakpoints, indexes, side='right') - 1
+        found = positions >= 0
+    elif direction == 'forward':
+        positions = np.searchsorted(breakpoints, indexes, side='left')
+        found = positions < breakpoints.size
+    else:
+        raise ValueError("direction should be 'backward' or 'forward', "
+                         "got %s."%direction)
+    snapped_indexes = np.full(indexes.size, -1 if fill_value is None
+                                            else fill_value)
+    snapped_indexes[found] = breakpoints[positions[found]]
+    return snapped_indexes
+
+def windowed_argmin(series, list_starts, list_ends):
+    """
+    Index of the minimum of a series in every window from start to end 
+    (included), computed with segment reductions over a flat index
+    
+    Parameters
+    ----------
+    series      : 1darray
+        Time series, NaN values are skipped
+    list_starts : 1darray 
+        Array of window start indexes
+    list_ends   : 1darray
+        Array of window end indexes, greater or equal to the starts
+        
+    Returns
+    -------
+    argmins : 1darray
+        Index of the first minimum in each window, -1 if the window only
+        contains NaN
+    """
+    lengths = list_ends - list_starts + 1
+    offsets = np.cumsum(lengths) - lengths
+    total_length = lengths.sum()
+    flat_index = concatenated_ranges(list_starts, lengths)
+    window_values = series[flat_index]
+    window_values = np.where(np.isnan(window_values), np.inf, window_values)
+    window_minimum = np.minimum.reduceat(window_values, offsets)
+    is_minimum = window_values == np.repeat(window_minimum, lengths)
+    first_minimum = np.minimum.reduceat(np.where(is_minimum,
+                                                 np.arange(total_length),
+                                                 total_length),
+                                        offsets)
+    argmins = flat_index[first_minimum]
+    argmins[window_minimum == np.inf] = -1
+    return argmins
+
+class RangeArgmin:
+    """
+    Index of the first minimum of a series over many windows, from a sparse
+    table of the minima of blocks of the series. Each window costs
+    O(block_size) whatever its length, once the table is built in O(size).
+
+    Parameters
+    ----------
+    series     : 1darray
+        Time series, NaN values are skipped
+    block_size : int
+        Number of time steps per block
+    """
+    def __init__(self, series, block_size=64):
+        series = np.asarray(series, dtype=float)
+        self.block_size = block_size
+        number_blocks = max(-(-series.size//block_size), 1)
+        self.values = np.full(number_blocks*block_size, np.inf)
+        self.values[:series.size] = np.where(np.isnan(series), np.inf, series)
+        block_argmin = self.values.reshape(number_blocks, block_size).argmin(axis=1)
+        # table[level, block]: index of the first minimum of the 2**level
+        # blocks from block on
+        levels = int(np.log2(number_blocks)) + 1
+        self.table = np.zeros((levels, number_blocks), dtype=np.int64)
+        self.table[0] = np.arange(number_blocks)*block_size + block_argmin
+        for level in range(1, levels):
+            half = 2**(level-1)
+            left = self.table[level-1, :number_blocks-half]
+            right = self.table[level-1, half:]
+            self.table[level, :number_blocks-half] = \
+                np.where(self.values[right] < self.values[left], right, left)
+
+    def query(self, list_starts, list_ends):
+        """
+        Index of the first minimum in every window from start to end
+        (included), see windowed_argmin
+
+        Parameters
+        ----------
+        list_starts : 1darray
+            Array of window start indexes
+        list_ends   : 1darray
+            Array of window end indexes, greater or equal to the starts
+
+        Returns
+        -------
+        argmins : 1darray
+            Index of the first minimum in each window, -1 if the window only
+            contains NaN
+        """
+        list_starts = np.asarray(list_starts, dtype=int)
+        list_ends = np.asarray(list_ends, dtype=int)
+        block_size = self.block_size
+        first_block = list_starts//block_size
+        last_block = list_ends//block_size
+        # Candidates in increasing index order: the partial first block, the
+        # whole blocks in between, covered by two overlapping table ranges,
+        # and the partial last block
+        head = windowed_argmin(self.values, list_starts,
+                               np.minimum(list_ends, (first_block+1)*block_size - 1))
+        tail = windowed_argmin(self.values,
+                               np.maximum(list_starts, last_block*block_size),
+                               list_ends)
+        head = np.where(head < 0, list_starts, head)
+        tail = np.where(tail < 0, list_ends, tail)
+        number_middle = last_block - first_block - 1
+        has_middle = number_middle > 0
+        level = np.zeros(list_starts.size, dtype=int)
+        level[has_middle] = np.log2(number_middle[has_middle]).astype(int)
+        middle_left = np.where(has_middle,
+                               self.table[level, np.where(has_middle, first_block + 1, 0)],
+                               head)
+        middle_right = np.where(has_middle,
+                                self.table[level, np.where(has_middle,
+                                                           last_block - 2**level, 0)],
+                                head)
+        candidates = np.stack([head, middle_left, middle_right, tail])
+        best = self.values[candidates].argmin(axis=0)
+        argmins = candidates[best, np.arange(list_starts.size)]
+        argmins[self.values[argmins] == np.inf] = -1
+        return argmins
+
+def concatenated_ranges(list_starts, lengths):
+    """
+    Flat index covering several ranges one after the other
+    
+    Parameters
+    ----------
+    list_starts : 1darray 
+        Array of range start indexes
+    lengths     : 1darray
+        Array of range lengths
+        
+    Returns
+    -------
+    flat_index : 1darray
+        Concatenation of range(start, start+length) for all ranges
+    """
+    lengths = np.asarray(lengths, dtype=int)
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(np.asarray(list_starts, dtype=int) - offsets, lengths) \
+         + np.arange(lengths.sum())
+
+def align_difference(difference, lag):
+    """
+    Aligns a first order difference on the time steps of its series, from the
+    third time step on: x[t-1] - x[t-2] if lag is 1, x[t] - x[t-1] if lag is 0
+    
+    Parameters
+    ----------
+    difference : 1darray
+        First order difference of a time series, as given by np.diff
+    lag        : int
+        0 or 1, lag of the difference
+        
+    Returns
+    -------
+    aligned_difference : 1darray
+        Difference at each time step, NaN where it is not defined
+    """
+    size = difference.shape[-1]
+    aligned_difference = np.full(difference.shape[:-1] + (size+1,), np.nan)
+    aligned_difference[..., 2:] = difference[..., 1-lag:size-lag]
+    return aligned_difference
@@ -0,0 +1,257 @@
+"""
+Features of the temperature data shared by the detection stages.
+
+DetectionFeatures computes once the arrays every stage reads: the
+temperature stratification index (TSI), its difference, the bottom
+temperature and the minimum and maximum of the water column. With many
+depths, such as thermistor chains, the TSI and the column extrema are
+computed in a single pass over tiles of CHAIN_BLOCK_SIZE time steps, see
+chain_reductions, instead of one reduction over the whole array each. The
+operations are done in the same order, so the features are exactly those of
+stratification_index and numpy reductions.
+"""
+import warnings
+import numpy as np
+
+# Time steps of the tiles of chain_reductions, so that a tile of a few tens
+# of depths stays in cache while it is reduced
+CHAIN_BLOCK_SIZE = 4096
+
+def compute_temperature_stratification_index(darray):
+    """
+    Computes the temperature stratification index of a temperature time series
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Represents temperature data
+
+    Returns
+    -------
+    phi : xarray DataArray
+        Represent the temperature stratification index
+    """
+    return ((darray-darray.mean('depth'))*darray.depth).mean('depth')
+
+def stratification_index(temperature, depths):
+    """
+    Computes the temperature stratification index of a (depth, time) array,
+    NaN values being skipped as in compute_temperature_stratification_index
+
+    Parameters
+    ----------
+    temperature : ndarray
+        Temperature data with dimensions (depth, time), or (depth, site,
+        time) for several sites
+    depths      : 1darray
+        Depth of each row of temperature, positive down
+
+    Returns
+    -------
+    phi : ndarray
+        Represent the temperature stratification index, with the dimensions
+        of temperature but depth
+    """
+    depths = np.asarray(depths, dtype=temperature.dtype)
+    depths = depths.reshape((-1,) + (1,)*(temperature.ndim-1))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        column_mean = np.nanmean(temperature, axis=0)
+        return np.nanmean((temperature - column_mean)*depths, axis=0)
+
+def chain_reductions(temperature, depths, index_bottom_logger,
+                     block_size=CHAIN_BLOCK_SIZE):
+    """
+    Computes the TSI, the minimum and maximum temperature of the water
+    column and whether the bottom logger holds them, in a single pass over
+    tiles of block_size time steps. Each tile is reduced over depth while
+    it is in cache, so that no temporary array of the size of temperature
+    is made and the time grows linearly with the number of depths. The
+    operations of stratification_index are done in the same order, so the
+    TSI is exactly the same, ties included.
+
+    Parameters
+    ----------
+    temperature         : ndarray
+        Temperature data with dimensions (depth, time) or (depth, site,
+        time), C-contiguous
+    depths              : 1darray
+        Depth of each row of temperature, positive down
+    index_bottom_logger : int
+        Row of the deepest logger
+    block_size          : int
+        Number of time steps of each tile
+
+    Returns
+    -------
+    phi           : ndarray
+        Temperature stratification index
+    column_min    : ndarray
+        Minimum temperature in the water column, NaN values skipped
+    column_max    : ndarray
+        Maximum temperature in the water column, NaN values skipped
+    bottom_is_min : ndarray
+        True where the bottom temperature is the column minimum
+    bottom_is_max : ndarray
+        True where the bottom temperature is the column maximum
+    """
+    shape = temperature.shape[1:]
+    flat = temperature.reshape(temperature.shape[0], -1)
+    size = flat.shape[1]
+    depths = np.asarray(depths, dtype=flat.dtype)[:, None]
+    phi = np.empty(size, dtype=flat.dtype)
+    column_min = np.empty(size, dtype=flat.dtype)
+    column_max = np.empty(size, dtype=flat.dtype)
+    bottom_is_min = np.empty(size, dtype=bool)
+    bottom_is_max = np.empty(size, dtype=bool)
+    values = np.empty((flat.shape[0], min(block_size, size)), dtype=flat.dtype)
+    is_missing = np.empty(values.shape, dtype=bool)
+    for start in range(0, size, block_size):
+        stop = min(start + block_size, size)
+        tile = flat[:, start:stop]
+        tile_values = values[:, :stop-start]
+        tile_missing = is_missing[:, :stop-start]
+        np.isnan(tile, out=tile_missing)
+        count = tile.shape[0] - tile_missing.sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.copyto(tile_values, tile)
+            tile_values[tile_missing] = 0
+            # Divided in place as numpy.nanmean does, keeping the dtype
+            column_mean = np.divide(sum_rows(tile_values), count,
+                                    casting='unsafe', dtype=flat.dtype)
+            np.subtract(tile, column_mean, out=tile_values)
+            tile_values *= depths
+            tile_values[tile_missing] = 0
+            phi[start:stop] = np.divide(sum_rows(tile_values), count,
+                                        casting='unsafe', dtype=flat.dtype)
+        np.fmin.reduce(tile, axis=0, out=column_min[start:stop])
+        np.fmax.reduce(tile, axis=0, out=column_max[start:stop])
+        np.equal(tile[index_bottom_logger], column_min[start:stop],
+                 out=bottom_is_min[start:stop])
+        np.equal(tile[index_bottom_logger], column_max[start:stop],
+                 out=bottom_is_max[start:stop])
+    return phi.reshape(shape), column_min.reshape(shape), \
+        column_max.reshape(shape), bottom_is_min.reshape(shape), \
+        bottom_is_max.reshape(shape)
+
+def sum_rows(values):
+    """
+    Sum over the first axis of a 2d array, adding one row after the other.
+    numpy.sum does so for arrays of several columns, but sums a single
+    column pairwise, which would make the TSI of one time step tiles differ
+    in the last bit.
+    """
+    if values.shape[1] > 1:
+        return values.sum(axis=0)
+    total = values[0].copy()
+    for row in values[1:]:
+        total += row
+    return total
+
+class DetectionFeatures:
+    """
+    Derived arrays shared by every detection stage, computed once from the
+    aligned temperature block. With a (depth, site, time) block, the arrays
+    derived from a single depth have dimensions (site, time).
+
+    Parameters
+    ----------
+    temperature : ndarray
+        Temperature data with dimensions (depth, time), or (depth, site,
+        time) for several sites sharing a time axis
+    depths      : 1darray
+        Depth of each row of temperature, positive down
+    phi         : ndarray
+        Precomputed temperature stratification index. Computed from
+        temperature if None
+    dtype       : numpy dtype
+        Data type of all derived arrays
+    chain       : bool
+        If True, the TSI and the column minimum and maximum are computed in
+        a single pass, see chain_reductions, which is faster, above all
+        with many depths such as thermistor chains. If False, with one
+        reduction over the whole array each. The features are the same.
+
+    Attributes
+    ----------
+    temperature             : ndarray
+        C-contiguous temperature data with dimensions (depth, time) or
+        (depth, site, time)
+    depths                  : 1darray
+        Depth of each row of temperature
+    phi                     : 1darray
+        Temperature stratification index
+    column_min              : 1darray
+        Minimum temperature in the water column, NaN values skipped
+    column_max              : 1darray
+        Maximum temperature in the water column, NaN values skipped
+    bottom_is_min           : 1darray
+        True where the bottom temperature is the column minimum
+    bottom_is_max           : 1darray
+        True where the bottom temperature is the column maximum
+    index_bottom_logger     : int
+        Row of the deepest logger
+    bottom_temperature      : 1darray
+        Temperature of the deepest logger
+    phi_diff                : 1darray
+        First order difference of phi, phi[t+1] - phi[t]
+    bottom_temperature_diff : 1darray
+        First order difference of the bottom temperature
+    """
+    def __init__(self, temperature, depths, phi=None, dtype=np.float64,
+                 chain=True):
+        self.temperature = np.ascontiguousarray(temperature, dtype=dtype)
+        self.depths = np.asarray(depths, dtype=float)
+        self.index_bottom_logger = int(self.depths.argmax())
+        self.bottom_temperature = self.temperature[self.index_bottom_logger]
+        if chain:
+            chain_phi, self.column_min, self.column_max, \
+                self.bottom_is_min, self.bottom_is_max = \
+                chain_reductions(self.temperature, self.depths,
+                                 self.index_bottom_logger)
+            if phi is None:
+                phi = chain_phi
+        else:
+            if phi is None:
+                phi = stratification_index(self.temperature, self.depths)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', category=RuntimeWarning)
+                self.column_min = np.nanmin(self.temperature, axis=0)
+                self.column_max = np.nanmax(self.temperature, axis=0)
+            self.bottom_is_min = self.bottom_temperature == self.column_min
+            self.bottom_is_max = self.bottom_temperature == self.column_max
+        self.phi = np.ascontiguousarray(phi, dtype=dtype)
+        self.phi_diff = np.diff(self.phi)
+        self.bottom_temperature_diff = np.diff(self.bottom_temperature)
+
+    @classmethod
+    def from_darray(cls, darray, phi=None, dtype=np.float64, chain=True):
+        """
+        Computes detection features from a (depth, time) DataArray
+
+        Parameters
+        ----------
+        darray : xarray DataArray
+            Temperature data with dimensions (depth, time), or (depth,
+            site, time) in any order
+        phi    : xarray DataArray or ndarray
+            Precomputed temperature stratification index
+        dtype  : numpy dtype
+            Data type of all derived arrays
+        chain  : bool
+            If True, single pass computation, see DetectionFeatures
+
+        Returns
+        -------
+        features : DetectionFeatures
+            Features of darray
+        """
+        darray = darray.transpose('depth', ..., 'time')
+        return cls(darray.values, darray.depth.values,
+                   phi=None if phi is None else np.asarray(phi),
+                   dtype=dtype, chain=chain)
+
+    @property
+    def size(self):
+        """Number of time steps"""
+        return self.phi.shape[-1]
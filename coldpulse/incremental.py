@@ -0,0 +1,739 @@
+"""
+Incremental detection for stations whose csv files grow over time.
+
+The state of a station is kept next to its outputs: the byte offset read in
+each csv file, its size and a hash of its first bytes, the raw samples needed to interpolate the next time steps,
+the TSI threshold, and the trailing context of the aligned temperature
+data. Pulses ending within the last context_length time steps, or which
+the new data could still change, are provisional: they are written to the
+outputs but detected again, together with the new data, on the next run.
+Csv files which were rewritten rather than appended to are detected again
+from the start.
+"""
+import os
+import io
+import json
+import hashlib
+import numpy as np
+import xarray as xr
+from .inputs import list_station_files, logger_depths, read_logger_csv
+from .threshold import make_tsi_threshold_from_climatology
+from .features import DetectionFeatures
+from .outputs import subpulse_dataframe, pulse_dataframe, series_dataset
+from .writers import station_name
+from .profiling import QUIET
+from . import engine
+
+
+def update_station(input_dir, dir_name=None, context_length=720,
+                   chunk_size=None, read_size=2**24, profiler=QUIET,
+                   threshold='godas'):
+    """
+    Detects pulses in the data appended to the csv files of input_dir since
+    the last run and appends them to the outputs in dir_name
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+    dir_name : String
+        Output directory. '[input_dir]_TSI_out' if None.
+    context_length : int
+        Number of time steps at the end of the record during which pulses
+        are provisional, and kept as context for the next run.
+    chunk_size : int
+        If not None, the new data is read and processed by chunks of 
+        chunk_size time steps, so that memory use does not depend on the
+        amount of new data.
+    read_size : int
+        Chunked mode only, number of bytes read at once in a csv file.
+    profiler : profiling.Profiler
+        Receives the timing of reading and detecting each block.
+    threshold : String or float
+        TSI threshold of a new station, computed from the GODAS climatology
+        on its first run if 'godas'. The threshold of an existing station
+        is kept.
+
+    Returns
+    -------
+    number_new_time_steps : int
+        Number of time steps processed in this run
+
+    """
+    if dir_name is None:
+        dir_name = '%s_TSI_out'%os.path.normpath(input_dir)
+    state = load_state(dir_name, input_dir)
+    if state is not None and not files_appended(input_dir, state):
+        profiler.message('Csv files changed since the last run, detecting '
+                         'pulses again from the start.')
+        state = None
+    if state is None:
+        state = new_state(input_dir)
+        if threshold != 'godas':
+            state['threshold'] = float(threshold)
+        raw_data = [(np.zeros(0, dtype=np.int64), np.zeros(0))
+                    for file in state['files']]
+        context = np.zeros((len(state['files']), 0))
+    else:
+        raw_data, context = load_arrays(dir_name, input_dir, state)
+    number_new_time_steps = 0
+    while True:
+        with profiler.stage('read_block') as record:
+            fill_raw_data(input_dir, state, raw_data, chunk_size, read_size)
+            if state['time_start'] is None:
+                initialize_time_grid(state, raw_data)
+            new_times, new_block, raw_data = \
+                align_new_time_steps(state, raw_data, max_steps=chunk_size)
+            record['items'] = new_times.size
+        if new_times.size == 0:
+            break
+        profiler.message('Detecting pulses from time step %d to %d...'
+                         %(state['size'], state['size'] + new_times.size))
+        with profiler.stage('detect_block') as record:
+            context = process_new_block(input_dir, dir_name, state, context,
+                                        new_times, new_block, context_length)
+            save_state(dir_name, input_dir, state, raw_data, context)
+            record['items'] = new_times.size
+        number_new_time_steps += new_times.size
+        if chunk_size is None:
+            break
+    if number_new_time_steps == 0:
+        profiler.message('No new time step to process.')
+        save_state(dir_name, input_dir, state, raw_data, context)
+    else:
+        profiler.message('%d new time steps processed.'%number_new_time_steps)
+    return number_new_time_steps
+
+def process_new_block(input_dir, dir_name, state, context, new_times,
+                      new_block, context_length):
+    """
+    Detects pulses in a block of new time steps and updates the outputs
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+    dir_name : String
+        Output directory.
+    state : dict
+        State of the station, updated in place.
+    context : numpy 2d array
+        Aligned temperature data from state['context_start'].
+    new_times : numpy 1d array
+        Timestamps of the new time steps.
+    new_block : numpy 2d array
+        Temperature data with dimensions (depth, new time steps).
+    context_length : int
+        Number of time steps at the end of the record during which pulses
+        are provisional.
+
+    Returns
+    -------
+    context : numpy 2d array
+        Context for the next block.
+
+    """
+    depths = np.array(state['depths'])
+    is_first_run = state['size'] == 0
+    if is_first_run:
+        darray = make_darray(new_block, depths, new_times, state)
+    if is_first_run and state['threshold'] is None:
+        state['threshold'] = float(make_tsi_threshold_from_climatology(darray,
+                                                                       input_dir))
+    context_start = state['context_start']
+    previous_size = state['size']
+    previous_boundary = state['boundary']
+    previous_subpulse_rows = state['subpulse_rows']
+    dt = state['time_step']/3600
+    subpulse_table, is_committed, series, context = \
+        detect_new_block(state, context, new_block, context_length)
+
+    dataframe_subpulses = subpulse_dataframe(subpulse_table,
+                                             index=np.arange(is_committed.size)
+                                                  + previous_subpulse_rows)
+    window_times = grid_times(state, context_start, state['size'])
+    dataframe_pulses = pulse_dataframe(dataframe_subpulses, window_times, dt,
+                                       offset=context_start)
+    is_pulse_committed = dataframe_pulses.start_pulse.values < state['boundary']
+    state['committed_bytes']['pulse'] = \
+        write_rows('%s/%s_pulse_stats_.csv'%(dir_name, station_name(input_dir)),
+                   dataframe_pulses, is_pulse_committed,
+                   state['committed_bytes']['pulse'])
+    state['committed_bytes']['subpulse'] = \
+        write_rows('%s/%s_subpulse_stats_.csv'%(dir_name, station_name(input_dir)),
+                   dataframe_subpulses, is_committed,
+                   state['committed_bytes']['subpulse'])
+    series_path = '%s/%s_pulse_series_.nc'%(dir_name, station_name(input_dir))
+    if is_first_run:
+        series_dataset(darray, series).to_netcdf(series_path,
+                                                 unlimited_dims=['time'],
+                                                 encoding=TIME_ENCODING)
+    else:
+        append_series(series_path, new_times, new_block, series,
+                      previous_size, previous_boundary, context_start)
+    return context
+
+def detect_new_block(state, context, new_block, context_length, final=False,
+                     sparse=False):
+    """
+    Detects pulses in a block of new time steps preceded by the trailing
+    context of the previous blocks
+
+    Pulses starting before state['boundary'] were committed with the 
+    previous blocks and are dropped. Pulses ending in the last context_length
+    time steps, or which new data could still change, are provisional: the
+    new boundary is set before the first one, see commit_boundary, and they
+    are detected again with the next block. The committed pulses are
+    therefore those of a single run over the whole record whatever
+    context_length, but the context grows for as long as pulses stay open,
+    e.g. when the record ends with a long pulse.
+
+    Parameters
+    ----------
+    state : dict
+        Detection state with 'threshold', 'time_step' (s), 'size', 
+        'context_start', 'boundary', 'next_pulse_id' and 'subpulse_rows'
+        keys, updated in place.
+    context : numpy 2d array
+        Aligned temperature data from state['context_start'].
+    new_block : numpy 2d array
+        Temperature data with dimensions (depth, new time steps).
+    context_length : int
+        Number of time steps at the end of the record during which pulses
+        are provisional, at least 1.
+    final : bool
+        If True, the block is the last one and all pulses are committed.
+    sparse : bool
+        If True, series only hold the time steps of the subpulses, see
+        engine.compute_subpulse_metrics.
+
+    Returns
+    -------
+    subpulse_table : dict of numpy 1d arrays
+        Subpulses starting after the previous boundary, with indexes in the
+        whole record.
+    is_committed : numpy 1d array
+        True for subpulses of pulses starting before the new boundary.
+    series : dict of numpy 1d arrays
+        Instantaneous series of these subpulses, over the window starting at
+        the previous state['context_start'] or sparse.
+    context : numpy 2d array
+        Context for the next block.
+
+    """
+    assert context_length >= 1,\
+        "context_length must be at least 1, not %d."%context_length
+    window = np.concatenate([context, new_block], axis=1)
+    context_start = state['context_start']
+    previous_boundary = state['boundary']
+    size = state['size'] + new_block.shape[1]
+    features = DetectionFeatures(window, state['depths'])
+    # Same stages as engine.detect_pulses
+    start_breakpoints = engine.start_breakpoints(features,
+                                                 **engine.DEFAULT_START_FLAGS)
+    list_starts, list_ends = engine.potential_pulses(features, state['threshold'])
+    shifted_starts = engine.snap_to_breakpoints(list_starts, start_breakpoints,
+                                                direction='backward')
+    if context_start > 0:
+        # Breakpoints are incomplete on the first two time steps of the
+        # window. Potential pulses shifted back there start before the
+        # previous boundary and were settled by earlier blocks.
+        is_settled = shifted_starts < 2
+        list_ends = list_ends[~is_settled]
+        shifted_starts = shifted_starts[~is_settled]
+    starts, ends = engine.remove_if_not_from_bottom_logger(features,
+                                                           shifted_starts,
+                                                           list_ends)
+    ends = engine.shift_ends(features, ends, **engine.DEFAULT_END_FLAGS)
+    subpulses = engine.split_pulses(features.bottom_temperature, starts, ends)
+    # Pulses starting before the boundary were committed by earlier blocks
+    is_kept = subpulses[1] + context_start >= previous_boundary
+    pulse_id, start_pulse, end_pulse, start_subpulse, end_subpulse = \
+        [column[is_kept] for column in subpulses]
+    metrics, series = engine.compute_subpulse_metrics(features.bottom_temperature,
+                                                      start_pulse,
+                                                      start_subpulse,
+                                                      end_subpulse,
+                                                      state['time_step']/3600,
+                                                      sparse=sparse)
+    pulse_id = np.unique(pulse_id, return_inverse=True)[1].reshape(-1) \
+             + state['next_pulse_id']
+    subpulse_table = dict(zip(engine.SUBPULSE_COLUMNS + engine.METRIC_COLUMNS,
+                              [pulse_id,
+                               start_pulse + context_start,
+                               end_pulse + context_start,
+                               start_subpulse + context_start,
+                               end_subpulse + context_start] + list(metrics)))
+
+    if final:
+        boundary = size
+    else:
+        # Whether potential pulses reaching the end of the window pass the
+        # bottom logger filter depends on the next blocks
+        is_open = list_ends >= window.shape[1] - 1
+        boundary = commit_boundary(start_breakpoints,
+                                   np.concatenate([starts, shifted_starts[is_open]]),
+                                   np.concatenate([ends, list_ends[is_open]]),
+                                   context_start, size, context_length,
+                                   previous_boundary)
+    is_committed = subpulse_table['start_pulse'] < boundary
+
+    state['next_pulse_id'] += np.unique(pulse_id[is_committed]).size
+    state['subpulse_rows'] += int(is_committed.sum())
+    state['size'] = size
+    state['boundary'] = int(boundary)
+    state['context_start'] = int(max(boundary - context_length, 0))
+    context = window[:, state['context_start'] - context_start:]
+    return subpulse_table, is_committed, \
+        dict(zip(engine.SERIES_NAMES, series)), context
+
+def commit_boundary(start_breakpoints, starts, ends, context_start, size,
+                    context_length, previous_boundary):
+    """
+    First time step of the record after which pulses stay provisional, so
+    that the committed pulses are those of a single run over the whole
+    record
+
+    Pulses are merged with the pulses overlapping the time step before
+    their start, so the boundary never falls within a pulse, from the time
+    step before its start to its end. The last two time steps of a window
+    are not known to be breakpoints, so pulses ending there may end later.
+    Pulses of later blocks are shifted back to a start breakpoint, at the
+    latest the last one of the window, and the boundary stays before it.
+
+    Parameters
+    ----------
+    start_breakpoints : numpy 1d array
+        Start breakpoints of the window, see engine.start_breakpoints.
+    starts : numpy 1d array
+        Shifted starts of the pulses of the window, and of the potential
+        pulses which may still pass the bottom logger filter.
+    ends : numpy 1d array
+        Shifted ends of these pulses.
+    context_start : int
+        Index of the first time step of the window in the record.
+    size : int
+        Number of time steps of the record, up to the end of the window.
+    context_length : int
+        Number of time steps at the end of the record during which pulses
+        are provisional.
+    previous_boundary : int
+        Boundary of the previous block.
+
+    Returns
+    -------
+    boundary : int
+        Index of the first time step of the provisional pulses.
+
+    """
+    window_size = size - context_start
+    if context_start > 0:
+        start_breakpoints = start_breakpoints[start_breakpoints >= 2]
+    if start_breakpoints.size:
+        last_breakpoint = start_breakpoints[-1] + context_start
+    else:
+        last_breakpoint = previous_boundary + 1
+    boundary = min(size - context_length, last_breakpoint - 1)
+    interval_starts = np.asarray(starts, dtype=int) - 1 + context_start
+    interval_ends = np.where(np.asarray(ends) >= window_size - 2, size,
+                             np.asarray(ends, dtype=int) + context_start)
+    order = np.argsort(interval_starts, kind='stable')
+    interval_starts = interval_starts[order]
+    running_ends = np.maximum.accumulate(interval_ends[order])
+    number_before = np.searchsorted(interval_starts, boundary, side='left')
+    if number_before and running_ends[number_before - 1] >= boundary:
+        # Start of the union of overlapping pulses holding the boundary
+        is_first = np.ones(number_before, dtype=bool)
+        is_first[1:] = interval_starts[1:number_before] \
+                     > running_ends[:number_before - 1]
+        boundary = interval_starts[np.flatnonzero(is_first)[-1]]
+    return int(max(boundary, previous_boundary))
+
+# =============================================================================
+# State
+# =============================================================================
+
+TIME_ENCODING = dict(time=dict(units='seconds since 1970-01-01',
+                               dtype='int64'))
+# Number of leading bytes of each csv file hashed in the state
+HEAD_BYTES = 4096
+
+def new_state(input_dir):
+    """
+    Creates the state of a station that was never processed
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+
+    Returns
+    -------
+    state : dict
+        State of the station
+
+    """
+    list_csv_files, depths_dict, (location_id, longitude, latitude) = \
+        list_station_files(input_dir)
+    return dict(files = list_csv_files,
+                depths = logger_depths(list_csv_files, depths_dict),
+                location_id = location_id,
+                longitude = longitude,
+                latitude = latitude,
+                offsets = {file: 0 for file in list_csv_files},
+                sizes = {file: 0 for file in list_csv_files},
+                heads = {file: [0, head_hash(None, 0)] for file in list_csv_files},
+                threshold = None,
+                time_start = None,
+                time_step = None,
+                size = 0,
+                context_start = 0,
+                boundary = 0,
+                next_pulse_id = 0,
+                subpulse_rows = 0,
+                committed_bytes = dict(pulse=0, subpulse=0))
+
+def head_hash(path, length):
+    """
+    SHA-1 hex digest of the first length bytes of a file, of no bytes if
+    path is None
+    """
+    if path is None:
+        return hashlib.sha1().hexdigest()
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read(length)).hexdigest()
+
+def files_appended(input_dir, state):
+    """
+    Checks that the csv files of a station were only appended to since the
+    last run, so that the rows after the offsets of the state are the new
+    ones
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+    state : dict
+        State of the station
+
+    Returns
+    -------
+    is_appended : bool
+        False if the csv files are not those of the state, or if one of them
+        is shorter than when it was last read or its first bytes changed.
+
+    """
+    if 'heads' not in state \
+            or list_station_files(input_dir)[0] != state['files']:
+        return False
+    for file in state['files']:
+        path = '%s/%s'%(input_dir, file)
+        length, digest = state['heads'][file]
+        if os.path.getsize(path) < state['sizes'][file] \
+                or head_hash(path, length) != digest:
+            return False
+    return True
+
+def state_paths(dir_name, input_dir):
+    """
+    Paths of the files holding the state of a station
+
+    Parameters
+    ----------
+    dir_name : String
+        Output directory.
+    input_dir : String
+        Path of the input directory.
+
+    Returns
+    -------
+    json_path : String
+        Path of the json file with scalar values.
+    npz_path : String
+        Path of the npz file with arrays.
+
+    """
+    name = station_name(input_dir)
+    return '%s/%s_state_.json'%(dir_name, name), \
+           '%s/%s_state_.npz'%(dir_name, name)
+
+def load_state(dir_name, input_dir):
+    """
+    Loads the state of a station, None if it was never processed
+    incrementally.
+    """
+    json_path, npz_path = state_paths(dir_name, input_dir)
+    if not os.path.exists(json_path):
+        return None
+    with open(json_path) as file:
+        return json.load(file)
+
+def load_arrays(dir_name, input_dir, state):
+    """
+    Loads raw samples and context of a station
+
+    Returns
+    -------
+    raw_data : list of tuples
+        Times (int64 ns) and values of the raw samples still needed for
+        interpolation, for each csv file.
+    context : numpy 2d array
+        Aligned temperature data from state['context_start'].
+
+    """
+    json_path, npz_path = state_paths(dir_name, input_dir)
+    with np.load(npz_path) as arrays:
+        raw_data = [(arrays['raw_time_%d'%index], arrays['raw_value_%d'%index])
+                    for index in range(len(state['files']))]
+        context = arrays['context']
+    return raw_data, context
+
+def save_state(dir_name, input_dir, state, raw_data, context):
+    """
+    Saves the state of a station. The json file is written last, so that an
+    interrupted run leaves the previous state usable.
+    """
+    json_path, npz_path = state_paths(dir_name, input_dir)
+    arrays = dict(context=context)
+    for index, (times, values) in enumerate(raw_data):
+        arrays['raw_time_%d'%index] = times
+        arrays['raw_value_%d'%index] = values
+    with open(npz_path + '.tmp', 'wb') as file:
+        np.savez(file, **arrays)
+    os.replace(npz_path + '.tmp', npz_path)
+    with open(json_path + '.tmp', 'w') as file:
+        json.dump(state, file, indent=1)
+    os.replace(json_path + '.tmp', json_path)
+
+# =============================================================================
+# Reading and alignment
+# =============================================================================
+
+def read_new_rows(path, offset, max_bytes=None):
+    """
+    Reads the complete rows of a csv file written after a byte offset
+
+    Parameters
+    ----------
+    path : String
+        Path of the csv file, with time and temperature in its first two
+        columns and a header line.
+    offset : int
+        Byte offset of the first row to read, 0 to read the whole file.
+    max_bytes : int
+        Approximate number of bytes to read. All remaining rows if None.
+
+    Returns
+    -------
+    times : numpy 1d array
+        Timestamps as int64 nanoseconds.
+    values : numpy 1d array
+        Temperature values.
+    new_offset : int
+        Byte offset following the last complete row read.
+
+    """
+    with open(path, 'rb') as file:
+        file.seek(offset)
+        if max_bytes is None:
+            data = file.read()
+        else:
+            data = file.read(max_bytes) + file.readline()
+    length = data.rfind(b'\n') + 1
+    empty = np.zeros(0, dtype=np.int64), np.zeros(0), offset
+    if length == 0:
+        return empty
+    times, values = read_logger_csv(io.BytesIO(data[:length]),
+                                    header=0 if offset == 0 else None)
+    return times.view(np.int64), values, offset + length
+
+def merge_raw_samples(old_samples, new_samples):
+    """
+    Merges raw samples, sorted by time, keeping the first sample of each
+    timestamp.
+    """
+    times = np.concatenate([old_samples[0], new_samples[0]])
+    values = np.concatenate([old_samples[1], new_samples[1]])
+    order = np.argsort(times, kind='stable')
+    times, first_index = np.unique(times[order], return_index=True)
+    return times, values[order][first_index]
+
+def fill_raw_data(input_dir, state, raw_data, chunk_size=None,
+                  read_size=2**24):
+    """
+    Reads new rows of all csv files into the raw samples of each file
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+    state : dict
+        State of the station, offsets, sizes and heads are updated in
+        place.
+    raw_data : list of tuples
+        Times and values of the raw samples of each file, updated in place.
+    chunk_size : int
+        If None, all new rows are read. Otherwise files are read by blocks of
+        read_size bytes until they cover the next chunk_size time steps.
+    read_size : int
+        Number of bytes read at once in chunked mode.
+
+    Returns
+    -------
+    None.
+
+    """
+    for index, file in enumerate(state['files']):
+        path = '%s/%s'%(input_dir, file)
+        while True:
+            times, values, new_offset = \
+                read_new_rows(path, state['offsets'][file],
+                              None if chunk_size is None else read_size)
+            state['offsets'][file] = new_offset
+            raw_data[index] = merge_raw_samples(raw_data[index],
+                                                (times, values))
+            if chunk_size is None or times.size == 0:
+                break
+            if state['time_start'] is not None:
+                target_time = state['time_start'] \
+                    + (state['size'] + chunk_size)*state['time_step']*10**9
+                if raw_data[index][0][-1] >= target_time:
+                    break
+            elif raw_data[index][0].size > 1:
+                break
+        state['sizes'][file] = os.path.getsize(path)
+        if state['heads'][file][0] < HEAD_BYTES:
+            # Only rows read are hashed, the last line can be incomplete
+            length = min(state['offsets'][file], HEAD_BYTES)
+            state['heads'][file] = [length, head_hash(path, length)]
+
+def initialize_time_grid(state, raw_data):
+    """
+    Sets the start and time step of the common time grid, as prepare_darray
+    does: latest start and coarsest time interval of all files.
+    """
+    assert all(times.size > 1 for times, values in raw_data),\
+        "At least two rows are required in each csv file."
+    state['time_start'] = int(max(times[0] for times, values in raw_data))
+    state['time_step'] = int(max((times[1] - times[0])//10**9
+                                 for times, values in raw_data))
+
+def grid_times(state, start, stop):
+    """
+    Timestamps of the time steps start to stop (excluded) of the time grid
+    """
+    return np.datetime64(state['time_start'], 'ns') \
+         + np.arange(start, stop)*np.timedelta64(state['time_step'], 's')
+
+def align_new_time_steps(state, raw_data, max_steps=None):
+    """
+    Interpolates raw samples on the time steps of the grid that follow the
+    last processed one and are covered by all files
+
+    Parameters
+    ----------
+    state : dict
+        State of the station.
+    raw_data : list of tuples
+        Times and values of the raw samples of each file.
+    max_steps : int
+        Maximum number of time steps to align. No maximum if None.
+
+    Returns
+    -------
+    new_times : numpy 1d array
+        Timestamps of the new time steps.
+    new_block : numpy 2d array
+        Temperature data with dimensions (depth, new time steps).
+    raw_data : list of tuples
+        Raw samples still needed to interpolate the next time steps.
+
+    """
+    step = state['time_step']*10**9
+    end_time = min(times[-1] if times.size else state['time_start'] - 1
+                   for times, values in raw_data)
+    stop = max((end_time - state['time_start'])//step + 1, state['size'])
+    if max_steps is not None:
+        stop = min(stop, state['size'] + max_steps)
+    new_index = np.arange(state['size'], stop)
+    new_times_ns = state['time_start'] + new_index*step
+    new_block = np.empty((len(raw_data), new_index.size))
+    trimmed_raw_data = []
+    for row, (times, values) in enumerate(raw_data):
+        new_block[row] = np.interp(new_times_ns - state['time_start'],
+                                   times - state['time_start'],
+                                   values)
+        if new_index.size:
+            last_time = new_times_ns[-1]
+            first_needed = max(np.searchsorted(times, last_time, 'right') - 1, 0)
+        else:
+            first_needed = 0
+        trimmed_raw_data.append((times[first_needed:], values[first_needed:]))
+    return grid_times(state, state['size'], stop), new_block, trimmed_raw_data
+
+def make_darray(block, depths, times, state):
+    """
+    Makes a DataArray of aligned temperature data, as prepare_darray does
+    """
+    darray = xr.DataArray(block,
+                          dims = ['depth', 'time'],
+                          coords = dict(depth=depths, time=times),
+                          name = 'temperature')
+    darray['locationID'] = state['location_id']
+    darray['longitude'] = state['longitude']
+    darray['latitude'] = state['latitude']
+    return darray
+
+# =============================================================================
+# Outputs
+# =============================================================================
+
+def write_rows(path, dataframe, is_committed, committed_bytes):
+    """
+    Replaces the provisional rows of a csv output by the rows of dataframe
+
+    Parameters
+    ----------
+    path : String
+        Path of the csv file.
+    dataframe : pandas DataFrame
+        Rows to write, committed ones first.
+    is_committed : numpy 1d array
+        True for rows that will not change in later runs.
+    committed_bytes : int
+        Size of the committed part of the csv file, 0 for a new file.
+
+    Returns
+    -------
+    committed_bytes : int
+        Size of the committed part of the csv file after writing.
+
+    """
+    with open(path, 'a+', newline='') as file:
+        file.truncate(committed_bytes)
+        file.seek(committed_bytes)
+        dataframe[is_committed].to_csv(file, header=committed_bytes == 0)
+        file.flush()
+        committed_bytes = file.tell()
+        dataframe[~is_committed].to_csv(file, header=False)
+    return committed_bytes
+
+def append_series(path, new_times, new_block, series, previous_size,
+                  previous_boundary, context_start):
+    """
+    Appends new time steps to the series NetCDF file and rewrites the
+    series of the provisional part of the record
+    """
+    import netCDF4
+    seconds = (new_times - np.datetime64(0, 's')) // np.timedelta64(1, 's')
+    size = previous_size + new_times.size
+    with netCDF4.Dataset(path, 'a') as dataset:
+        dataset['time'][previous_size:size] = seconds
+        temperature = dataset['temperature']
+        if temperature.dimensions[0] == 'time':
+            temperature[previous_size:size, :] = new_block.T
+        else:
+            temperature[:, previous_size:size] = new_block
+        for name in engine.SERIES_NAMES:
+            dataset[name][previous_boundary:size] = \
+                series[name][previous_boundary - context_start:]
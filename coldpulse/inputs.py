@@ -1,8 +1,28 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import xarray as xr
 import pandas as pd
+from . import cache
+from . import alignment
+from .profiling import QUIET
 
-def prepare_darray(input_dir):
+# Timestamp formats tried, in this order, when none is given
+TIME_FORMATS = ['%Y-%m-%d %H:%M:%S',
+                '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M',
+                '%Y-%m-%dT%H:%M',
+                '%Y/%m/%d %H:%M:%S',
+                '%Y/%m/%d %H:%M',
+                '%m/%d/%Y %H:%M:%S',
+                '%m/%d/%Y %H:%M',
+                '%d/%m/%Y %H:%M:%S',
+                '%d/%m/%Y %H:%M',
+                '%Y-%m-%d %H:%M:%S.%f',
+                '%Y-%m-%dT%H:%M:%S.%f']
+
+def prepare_darray(input_dir, time_format=None, use_cache=True, workers=None,
+                   strategy='interp', profiler=QUIET):
     """
     Prepares darray from several csv files in the directory input_dir
 
@@ -10,12 +30,81 @@ def prepare_darray(input_dir):
     ----------
     input_dir : String
        Path of the input directory which contains csv files
+    time_format : String
+        strftime format of the timestamps. Detected from the files if
+        None.
+    use_cache : bool
+        If True, parsed files are kept in a binary cache and read from it
+        while the csv files are not modified.
+    workers : int
+        Number of files loaded concurrently. One per file if None.
+    strategy : String
+        How the loggers are resampled on the common time grid, 'interp' or
+        'mean', see alignment.align_samples.
+    profiler : profiling.Profiler
+        Receives the timing of reading and aligning the files, and the
+        progress of reading.
 
     Returns
     -------
     complete_dataarray : xarray DataArray
         Temperature data in a DataArray
 
+    """
+    list_csv_files, depths_dict, (location_id, longitude, latitude) = \
+        list_station_files(input_dir)
+    
+    with profiler.stage('read_files') as record:
+        with ThreadPoolExecutor(max_workers=workers or len(list_csv_files)) as executor:
+            samples = []
+            for times, values in executor.map(
+                    lambda file: read_logger_file('%s/%s'%(input_dir, file),
+                                                  time_format=time_format,
+                                                  use_cache=use_cache),
+                    list_csv_files):
+                samples.append((times, values))
+                profiler.progress('read_files', len(samples), len(list_csv_files))
+        record['items'] = sum([times.size for times, values in samples])
+    with profiler.stage('align') as record:
+        samples = [alignment.dedupe_samples(times, values) 
+                   for times, values in samples]
+        time_grid = alignment.common_time_grid(samples)
+        temperature = alignment.align_samples(samples, time_grid, strategy=strategy)
+        record['items'] = time_grid.size
+    depths = logger_depths(list_csv_files, depths_dict)
+    complete_dataarray = xr.DataArray(temperature,
+                                      dims = ['depth', 'time'],
+                                      coords = dict(depth=depths,
+                                                    time=time_grid.view('datetime64[ns]')),
+                                      name = 'temperature')
+    complete_dataarray['locationID'] = location_id
+    complete_dataarray['longitude'] = longitude
+    complete_dataarray['latitude'] = latitude
+    
+    return complete_dataarray
+
+# =============================================================================
+# Side input functions    
+# =============================================================================
+
+def list_station_files(input_dir):
+    """
+    Lists csv files of the directory input_dir and parses their names
+
+    Parameters
+    ----------
+    input_dir : String
+       Path of the input directory which contains csv files
+
+    Returns
+    -------
+    list_csv_files : list of String
+        Names of the csv files
+    depths_dict : dict
+        Depth of each csv file, positive down
+    location : tuple
+        Location ID, longitude and latitude of the station
+
     """
     # Name format: locationID_lon_lat_depth_.csv
     # The depths should be in m positive down.
@@ -37,55 +126,17 @@ def prepare_darray(input_dir):
                 \n Don't forget the underscore before .csv."%file
         location_id, longitude, latitude, depth, format = file_metadata
         depths_dict[file] = float(depth)
-    
-    dataarray_data_list = []
-    print('Loading files...')
-    for file in list_csv_files:
-        dataarray_data_list.append(csv_to_darray(input_dir,
-                                                 file,
-                                                 depths_dict[file]))
-        print("  "+u"\u21B3" + "  %s loaded."%file)
-    potential_starts = []
-    potential_ends = []
-    potential_time_intervals = []
-    sorted_dataarray_list = []
-    for dataarray in dataarray_data_list:
-        no_duplicate_dataarray = dataarray.groupby('time').first()
-        sorted_dataarray = no_duplicate_dataarray.sortby('time', ascending=True)
-        sorted_dataarray_list.append(sorted_dataarray)
-        start_time = sorted_dataarray.time.values[0]
-        end_time = sorted_dataarray.time.values[-1]
-        time_interval_raw = sorted_dataarray.time.diff('time').values[0]
-        time_interval = time_interval_raw.astype('timedelta64[s]').astype(int)
-        potential_starts.append(start_time)
-        potential_ends.append(end_time)
-        potential_time_intervals.append(time_interval)
-
-    total_start_time = max(potential_starts)
-    total_end_time = min(potential_ends)
-    total_time_interval = max(potential_time_intervals)
-    time_array =pd.date_range(start=total_start_time,
-                              end=total_end_time,
-                              freq='%ss'%total_time_interval)
-    interpolated_dataarray_list = []
-    for dataarray in sorted_dataarray_list:
-        interpolated_dataarray = dataarray.interp(time=time_array)
-        interpolated_dataarray_list.append(interpolated_dataarray)
-    complete_dataarray = xr.concat(interpolated_dataarray_list,
-                                   dim = 'depth')
-    complete_dataarray['locationID'] = location_id
-    latitude = float(latitude)
-    longitude = float(longitude)
-    complete_dataarray['longitude'] = longitude
-    complete_dataarray['latitude'] = latitude
-    
-    return complete_dataarray
+    return list_csv_files, depths_dict, \
+        (location_id, float(longitude), float(latitude))
 
-# =============================================================================
-# Side input functions    
-# =============================================================================
+def logger_depths(list_csv_files, depths_dict):
+    """
+    Depth of each csv file used by the detection, loggers shallower than 5 m
+    being counted at 5 m
+    """
+    return [max(depths_dict[file], 5.) for file in list_csv_files]
 
-def csv_to_darray(input_dir, file_name, depth):
+def csv_to_darray(input_dir, file_name, depth, time_format=None, use_cache=True):
     """
     Imports a csv file and make a dataarray out of it
 
@@ -97,6 +148,10 @@ def csv_to_darray(input_dir, file_name, depth):
         Name of the csv file.
     depth : float
         Depth corresponding to the csv file, positive down.
+    time_format : String
+        strftime format of the timestamps. Detected if None.
+    use_cache : bool
+        If True, the parsed file is read from or saved to the binary cache.
 
     Returns
     -------
@@ -104,19 +159,119 @@ def csv_to_darray(input_dir, file_name, depth):
         Temperature data
 
     """
-    time_column = 0
-    temp_column = 1
-    df = pd.read_csv('%s/%s'%(input_dir,file_name))
-    time_col = df.columns[time_column]
-    temp_col = df.columns[temp_column]
-    time = pd.DatetimeIndex(df[time_col])
-    temp = df[temp_col].astype(float)
-    temp.index = time
+    times, values = read_logger_file('%s/%s'%(input_dir,file_name),
+                                     time_format=time_format,
+                                     use_cache=use_cache)
+    temp = pd.Series(values, index=pd.DatetimeIndex(times), name='temperature')
     temp.index.name='time'
-    temp = temp.rename('temperature')
     darray = xr.DataArray(temp)
     if depth<5:
         depth=5
     darray['depth'] = depth
     return darray
-   
+
+def read_logger_file(path, time_format=None, use_cache=True):
+    """
+    Reads the time and temperature columns of a logger csv file, from the
+    binary cache if it holds this version of the file
+
+    Parameters
+    ----------
+    path : String
+        Path of the csv file, with time and temperature in its first two
+        columns and a header line.
+    time_format : String
+        strftime format of the timestamps. Detected if None.
+    use_cache : bool
+        If True, the parsed file is read from or saved to the binary cache,
+        keyed by the path, size and modification time of the file.
+
+    Returns
+    -------
+    times : numpy 1d array
+        Timestamps as datetime64[ns].
+    values : numpy 1d array
+        Temperature values.
+
+    """
+    if not use_cache:
+        return read_logger_csv(path, time_format=time_format)
+    columns = cache.load_csv_copy(path)
+    if columns is not None:
+        return columns
+    times, values = read_logger_csv(path, time_format=time_format)
+    cache.store_csv_copy(path, times, values)
+    return times, values
+
+def read_logger_csv(path_or_buffer, time_format=None, header=0):
+    """
+    Parses the time and temperature columns of a logger csv file
+
+    Parameters
+    ----------
+    path_or_buffer : String or file object
+        csv data with time and temperature in its first two columns.
+    time_format : String
+        strftime format of the timestamps. Detected if None.
+    header : int
+        Row of the header line, None if there is none.
+
+    Returns
+    -------
+    times : numpy 1d array
+        Timestamps as datetime64[ns].
+    values : numpy 1d array
+        Temperature values.
+
+    """
+    df = pd.read_csv(path_or_buffer, 
+                     header=header,
+                     usecols=[0, 1],
+                     dtype={0: str, 1: np.float64})
+    times = parse_times(df[df.columns[0]].values, time_format=time_format)
+    return times, df[df.columns[1]].values
+
+def parse_times(strings, time_format=None):
+    """
+    Parses timestamps with a single format
+
+    Parameters
+    ----------
+    strings : numpy 1d array
+        Timestamps as strings.
+    time_format : String
+        strftime format of the timestamps. If None, the first format of 
+        TIME_FORMATS matching rows sampled through the file is used, and 
+        pandas infers the format if none does. If some timestamps do not
+        have this format, each timestamp is parsed on its own, as pandas
+        parses mixed formats. Ambiguous dates are read month first, as
+        pandas does.
+
+    Returns
+    -------
+    times : numpy 1d array
+        Timestamps as datetime64[ns].
+
+    """
+    if time_format is not None:
+        return pd.to_datetime(strings, format=time_format).as_unit('ns').values
+    time_format = detect_time_format(strings[::max(strings.size//1000, 1)])
+    try:
+        times = pd.to_datetime(strings, format=time_format)
+    except ValueError:
+        # Mixed or irregular formats, slower
+        times = pd.to_datetime(strings, format='mixed')
+    return times.as_unit('ns').values
+
+def detect_time_format(strings):
+    """
+    Finds the first format of TIME_FORMATS that parses all strings, None if
+    there is none
+    """
+    for time_format in TIME_FORMATS:
+        try:
+            pd.to_datetime(strings, format=time_format)
+            return time_format
+        except ValueError:
+            pass
+    return None
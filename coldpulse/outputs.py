@@ -1,11 +1,16 @@
-import sys
 import numpy as np
 import xarray as xr
 import pandas as pd
-from scipy.signal import argrelmax
 from .detection import pulses_detection
+from .features import DetectionFeatures
+from .profiling import QUIET
+from . import engine
 
-def get_output(darray, input_dir):
+# Scalar coordinates of the station set by inputs.prepare_darray
+LOCATION_NAMES = ['locationID', 'longitude', 'latitude']
+
+def get_output(darray, input_dir, low_memory=False, profiler=QUIET,
+               threshold='godas'):
     """
     Generates output from te TSI method
 
@@ -13,23 +18,39 @@ def get_output(darray, input_dir):
     ----------
     darray : xarray DataArray
         Temperrature input data.
-    lon : Float
-        Longitude of the location studied.
-    lat : Float
-        Latitude of the location studied
-    manual_threshold : Float
-        manual TSI threshold that can be computed from local climatology
+    input_dir : String
+        Path of the input directory, referenced by the sparse Dataset. None
+        for data which was not read from csv files.
+    low_memory : bool
+        If True, the output Dataset is sparse, see sparse_series_dataset.
+    profiler : profiling.Profiler
+        Receives the timing of each stage. Its report() gives the profile
+        of the run once the outputs are returned.
+    threshold : String, float or numpy 1d array
+        TSI threshold or how it is computed, see detection.pulses_detection.
+
     Returns
     -------
-    df_output : pandas DataFrame
-        DataFrame containing information about individual pulses.
+    df_output_sub : pandas DataFrame
+        DataFrame containing information about individual subpulses.
     ds_output : xarrray Dataset
         Dataset including drops and degree cooling hours data.
-
+    df_output : pandas DataFrame
+        DataFrame containing information about individual pulses.
 
     """
-    list_starts, list_ends = pulses_detection(darray, input_dir)
-    df_output_sub, ds_output,df_output = prepare_output(darray, list_starts, list_ends) 
+    with profiler.stage('features') as record:
+        features = DetectionFeatures.from_darray(darray)
+        record['items'] = features.phi.size
+    list_starts, list_ends = pulses_detection(darray, input_dir,
+                                              features=features,
+                                              profiler=profiler,
+                                              threshold=threshold)
+    df_output_sub, ds_output,df_output = prepare_output(darray, list_starts, list_ends,
+                                                        features=features,
+                                                        low_memory=low_memory,
+                                                        source=input_dir,
+                                                        profiler=profiler) 
     return df_output_sub, ds_output, df_output
     
 def save_output(df_subpulse, df_pulse, ds_output, file_name, dir_name = None):
@@ -63,7 +84,8 @@ def save_output(df_subpulse, df_pulse, ds_output, file_name, dir_name = None):
 # Output side functions
 # =============================================================================
 
-def prepare_output(darray, list_starts, list_ends):
+def prepare_output(darray, list_starts, list_ends, features=None,
+                   low_memory=False, source=None, profiler=QUIET):
     """
     Computes degree cooling hours and temperature drops for cold-pulses detected
 
@@ -75,6 +97,15 @@ def prepare_output(darray, list_starts, list_ends):
         Array containing start indexes of found pulses.
     list_ends : numpy 1d array
         Array containing start indexes of found pulses.
+    features : DetectionFeatures
+        Precomputed features of darray.
+    low_memory : bool
+        If True, ds is sparse and does not include the temperature data,
+        see sparse_series_dataset.
+    source : String
+        Input directory of darray, referenced by the sparse Dataset.
+    profiler : profiling.Profiler
+        Receives the timing of each stage.
 
     Returns
     -------
@@ -82,72 +113,70 @@ def prepare_output(darray, list_starts, list_ends):
         DataFrame including all pulses and subpulses.
     ds : xarrray Dataset
         Dataset including drops and degree cooling hours data.
+    dataframe_pulse : pandas DataFrame
+        DataFrame containing information about individual pulses.
 
     """
+    if features is None:
+        features = DetectionFeatures.from_darray(darray)
     bottom_temperature = darray.sel(depth=darray.depth.max())
-    dataframe_starts_ends_subpulses = split_pulses(bottom_temperature, 
-                                                   list_starts,
-                                                   list_ends)
     dt = bottom_temperature.time.diff('time').values[0].astype('timedelta64[s]').astype(int)/3600
-    list_dch = []
-    list_drops = []
-    list_min_temp = []
-    dch_series = np.nan*np.zeros(bottom_temperature.size)
-    drops_series = np.nan*np.zeros(bottom_temperature.size)
-    min_temp_series = np.nan*np.zeros(bottom_temperature.size)
-    temp_series = np.nan*np.zeros(bottom_temperature.size)
-    sys.stdout.write("\r+'                                                   ")
-    for index in range(dataframe_starts_ends_subpulses.shape[0]):
-        progress = index/dataframe_starts_ends_subpulses.shape[0]*100
-        sys.stdout.write('\r' + 'Computing DCH: %.02f'%progress + r'%')
-        pulse_id, start_pulse, end_pulse, start_subpulse, end_subpulse = \
-            dataframe_starts_ends_subpulses.iloc[index]
-        dch = -(bottom_temperature[start_subpulse:end_subpulse] - bottom_temperature[start_pulse])*dt
-        drop = (bottom_temperature[start_subpulse:end_subpulse] - bottom_temperature[start_pulse]).min('time').values
-        min_temp = bottom_temperature[start_subpulse:end_subpulse].min('time').values
-        list_dch.append(dch.sum().values)
-        list_drops.append(drop)
-        list_min_temp.append(bottom_temperature[start_subpulse:end_subpulse].min('time').values)
-        dch_series[start_subpulse:end_subpulse] = dch
-        drops_series[start_subpulse:end_subpulse] = drop
-        min_temp_series[start_subpulse:end_subpulse] = min_temp
-        temp_series[start_subpulse:end_subpulse] = bottom_temperature[start_subpulse:end_subpulse]
-    dataframe_starts_ends_subpulses['dch_subpulse'] = list_dch
-    dataframe_starts_ends_subpulses['drop_subpulse'] = list_drops
-    dataframe_starts_ends_subpulses['min_temp_subpulse'] = list_min_temp
-    dataframe_starts_ends_subpulses['duration_subpulse'] = \
-        dataframe_starts_ends_subpulses.end_subpulse - dataframe_starts_ends_subpulses.start_subpulse  
-    dataframe_pulses_group = dataframe_starts_ends_subpulses.groupby('pulse_id')
-    dataframe_pulse = pd.DataFrame()
-    dataframe_pulse['start_pulse'] =   dataframe_pulses_group.start_pulse.first()
-    dataframe_pulse['start_time'] = bottom_temperature.time.values[dataframe_pulse['start_pulse']]
-    dataframe_pulse['end_pulse'] =   dataframe_pulses_group.end_pulse.first()
-    dataframe_pulse['end_time'] = bottom_temperature.time.values[dataframe_pulse['end_pulse']]
-    dataframe_pulse['number_subpulses'] =   dataframe_pulses_group.start_pulse.count()
-    dataframe_pulse['dch_pulse'] =   dataframe_pulses_group.dch_subpulse.sum()
-    dataframe_pulse['drop_pulse'] =   dataframe_pulses_group.drop_subpulse.min()
-    dataframe_pulse['min_temp_pulse'] =   dataframe_pulses_group.min_temp_subpulse.min()
-    dataframe_pulse['duration_pulse'] =   (dataframe_pulse.end_pulse-dataframe_pulse.start_pulse)*dt
-    dch_darray = xr.DataArray(dch_series,
-                              dims = ['time'],
-                              coords = dict(time=bottom_temperature.time))
-    drops_darray = xr.DataArray(drops_series,
-                                dims = ['time'],
-                                coords = dict(time=bottom_temperature.time))
-    pulse_temp_darray = xr.DataArray(temp_series,
-                                     dims = ['time'],
-                                     coords = dict(time=bottom_temperature.time))
-    min_temp_darray = xr.DataArray(min_temp_series,
-                                   dims = ['time'],
-                                   coords = dict(time=bottom_temperature.time))
-    
-    ds = xr.Dataset(dict(dch = dch_darray, 
-                         drops = drops_darray,
-                         min_temp=min_temp_darray,
-                         pulse_temp=pulse_temp_darray,
-                         temperature =darray))
-    sys.stdout.write("\r+'                                                   ")
-    sys.stdout.write('\r' + 'Metrics computed !')
+    with profiler.stage('describe_pulses') as record:
+        subpulse_table, series = engine.describe_pulses(features.bottom_temperature,
+                                                        list_starts,
+                                                        list_ends,
+                                                        dt,
+                                                        sparse=low_memory)
+        record['items'] = len(subpulse_table[engine.SUBPULSE_COLUMNS[0]])
+    return format_output(darray, subpulse_table, series, dt,
+                         low_memory=low_memory, source=source,
+                         profiler=profiler)
+
+def format_output(darray, subpulse_table, series, dt, low_memory=False,
+                  source=None, profiler=QUIET):
+    """
+    Makes the output tables and Dataset from the subpulse table and series
+    of engine.describe_pulses
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Temperature data
+    subpulse_table : dict
+        Subpulse table, see engine.describe_pulses
+    series : dict
+        Series of drops and degree cooling hours, sparse if low_memory
+    dt : float
+        Time step in hours
+    low_memory : bool
+        If True, ds is sparse and does not include the temperature data,
+        see sparse_series_dataset.
+    source : String
+        Input directory of darray, referenced by the sparse Dataset.
+    profiler : profiling.Profiler
+        Receives the timing of each stage.
+
+    Returns
+    -------
+    dataframe_starts_ends_subpulses : pandas DataFrame
+        DataFrame including all pulses and subpulses.
+    ds : xarrray Dataset
+        Dataset including drops and degree cooling hours data.
+    dataframe_pulse : pandas DataFrame
+        DataFrame containing information about individual pulses.
+
+    """
+    with profiler.stage('output_tables') as record:
+        dataframe_starts_ends_subpulses = subpulse_dataframe(subpulse_table)
+        dataframe_pulse = pulse_dataframe(dataframe_starts_ends_subpulses,
+                                          darray.time.values,
+                                          dt)
+        record['items'] = len(dataframe_pulse)
+    with profiler.stage('output_series'):
+        if low_memory:
+            ds = sparse_series_dataset(darray, subpulse_table, series, source=source)
+        else:
+            ds = series_dataset(darray, series)
     
     return dataframe_starts_ends_subpulses, ds, dataframe_pulse
 
@@ -171,83 +200,198 @@ def split_pulses(bottom_temperature, list_starts, list_ends):
         DataFrame containing start and end indexes of each subpulse
 
     """
-    #Combine pulses if they overlap
-    is_pulse_present = np.zeros(bottom_temperature.size)
-    sys.stdout.write("\r+'                                                   ")
-    for k in range(list_starts.size):
-        progress = list_starts[k]/is_pulse_present.size*100
-        sys.stdout.write('\r' + 'Removing overlap: %.02f'%progress + r'%')
-        is_pulse_present[list_starts[k]:list_ends[k]] = 1
-        is_pulse_present_grad = np.diff(is_pulse_present)
-    if is_pulse_present[0]:
-        is_pulse_present_grad[0] = 1
-    if is_pulse_present[-1]:
-        is_pulse_present_grad[-1] = -1
-    list_starts_no_overlap = np.where(is_pulse_present_grad == 1)[0]
-    list_ends_no_overlap = np.where(is_pulse_present_grad == -1)[0]
-    #Divide pulses if the temperature gets warmer than the initial temperature
-    list_starts_no_overlap_split = []
-    list_ends_no_overlap_split = []
-    sys.stdout.write("\r+'                                                   ")
-    for k in range(list_starts_no_overlap.size):
-        init_start = list_starts_no_overlap[k]
-        progress = init_start/list_ends[-1]*100
-        sys.stdout.write('\r' + 'Splitting pulses: %.02f'%progress + r'%')
-        init_end = list_ends_no_overlap[k]
-        pulse_done = False
-        decreasing_temperature = \
-            np.where(bottom_temperature[init_start:init_end].diff('time') < 0)[0]
-        is_temperature_decreasing = \
-            decreasing_temperature.size > 0
-        if is_temperature_decreasing:
-            init_start = init_start + decreasing_temperature[0]
-        else:
-            pulse_done = True
-        while not pulse_done:
-            init_temp = bottom_temperature[init_start]
-            warmer_temperature_than_init = \
-                np.where(bottom_temperature[init_start:init_end] > init_temp)[0]
-            is_temperature_warmer_than_init = \
-                warmer_temperature_than_init.size > 0
-            if is_temperature_warmer_than_init:
-                new_end = init_start + warmer_temperature_than_init[0]
-                list_starts_no_overlap_split.append(init_start)
-                list_ends_no_overlap_split.append(new_end)
-                decreasing_temperature = \
-                    np.where(bottom_temperature[new_end:init_end].diff('time') < 0)[0]
-                is_temperature_decreasing = \
-                    decreasing_temperature.size > 0
-                if is_temperature_decreasing:
-                    init_start = new_end + decreasing_temperature[0]
-                else:
-                    pulse_done = True
-            else:
-                list_starts_no_overlap_split.append(init_start)
-                list_ends_no_overlap_split.append(init_end)
-                pulse_done = True
-    list_starts_no_overlap_split = np.array(list_starts_no_overlap_split)
-    list_ends_no_overlap_split = np.array(list_ends_no_overlap_split)
-    #Divide into subpulses
-    list_starts_ends_subpulses = []
-    sys.stdout.write("\r+'                                                   ")
-    for k in range(list_starts_no_overlap_split.size):
-        start = list_starts_no_overlap_split[k]
-        progress = start/list_ends[-1]*100
-        sys.stdout.write('\r' + 'Finding subpulses: %.02f'%progress + r'%')
-        end = list_ends_no_overlap_split[k]
-        temp_extract = bottom_temperature[start:end]
-        local_maxima = argrelmax(temp_extract.values)[0]
-        local_maxima = np.insert(local_maxima, 0, 0)
-        local_maxima += start
-        local_maxima = np.insert(local_maxima, len(local_maxima), end)
-        
-        for i in range(local_maxima.size-1):
-            data_subpulse = [k, start, end, local_maxima[i], local_maxima[i+1]]
-            list_starts_ends_subpulses.append(data_subpulse)
-    dataframe_starts_ends_subpulses = pd.DataFrame(list_starts_ends_subpulses,
-    					   columns=['pulse_id',
-    					   			'start_pulse',
-    					   			'end_pulse',
-    					   			'start_subpulse',
-    					   			'end_subpulse'])
+    subpulses = engine.split_pulses(np.asarray(bottom_temperature),
+                                    list_starts,
+                                    list_ends)
+    return pd.DataFrame(dict(zip(engine.SUBPULSE_COLUMNS, subpulses)))
+
+def subpulse_dataframe(subpulse_table, index=None):
+    """
+    Makes the subpulse DataFrame from a subpulse table
+
+    Parameters
+    ----------
+    subpulse_table : dict of numpy 1d arrays
+        Subpulse table as returned by engine.describe_pulses.
+    index : array like
+        Index of the DataFrame. Default index if None.
+
+    Returns
+    -------
+    dataframe_starts_ends_subpulses : pandas DataFrame
+        DataFrame including all pulses and subpulses.
+
+    """
+    dataframe_starts_ends_subpulses = pd.DataFrame(subpulse_table, index=index)
+    dataframe_starts_ends_subpulses['duration_subpulse'] = \
+        dataframe_starts_ends_subpulses.end_subpulse - dataframe_starts_ends_subpulses.start_subpulse  
     return dataframe_starts_ends_subpulses
+
+def pulse_dataframe(dataframe_starts_ends_subpulses, time, dt, offset=0):
+    """
+    Aggregates subpulses into pulse statistics
+
+    Parameters
+    ----------
+    dataframe_starts_ends_subpulses : pandas DataFrame
+        DataFrame including all pulses and subpulses.
+    time : numpy 1d array
+        Timestamps of the time series.
+    dt : float
+        Time step in hours.
+    offset : int
+        Index of the first element of time in the time series.
+
+    Returns
+    -------
+    dataframe_pulse : pandas DataFrame
+        DataFrame containing information about individual pulses.
+
+    """
+    dataframe_pulses_group = dataframe_starts_ends_subpulses.groupby('pulse_id')
+    dataframe_pulse = pd.DataFrame()
+    dataframe_pulse['start_pulse'] =   dataframe_pulses_group.start_pulse.first()
+    dataframe_pulse['start_time'] = time[dataframe_pulse['start_pulse'] - offset]
+    dataframe_pulse['end_pulse'] =   dataframe_pulses_group.end_pulse.first()
+    dataframe_pulse['end_time'] = time[dataframe_pulse['end_pulse'] - offset]
+    dataframe_pulse['number_subpulses'] =   dataframe_pulses_group.start_pulse.count()
+    dataframe_pulse['dch_pulse'] =   dataframe_pulses_group.dch_subpulse.sum()
+    dataframe_pulse['drop_pulse'] =   dataframe_pulses_group.drop_subpulse.min()
+    dataframe_pulse['min_temp_pulse'] =   dataframe_pulses_group.min_temp_subpulse.min()
+    dataframe_pulse['duration_pulse'] =   (dataframe_pulse.end_pulse-dataframe_pulse.start_pulse)*dt
+    return dataframe_pulse
+
+def series_dataset(darray, series):
+    """
+    Makes the output Dataset of instantaneous series
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Temperature data
+    series : dict of numpy 1d arrays
+        Instantaneous series as returned by engine.describe_pulses.
+
+    Returns
+    -------
+    ds : xarrray Dataset
+        Dataset including drops and degree cooling hours data.
+
+    """
+    data_vars = dict()
+    for name in engine.SERIES_NAMES:
+        data_vars[name] = xr.DataArray(series[name],
+                                       dims = ['time'],
+                                       coords = dict(time=darray.time))
+    data_vars['temperature'] = darray
+    return xr.Dataset(data_vars)
+
+def sparse_series_dataset(darray, subpulse_table, series, source=None):
+    """
+    Makes a compact output Dataset of instantaneous series
+
+    Series are only stored during subpulses, as float32: dch and pulse_temp
+    for each time step of each subpulse along the 'sample' dimension, one
+    subpulse after the other, and drops and min_temp once per subpulse
+    along the 'subpulse' dimension, with the start and end indexes of the
+    subpulses. The temperature data is not copied: the Dataset refers to
+    the input directory and keeps the time axis, as attributes if it is
+    regular (first time, time step in nanoseconds and number of time
+    steps), and the location of the station as attributes, or as variables
+    along 'site' for several sites.
+    dense_series_dataset rebuilds the full Dataset.
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Temperature data
+    subpulse_table : dict of numpy 1d arrays
+        Subpulse table as returned by engine.describe_pulses.
+    series : dict of numpy 1d arrays
+        Sparse instantaneous series as returned by engine.describe_pulses
+        with sparse=True.
+    source : String
+        Input directory of the temperature data.
+
+    Returns
+    -------
+    ds : xarrray Dataset
+        Sparse dataset of drops and degree cooling hours data.
+
+    """
+    start_subpulse = np.asarray(subpulse_table['start_subpulse'])
+    end_subpulse = np.asarray(subpulse_table['end_subpulse'])
+    offsets = np.cumsum(end_subpulse - start_subpulse) \
+            - (end_subpulse - start_subpulse)
+    ds = xr.Dataset(dict(start_subpulse = ('subpulse', start_subpulse),
+                         end_subpulse = ('subpulse', end_subpulse),
+                         drops = ('subpulse', 
+                                  series['drops'][offsets].astype(np.float32)),
+                         min_temp = ('subpulse',
+                                     series['min_temp'][offsets].astype(np.float32)),
+                         dch = ('sample', series['dch'].astype(np.float32)),
+                         pulse_temp = ('sample',
+                                       series['pulse_temp'].astype(np.float32))))
+    time = darray.time.values
+    time_steps = np.diff(time)
+    if time.size > 1 and (time_steps == time_steps[0]).all():
+        ds.attrs['time_start'] = str(time[0])
+        # In nanoseconds, as sampling intervals may be shorter than a second
+        ds.attrs['time_step_ns'] = int(time_steps[0]/np.timedelta64(1, 'ns'))
+        ds.attrs['time_size'] = time.size
+    else:
+        ds.coords['time'] = time
+    ds.attrs['depth'] = darray.depth.values
+    for name in LOCATION_NAMES:
+        if name in darray.coords and darray[name].ndim == 0:
+            ds.attrs[name] = darray[name].values.item()
+        elif name in darray.coords:
+            # One location per site
+            ds.coords[name] = (darray[name].dims, darray[name].values)
+    if source is not None:
+        ds.attrs['temperature_source'] = source
+    return ds
+
+def dense_series_dataset(ds_sparse, darray=None):
+    """
+    Rebuilds the output Dataset of instantaneous series from a sparse one
+
+    Parameters
+    ----------
+    ds_sparse : xarray Dataset
+        Sparse dataset as returned by sparse_series_dataset.
+    darray : xarray DataArray
+        Temperature data, added to the Dataset if not None.
+
+    Returns
+    -------
+    ds : xarrray Dataset
+        Dataset including drops and degree cooling hours data.
+
+    """
+    if 'time_start' in ds_sparse.attrs:
+        time_step = np.timedelta64(int(ds_sparse.attrs['time_step_ns']), 'ns')
+        time = np.datetime64(ds_sparse.attrs['time_start'], 'ns') \
+             + np.arange(ds_sparse.attrs['time_size'])*time_step
+    else:
+        time = ds_sparse.time.values
+    start_subpulse = ds_sparse.start_subpulse.values
+    lengths = ds_sparse.end_subpulse.values - start_subpulse
+    flat_index = engine.concatenated_ranges(start_subpulse, lengths)
+    data_vars = dict()
+    for name in engine.SERIES_NAMES:
+        values = ds_sparse[name].values
+        if ds_sparse[name].dims == ('subpulse',):
+            values = np.repeat(values, lengths)
+        dense_values = np.full(time.size, np.nan, dtype=values.dtype)
+        dense_values[flat_index] = values
+        data_vars[name] = xr.DataArray(dense_values,
+                                       dims = ['time'],
+                                       coords = dict(time=time))
+    if darray is not None:
+        data_vars['temperature'] = darray
+    ds = xr.Dataset(data_vars)
+    for name in LOCATION_NAMES:
+        if name in ds_sparse.attrs:
+            ds.coords[name] = ds_sparse.attrs[name]
+    return ds
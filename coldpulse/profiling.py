@@ -0,0 +1,169 @@
+"""
+Timing and progress reports of the stages of a run.
+
+Functions of the pipeline take a profiler argument. Each stage runs in a
+profiler.stage(name) block, which measures its wall time, its peak memory
+(with track_memory=True) and the number of items it returns, and sends
+these to a callback as an event dict:
+- 'stage' events, with the stage name, seconds, peak_memory (bytes) and
+  items,
+- 'progress' events within long stages, with done and total counts, sent
+  at most once every progress_interval seconds,
+- 'message' events, with a text.
+The callback can be a function, a logging.Logger, or None to only keep the
+records, which profiler.report() returns as a table. Without a profiler,
+functions use QUIET, which does nothing at all.
+"""
+import time
+import logging
+import tracemalloc
+from contextlib import contextmanager
+import pandas as pd
+
+PROFILE_COLUMNS = ['stage', 'seconds', 'peak_memory', 'items']
+
+
+class Profiler:
+    """
+    Records and reports the stages of a run
+
+    Parameters
+    ----------
+    callback          : callable or logging.Logger
+        Receives each event dict. Events are logged at INFO level if a
+        logger is given, and only recorded if None.
+    progress_interval : float
+        Minimum time in seconds between two progress events of a stage.
+    track_memory      : bool
+        If True, the peak memory allocated during each stage is measured
+        with tracemalloc, which slows down pure Python code.
+    """
+    def __init__(self, callback=None, progress_interval=1., track_memory=False):
+        if isinstance(callback, logging.Logger):
+            callback = logger_callback(callback)
+        self.callback = callback
+        self.progress_interval = progress_interval
+        self.track_memory = track_memory
+        self.records = []
+        self.last_progress = dict()
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Times the block it wraps as the stage name. The block can set the
+        number of items it processed in record['items'].
+
+        Yields
+        ------
+        record : dict
+            Record of the stage, completed when the block exits
+        """
+        record = dict(stage=name, seconds=None, peak_memory=None, items=None)
+        started_tracing = self.track_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['seconds'] = time.perf_counter() - start_time
+            if self.track_memory:
+                record['peak_memory'] = tracemalloc.get_traced_memory()[1] \
+                                      - memory_start
+            if started_tracing:
+                tracemalloc.stop()
+            self.records.append(record)
+            self.last_progress.pop(name, None)
+            self.emit(dict(record, event='stage'))
+
+    def progress(self, name, done, total=None):
+        """
+        Reports the progress of the stage name, if progress_interval
+        seconds have passed since its last report
+        """
+        now = time.perf_counter()
+        if now - self.last_progress.get(name, -float('inf')) < self.progress_interval \
+                and done != total:
+            return
+        self.last_progress[name] = now
+        self.emit(dict(event='progress', stage=name, done=done, total=total))
+
+    def message(self, text):
+        """
+        Reports a message
+        """
+        self.emit(dict(event='message', text=text))
+
+    def emit(self, event):
+        if self.callback is not None:
+            self.callback(event)
+
+    def report(self):
+        """
+        Profile of the run
+
+        Returns
+        -------
+        report : pandas DataFrame
+            One row per stage, in the order they ended, with the wall time
+            in seconds, the peak memory in bytes and the number of items.
+        """
+        return pd.DataFrame(self.records, columns=PROFILE_COLUMNS)
+
+class QuietProfiler(Profiler):
+    """
+    Profiler which records and reports nothing
+    """
+    def __init__(self):
+        Profiler.__init__(self)
+        self.record = dict()
+
+    @contextmanager
+    def stage(self, name):
+        yield self.record
+
+    def progress(self, name, done, total=None):
+        pass
+
+    def message(self, text):
+        pass
+
+QUIET = QuietProfiler()
+
+# =============================================================================
+# Callbacks
+# =============================================================================
+
+def print_event(event):
+    """
+    Prints an event on one line
+    """
+    print(format_event(event))
+
+def logger_callback(logger, level=logging.INFO):
+    """
+    Callback logging events with logger
+    """
+    def log_event(event):
+        logger.log(level, format_event(event))
+    return log_event
+
+def format_event(event):
+    """
+    Text of an event
+    """
+    if event['event'] == 'message':
+        return event['text']
+    if event['event'] == 'progress':
+        if event['total'] is None:
+            return '%s: %d'%(event['stage'], event['done'])
+        return '%s: %d/%d'%(event['stage'], event['done'], event['total'])
+    text = '%s: %.3fs'%(event['stage'], event['seconds'])
+    if event['items'] is not None:
+        text += ', %d items'%event['items']
+    if event['peak_memory'] is not None:
+        text += ', peak %.1f MB'%(event['peak_memory']/2**20)
+    return text
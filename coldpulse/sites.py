@@ -0,0 +1,108 @@
+"""
+Detection over many sites sharing a time axis.
+
+Each site is a water column, e.g. a mooring or a grid column of an ocean
+model, and the temperature data is a DataArray with dimensions (site,
+depth, time). Sites are detected by batches of site_chunk sites, each batch
+going through the detection stages as a single (depth, site, time) array,
+see engine.detect_sites. Pulses of all sites are returned in single tables
+with a 'site' column.
+"""
+import numpy as np
+import xarray as xr
+from .threshold import make_tsi_thresholds_for_sites
+from .outputs import subpulse_dataframe, pulse_dataframe, sparse_series_dataset
+from .profiling import QUIET
+from . import engine
+
+
+def get_output_sites(darray, thresholds=None, site_chunk=1024,
+                     low_memory=False, profiler=QUIET):
+    """
+    Generates output from the TSI method for every site of darray
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Temperature data with dimensions (site, depth, time), in any order,
+        with longitude and latitude coordinates along site. It can be backed
+        by dask, only site_chunk sites are loaded at once.
+    thresholds : float or array like
+        TSI threshold of each site. If None, the 'threshold' coordinate of
+        darray if any, else thresholds are computed from the GODAS
+        climatology with make_tsi_thresholds_for_sites.
+    site_chunk : int
+        Number of sites detected at once.
+    low_memory : bool
+        If True, the series are sparse, see outputs.sparse_series_dataset,
+        with the site of each subpulse in a 'site' variable.
+    profiler : profiling.Profiler
+        Receives the timing of each batch of sites and the progress.
+
+    Returns
+    -------
+    df_output_sub : pandas DataFrame
+        DataFrame containing information about individual subpulses, with
+        the site of each subpulse. Indexes are relative to the site.
+    ds_output : xarrray Dataset
+        Dataset including drops and degree cooling hours data, with
+        dimensions (site, time) unless low_memory is True.
+    df_output : pandas DataFrame
+        DataFrame containing information about individual pulses, with the
+        site of each pulse.
+
+    """
+    darray = darray.transpose('site', 'depth', 'time')
+    number_sites = darray.sizes['site']
+    if thresholds is None and 'threshold' in darray.coords:
+        thresholds = darray.threshold.values
+    elif thresholds is None:
+        with profiler.stage('threshold') as record:
+            thresholds = make_tsi_thresholds_for_sites(darray)
+            record['items'] = number_sites
+    thresholds = np.broadcast_to(np.asarray(thresholds, dtype=float),
+                                 (number_sites,))
+    time_step = darray.time.diff('time').values[0].astype('timedelta64[s]').astype(int)/3600
+    tables = []
+    series = []
+    next_pulse_id = 0
+    for first_site in range(0, number_sites, site_chunk):
+        last_site = min(first_site + site_chunk, number_sites)
+        with profiler.stage('detect_sites') as record:
+            result = engine.detect_sites(darray[first_site:last_site].values,
+                                         darray.depth.values,
+                                         thresholds[first_site:last_site],
+                                         time_step=time_step,
+                                         sparse=low_memory)
+            record['items'] = last_site - first_site
+        table = result.subpulses
+        table['site'] = table['site'] + first_site
+        table['pulse_id'] = table['pulse_id'] + next_pulse_id
+        if table['pulse_id'].size:
+            next_pulse_id = table['pulse_id'].max() + 1
+        tables.append(table)
+        series.append(result.series)
+        profiler.progress('detect_sites', last_site, number_sites)
+    subpulse_table = dict([(name, np.concatenate([table[name] for table in tables]))
+                           for name in tables[0]])
+    series = dict([(name, np.concatenate([block[name] for block in series]))
+                   for name in engine.SERIES_NAMES])
+    with profiler.stage('output_tables') as record:
+        site_index = subpulse_table['site']
+        subpulse_table['site'] = darray.site.values[site_index]
+        df_output_sub = subpulse_dataframe(subpulse_table)
+        df_output = pulse_dataframe(df_output_sub, darray.time.values, time_step)
+        df_output.insert(0, 'site', df_output_sub.groupby('pulse_id').site.first())
+        record['items'] = len(df_output)
+    with profiler.stage('output_series'):
+        if low_memory:
+            ds_output = sparse_series_dataset(darray, subpulse_table, series)
+            ds_output['site'] = ('subpulse', subpulse_table['site'])
+        else:
+            ds_output = xr.Dataset(dict([(name, (('site', 'time'), series[name]))
+                                         for name in engine.SERIES_NAMES]),
+                                   coords=dict(time=darray.time))
+            ds_output = ds_output.assign_coords(
+                dict([(name, coordinate) for name, coordinate in darray.coords.items()
+                      if coordinate.dims == ('site',)]))
+    return df_output_sub, ds_output, df_output
@@ -0,0 +1,324 @@
+"""
+Parameter sweeps of the detection, for sensitivity analyses.
+
+The features of the temperature data are computed once and shared by all
+configurations of TSI threshold and start/end shifting criteria. Each
+stage is also computed once per distinct input: potential pulses once per
+threshold, start and end breakpoints once per set of criteria, the index
+of the minima of the TSI used by the bottom logger filter once, and the
+splitting and metrics of a pulse once per distinct pulse, as most pulses
+are found by many configurations. With several workers, the
+features are put in shared memory and read by every worker process without
+copies.
+"""
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from .features import DetectionFeatures
+from .engine import DEFAULT_START_FLAGS, DEFAULT_END_FLAGS
+from . import engine
+
+START_FLAGS = ['use_positive_phi',
+               'use_increasing_phi',
+               'use_increasing_temp',
+               'use_minimum_water_column_temp']
+END_FLAGS = ['use_positive_phi',
+             'use_decreasing_phi',
+             'use_decreasing_temp',
+             'use_maximum_water_column_temp']
+RESULT_COLUMNS = ['number_pulses', 'number_subpulses', 'dch_total']
+# Features of the worker processes, see attach_features
+worker_state = dict()
+
+
+def sweep_darray(darray, thresholds, start_flag_sets=None, end_flag_sets=None,
+                 workers=1):
+    """
+    Runs the detection on darray for every combination of thresholds and
+    start/end criteria
+
+    Parameters
+    ----------
+    darray          : xarray DataArray
+        Temperature data with dimensions (depth, time)
+    thresholds      : list of float
+        TSI thresholds
+    start_flag_sets : list of dict
+        Criteria of shift_starts, each dict giving some of START_FLAGS.
+        [DEFAULT_START_FLAGS] if None, all 16 combinations if 'all'.
+    end_flag_sets   : list of dict
+        Criteria of shift_ends, each dict giving some of END_FLAGS.
+        [DEFAULT_END_FLAGS] if None, all 16 combinations if 'all'.
+    workers         : int
+        Number of worker processes, 1 to run in this process.
+
+    Returns
+    -------
+    results : pandas DataFrame
+        One row per configuration, see sweep_features
+    """
+    darray = darray.transpose('depth', 'time')
+    time_step = darray.time.diff('time').values[0].astype('timedelta64[s]').astype(int)/3600
+    features = DetectionFeatures.from_darray(darray)
+    configurations = parameter_grid(thresholds, start_flag_sets, end_flag_sets)
+    return sweep_features(features, configurations, time_step, workers=workers)
+
+def parameter_grid(thresholds, start_flag_sets=None, end_flag_sets=None):
+    """
+    Every combination of thresholds and start/end criteria
+
+    Parameters
+    ----------
+    thresholds      : list of float
+        TSI thresholds
+    start_flag_sets : list of dict
+        Criteria of shift_starts, see sweep_darray
+    end_flag_sets   : list of dict
+        Criteria of shift_ends, see sweep_darray
+
+    Returns
+    -------
+    configurations : list of dict
+        Configurations with a 'threshold' key, START_FLAGS prefixed by
+        'start_' and END_FLAGS prefixed by 'end_'
+    """
+    start_flag_sets = flag_sets(start_flag_sets, START_FLAGS, DEFAULT_START_FLAGS)
+    end_flag_sets = flag_sets(end_flag_sets, END_FLAGS, DEFAULT_END_FLAGS)
+    configurations = []
+    for threshold, start_flags, end_flags in itertools.product(np.atleast_1d(thresholds),
+                                                               start_flag_sets,
+                                                               end_flag_sets):
+        configuration = dict(threshold=float(threshold))
+        configuration.update([('start_%s'%name, start_flags[name])
+                              for name in START_FLAGS])
+        configuration.update([('end_%s'%name, end_flags[name])
+                              for name in END_FLAGS])
+        configurations.append(configuration)
+    return configurations
+
+def flag_sets(sets, names, default):
+    """
+    Complete sets of criteria, missing criteria taking their default value
+    """
+    if sets is None:
+        return [default]
+    if isinstance(sets, str) and sets == 'all':
+        return [dict(zip(names, values))
+                for values in itertools.product([True, False], repeat=len(names))]
+    for flags in sets:
+        assert set(flags) <= set(names),\
+            "Unknown criteria %s, use some of %s."%(sorted(set(flags) - set(names)), names)
+    return [dict(default, **flags) for flags in sets]
+
+def sweep_features(features, configurations, time_step=1., workers=1):
+    """
+    Evaluates configurations on precomputed features
+
+    Parameters
+    ----------
+    features       : DetectionFeatures
+        Features of the temperature data
+    configurations : list of dict
+        Configurations, see parameter_grid
+    time_step      : float
+        Time step of the data in hours
+    workers        : int
+        Number of worker processes, 1 to run in this process. Each worker
+        gets the configurations of some thresholds.
+
+    Returns
+    -------
+    results : pandas DataFrame
+        One row per configuration, in order, with its parameters, the
+        number of pulses and subpulses detected and their total degree
+        cooling hours.
+    """
+    if workers == 1 or len(configurations) < 2:
+        rows = evaluate_configurations(features, configurations, time_step)
+    else:
+        groups = dict()
+        for index, configuration in enumerate(configurations):
+            groups.setdefault(configuration['threshold'], []).append(index)
+        tasks = [[configurations[index] for index in indexes]
+                 for indexes in groups.values()]
+        blocks, arrays = share_features(features)
+        try:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=attach_features,
+                                     initargs=(arrays,)) as executor:
+                task_rows = list(executor.map(evaluate_in_worker, tasks,
+                                              [time_step]*len(tasks)))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+        rows = [None]*len(configurations)
+        for indexes, task in zip(groups.values(), task_rows):
+            for index, row in zip(indexes, task):
+                rows[index] = row
+    columns = list(configurations[0]) + RESULT_COLUMNS if configurations else RESULT_COLUMNS
+    return pd.DataFrame(rows, columns=columns)
+
+def evaluate_configurations(features, configurations, time_step):
+    """
+    Runs the detection for each configuration, computing each stage once
+    per distinct input
+
+    Parameters
+    ----------
+    features       : DetectionFeatures
+        Features of the temperature data
+    configurations : list of dict
+        Configurations, see parameter_grid
+    time_step      : float
+        Time step of the data in hours
+
+    Returns
+    -------
+    rows : list of dict
+        Configurations with their results
+    """
+    potential = dict()
+    starts_breakpoints = dict()
+    ends_breakpoints = dict()
+    pulse_memo = dict()
+    phi_range_argmin = engine.RangeArgmin(features.phi)
+    rows = []
+    for configuration in configurations:
+        threshold = configuration['threshold']
+        if threshold not in potential:
+            potential[threshold] = engine.potential_pulses(features, threshold)
+        list_starts, list_ends = potential[threshold]
+        start_flags = tuple([configuration['start_%s'%name] for name in START_FLAGS])
+        if start_flags not in starts_breakpoints:
+            starts_breakpoints[start_flags] = \
+                engine.start_breakpoints(features, **dict(zip(START_FLAGS, start_flags)))
+        end_flags = tuple([configuration['end_%s'%name] for name in END_FLAGS])
+        if end_flags not in ends_breakpoints:
+            ends_breakpoints[end_flags] = \
+                engine.end_breakpoints(features, **dict(zip(END_FLAGS, end_flags)))
+        shifted_starts = engine.snap_to_breakpoints(list_starts,
+                                                    starts_breakpoints[start_flags],
+                                                    direction='backward')
+        filtered_starts, filtered_ends = \
+            engine.remove_if_not_from_bottom_logger(features, shifted_starts,
+                                                    list_ends,
+                                                    phi_range_argmin=phi_range_argmin)
+        shifted_ends = engine.snap_to_breakpoints(filtered_ends,
+                                                  ends_breakpoints[end_flags],
+                                                  direction='forward')
+        totals = pulse_totals(features.bottom_temperature, filtered_starts,
+                              shifted_ends, time_step, pulse_memo)
+        rows.append(dict(configuration, **dict(zip(RESULT_COLUMNS, totals))))
+    return rows
+
+def pulse_totals(temperature, list_starts, list_ends, time_step, memo):
+    """
+    Number of pulses and subpulses and total degree cooling hours. The
+    pulses are merged as in engine.split_pulses, and each merged pulse is
+    only split and measured the first time it is found.
+
+    Parameters
+    ----------
+    temperature : 1darray
+        Bottom temperature data
+    list_starts : 1darray
+        Start indexes of pulses detected
+    list_ends   : 1darray
+        End indexes of pulses detected
+    time_step   : float
+        Time step in hours
+    memo        : dict
+        Number of pulses and subpulses and DCH of each merged pulse already
+        measured, by start and end index. Updated in place.
+
+    Returns
+    -------
+    totals : tuple
+        Number of pulses, number of subpulses and total DCH
+    """
+    temperature = np.asarray(temperature, dtype=float)
+    merged_starts, merged_ends = \
+        engine.merge_overlapping_pulses(list_starts, list_ends, temperature.size)
+    keys = list(zip(merged_starts.tolist(), merged_ends.tolist()))
+    is_new = np.array([key not in memo for key in keys], dtype=bool)
+    if is_new.any():
+        new_starts = merged_starts[is_new]
+        new_ends = merged_ends[is_new]
+        split_starts, split_ends = \
+            engine.split_warmer_than_initial(temperature, new_starts, new_ends)
+        subpulses = engine.find_subpulses(temperature, split_starts, split_ends)
+        metrics, series = engine.compute_subpulse_metrics(temperature,
+                                                          subpulses[1],
+                                                          subpulses[3],
+                                                          subpulses[4],
+                                                          time_step,
+                                                          sparse=True)
+        # Merged pulse of each split pulse and of each subpulse
+        split_owner = np.searchsorted(new_starts, split_starts, side='right') - 1
+        subpulse_owner = split_owner[subpulses[0]]
+        number_pulses = np.bincount(split_owner, minlength=new_starts.size)
+        number_subpulses = np.bincount(subpulse_owner, minlength=new_starts.size)
+        dch = np.bincount(subpulse_owner, weights=metrics[0],
+                          minlength=new_starts.size)
+        memo.update(zip([key for key, new in zip(keys, is_new) if new],
+                        zip(number_pulses.tolist(), number_subpulses.tolist(),
+                            dch.tolist())))
+    if not keys:
+        return 0, 0, 0.
+    totals = np.array([memo[key] for key in keys])
+    return int(totals[:, 0].sum()), int(totals[:, 1].sum()), float(totals[:, 2].sum())
+
+# =============================================================================
+# Shared features of worker processes
+# =============================================================================
+
+def share_features(features):
+    """
+    Copies the arrays of features to shared memory blocks
+
+    Returns
+    -------
+    blocks : list of SharedMemory
+        Blocks to close and unlink once the workers are done
+    arrays : dict
+        Block name, shape and dtype of each array attribute, see
+        attach_features
+    """
+    blocks = []
+    arrays = dict()
+    for name, value in vars(features).items():
+        if not isinstance(value, np.ndarray) or value.nbytes == 0:
+            arrays[name] = value
+            continue
+        block = shared_memory.SharedMemory(create=True, size=value.nbytes)
+        np.ndarray(value.shape, dtype=value.dtype, buffer=block.buf)[...] = value
+        blocks.append(block)
+        arrays[name] = (block.name, value.shape, value.dtype.str)
+    return blocks, arrays
+
+def attach_features(arrays):
+    """
+    Worker initializer: rebuilds the features from shared memory blocks,
+    as read-only arrays
+    """
+    features = DetectionFeatures.__new__(DetectionFeatures)
+    blocks = []
+    for name, value in arrays.items():
+        if isinstance(value, tuple):
+            block = shared_memory.SharedMemory(name=value[0])
+            blocks.append(block)
+            value = np.ndarray(value[1], dtype=np.dtype(value[2]), buffer=block.buf)
+            value.flags.writeable = False
+        setattr(features, name, value)
+    worker_state['features'] = features
+    worker_state['blocks'] = blocks
+
+def evaluate_in_worker(configurations, time_step):
+    """
+    Evaluates configurations on the features of the worker process
+    """
+    return evaluate_configurations(worker_state['features'], configurations,
+                                   time_step)
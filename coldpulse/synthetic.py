@@ -0,0 +1,137 @@
+"""
+Synthetic mooring data with injected cold pulses.
+
+Used to benchmark and check the detection without field data or network
+access. Temperature decreases with depth, follows a diurnal cycle and has
+Gaussian noise. Each injected pulse cools the water column from the bottom
+up to its top depth, with a half sine shape in time.
+"""
+import os
+import numpy as np
+import pandas as pd
+import xarray as xr
+from .features import stratification_index
+from .threshold import record_threshold
+
+
+def make_mooring(n_samples=10**5, depths=(5., 10., 20., 30.), time_step=120,
+                 n_pulses=None, pulse_top=(5., 30.), duration=(10, 150),
+                 amplitude=(0.5, 3.), noise=0.05, resolution=0.01,
+                 nan_fraction=0., seed=0, location=('SYN', -162., 5.9)):
+    """
+    Generates a multi-depth temperature record with injected cold pulses
+
+    Parameters
+    ----------
+    n_samples    : int
+        Number of time steps
+    depths       : tuple of float
+        Depths of the loggers, positive down
+    time_step    : int
+        Sampling interval in seconds
+    n_pulses     : int
+        Number of injected pulses. One every 400 time steps if None.
+    pulse_top    : tuple of float
+        Range of the top depth of the pulses. The cooling is maximum at the
+        deepest logger and decreases linearly to zero at the top depth.
+    duration     : tuple of int
+        Range of the pulse durations in time steps
+    amplitude    : tuple of float
+        Range of the bottom cooling of the pulses in degrees
+    noise        : float
+        Standard deviation of the Gaussian noise in degrees
+    resolution   : float
+        Resolution of the loggers in degrees, 0 for none
+    nan_fraction : float
+        Fraction of missing values
+    seed         : int
+        Seed of the random generator
+    location     : tuple
+        Location ID, longitude and latitude of the mooring
+
+    Returns
+    -------
+    darray : xarray DataArray
+        Temperature data with dimensions (depth, time), as given by
+        inputs.prepare_darray
+    pulses : pandas DataFrame
+        Start index, duration, top depth and amplitude of each injected
+        pulse
+    """
+    random = np.random.default_rng(seed)
+    depths = np.asarray(depths, dtype=float)
+    if n_pulses is None:
+        n_pulses = n_samples//400
+    hours = np.arange(n_samples)*time_step/3600
+    surface_temperature = 28 + 0.5*np.sin(2*np.pi*hours/24)
+    temperature = surface_temperature[None, :] - 0.02*depths[:, None]
+    pulses = pd.DataFrame(dict(
+        start = np.sort(random.integers(0, max(n_samples - duration[1], 1), n_pulses)),
+        duration = random.integers(duration[0], duration[1], n_pulses, endpoint=True),
+        top_depth = random.uniform(pulse_top[0], pulse_top[1], n_pulses),
+        amplitude = random.uniform(amplitude[0], amplitude[1], n_pulses)))
+    max_depth = depths.max()
+    for start, length, top_depth, pulse_amplitude in pulses.itertuples(index=False):
+        stop = min(start + length, n_samples)
+        shape = pulse_amplitude*np.sin(np.linspace(0, np.pi, length))[:stop - start]
+        weight = np.clip((depths - top_depth)/max(max_depth - top_depth, 1e-6), 0, 1)
+        temperature[:, start:stop] -= weight[:, None]*shape[None, :]
+    temperature += random.normal(0, noise, temperature.shape)
+    if resolution:
+        temperature = np.round(temperature/resolution)*resolution
+    if nan_fraction:
+        temperature[random.random(temperature.shape) < nan_fraction] = np.nan
+    time = pd.date_range('2020-01-01', periods=n_samples, freq='%ss'%time_step)
+    darray = xr.DataArray(temperature,
+                          dims = ['depth', 'time'],
+                          coords = dict(depth=depths, time=time),
+                          name = 'temperature')
+    darray['locationID'] = location[0]
+    darray['longitude'] = location[1]
+    darray['latitude'] = location[2]
+    return darray, pulses
+
+def write_mooring(darray, input_dir):
+    """
+    Writes a mooring as one csv file per depth, named as expected by
+    inputs.prepare_darray
+
+    Parameters
+    ----------
+    darray    : xarray DataArray
+        Temperature data with dimensions (depth, time)
+    input_dir : String
+        Directory where the csv files are written
+
+    Returns
+    -------
+    None.
+    """
+    os.makedirs(input_dir, exist_ok=True)
+    for depth in darray.depth.values:
+        logger = darray.sel(depth=depth)
+        file_name = '%s_%s_%s_%g_.csv'%(darray.locationID.values,
+                                        float(darray.longitude),
+                                        float(darray.latitude),
+                                        depth)
+        pd.DataFrame(dict(time=logger.time.values,
+                          temperature=logger.values)).to_csv(
+            os.path.join(input_dir, file_name), index=False)
+
+def self_climatology_threshold(darray):
+    """
+    TSI threshold from the record itself, mean minus standard deviation of
+    its TSI. Stands in for the GODAS climatology threshold offline.
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Temperature data
+
+    Returns
+    -------
+    threshold : float
+        TSI threshold
+    """
+    darray = darray.transpose('depth', 'time')
+    return record_threshold(stratification_index(darray.values, darray.depth.values))
@@ -1,37 +1,36 @@
 import os
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, Future
+from importlib import resources
+import numpy as np
 import xarray as xr
-from tqdm import tqdm
-from haversine import haversine
-import pkg_resources
+from .features import compute_temperature_stratification_index, stratification_index
+from .inputs import list_station_files, logger_depths
+from . import cache
 
+GODAS_OPENDAP_URL = 'https://psl.noaa.gov/thredds/dodsC/Datasets/godas/pottmp.%s.nc'
+GODAS_YEARS = range(1980, 2020)
+# Mean Earth radius in km
+EARTH_RADIUS = 6371.0088
+# Sources of the TSI threshold, see make_tsi_threshold
+THRESHOLD_METHODS = ['godas', 'global', 'rolling', 'seasonal']
 
-def compute_temperature_stratification_index(darray):
-    """
-    Computes the temperature stratification index of a temperature time series
-    
-    Parameters
-    ----------
-    darray : xarray DataArray
-        Represents temperature data
-    
-    Returns
-    -------
-    phi : xarray DataArray
-        Represent the temperature stratification index
-    """
-    return ((darray-darray.mean('depth'))*darray.depth).mean('depth')
-
+@lru_cache(maxsize=None)
 def read_godas_grid():
     """
     Reads the NCEP-GODAS file contained in the package to get the grid coordinates.
+    The grid is read once per process and shared by all later calls.
     
     Returns
     -------
     dataarray : xarray dataarray
         Grid coordinates of NCEP-GODAS as a dataarray
     """
-    stream = pkg_resources.resource_stream(__name__, "data/godas_grid_level.nc")
-    dataarray = xr.open_dataarray(stream)
+    resource = resources.files(__package__).joinpath('data', 'godas_grid_level.nc')
+    # A file path, extracted only if the package is not installed as files
+    with resources.as_file(resource) as path:
+        with xr.open_dataarray(path) as dataarray:
+            dataarray = dataarray.load()
     return dataarray
 
 def find_nearest_nonnan_neigbour(longitude, latitude, max_depth):
@@ -44,6 +43,8 @@ def find_nearest_nonnan_neigbour(longitude, latitude, max_depth):
         Longitude of the location studied
     latitude : float
         Latitude of the location studied
+    max_depth : float
+        Depth of the deepest logger
 
     Returns
     -------
@@ -52,38 +53,91 @@ def find_nearest_nonnan_neigbour(longitude, latitude, max_depth):
     nearest_latitude : float
         Latitude of the nearest non NaN neighbour
     """
-    if longitude <0:
-        corrected_longitude = longitude + 360
-    else:
-        corrected_longitude = longitude
-    multidepth_grids = read_godas_grid() 
-    reference_map = multidepth_grids.sel(level=max_depth, method='bfill')
-    stacked_reference_map = reference_map.stack(coordinates = ('lon','lat'))
-    no_nan_map = stacked_reference_map.dropna('coordinates')
-    squared_distance = (no_nan_map.coordinates.lon-corrected_longitude)**2 \
-                     + (no_nan_map.coordinates.lat-latitude)**2
-    nearest_neighbour = squared_distance.loc[squared_distance==squared_distance.min()]
-    nearest_longitude = nearest_neighbour.coordinates.lon.values[0]
-    nearest_latitude = nearest_neighbour.coordinates.lat.values[0]
-    
-    if nearest_longitude > 180:
-        nearest_longitude_corrected = nearest_longitude - 360
-    else:
-        nearest_longitude_corrected = nearest_longitude
-    
-    minimal_distance = haversine((latitude, longitude),
-                                 (nearest_latitude, nearest_longitude_corrected))
+    nearest_longitudes, nearest_latitudes, distances = \
+        find_nearest_nonnan_neighbours(longitude, latitude, max_depth)
+    minimal_distance = float(distances)
     if minimal_distance > 100:
         print( "!!!CAREFUL!!! The nearest GODAS gridpoint is %.01fkm away, results may not be great.\
             \n Please, check your input longitude and latitude."%minimal_distance)
     else:
         print( "The nearest GODAS gridpoint is %.01fkm away"%minimal_distance)
-    return nearest_longitude, nearest_latitude
+    return float(nearest_longitudes), float(nearest_latitudes)
+
+def find_nearest_nonnan_neighbours(longitudes, latitudes, max_depth):
+    """
+    Finds the nearest non NaN GODAS neighbours of several points, using great
+    circle distances
+
+    Parameters
+    ----------
+    longitudes : float or numpy array
+        Longitudes of the locations studied, in degrees east
+    latitudes : float or numpy array
+        Latitudes of the locations studied, in degrees north
+    max_depth : float
+        Depth of the deepest logger, the grid level below it is used
+
+    Returns
+    -------
+    nearest_longitudes : numpy array
+        Longitudes of the nearest non NaN neighbours, between 0 and 360
+    nearest_latitudes : numpy array
+        Latitudes of the nearest non NaN neighbours
+    distances : numpy array
+        Distances to the nearest non NaN neighbours in km
+    """
+    levels = read_godas_grid().level.values
+    level = levels[min(np.searchsorted(levels, max_depth), levels.size - 1)]
+    tree, grid_longitudes, grid_latitudes = godas_level_tree(float(level))
+    chord, nearest = tree.query(unit_sphere_coordinates(longitudes, latitudes))
+    distances = 2*EARTH_RADIUS*np.arcsin(np.minimum(chord/2, 1))
+    return grid_longitudes[nearest], grid_latitudes[nearest], distances
+
+@lru_cache(maxsize=None)
+def godas_level_tree(level):
+    """
+    Builds the spatial index of the non NaN GODAS grid points of a level.
+    It is built once per process and level.
+
+    Parameters
+    ----------
+    level : float
+        Level of the GODAS grid
+
+    Returns
+    -------
+    tree : scipy.spatial.cKDTree
+        KD-tree of the grid points on the unit sphere
+    grid_longitudes : numpy 1d array
+        Longitudes of the grid points, between 0 and 360
+    grid_latitudes : numpy 1d array
+        Latitudes of the grid points
+    """
+    from scipy.spatial import cKDTree
+    reference_map = read_godas_grid().sel(level=level)
+    stacked_reference_map = reference_map.stack(coordinates = ('lon','lat'))
+    no_nan_map = stacked_reference_map.dropna('coordinates')
+    grid_longitudes = no_nan_map.coordinates.lon.values
+    grid_latitudes = no_nan_map.coordinates.lat.values
+    tree = cKDTree(unit_sphere_coordinates(grid_longitudes, grid_latitudes))
+    return tree, grid_longitudes, grid_latitudes
+
+def unit_sphere_coordinates(longitudes, latitudes):
+    """
+    Converts longitudes and latitudes in degrees to cartesian coordinates on
+    the unit sphere, with the coordinates on the last axis
+    """
+    longitudes = np.radians(longitudes)
+    latitudes = np.radians(latitudes)
+    return np.stack([np.cos(latitudes)*np.cos(longitudes),
+                     np.cos(latitudes)*np.sin(longitudes),
+                     np.sin(latitudes)], axis=-1)
 
-def extract_data_online_godas(lon, lat, max_depth, input_dir):
+def extract_data_online_godas(lon, lat, max_depth, input_dir, cache_dir=None,
+                              source=None):
     """
     Download the required GODAS data to get the 40 year temperature climatology.
-    Saves the data as a .nc file following:
+    The data is kept in the cache directory as a .nc file following:
         NCEP-GODAS_potential-temperature_[lon]_[lat]_[max-depth].nc
 
     Parameters
@@ -92,52 +146,199 @@ def extract_data_online_godas(lon, lat, max_depth, input_dir):
         Longitude of the location studied
     lat : float
         Latitude of the location studied
+    cache_dir : String
+        Cache directory, see coldpulse.cache.default_cache_dir
+    source : String
+        Source of the yearly GODAS files, see godas_year_path
 
     Returns
     -------
     file_name : string
-        Name of the extracted godas climatology data 
+        Path of the extracted godas climatology data 
     """
     nearest_longitude, nearest_latitude = find_nearest_nonnan_neigbour(lon, lat, max_depth)
-    
-    file_name = "NCEP-GODAS_potential-temperature_%.01fE_%.01fN_%dm.nc"%(nearest_longitude,
-                                                                         nearest_latitude,
-                                                                         max_depth)
-    if not file_name in os.listdir():
-        print("Downloading climatology data, this may take some time...")
-        chunks = dict(lon=50,
-                      lat=50,
-                      time=12,
-                      level=5)
-
-        all_monthly_godas_extract = []
-        year_climatology = range(1980, 2020)
-        for year in tqdm(year_climatology):
-            monthly_godas = xr.open_dataset('https://psl.noaa.gov/thredds/dodsC/Datasets/godas/pottmp.%s.nc'%year,
-                                            chunks=chunks)
-            all_monthly_godas_extract.append(monthly_godas.sel(lon=nearest_longitude,
-                                                               lat=nearest_latitude,
-                                                               method='nearest').dropna('level'))
+    return get_godas_climatology(nearest_longitude, nearest_latitude, max_depth,
+                                 cache_dir=cache_dir, source=source)
+
+def get_godas_climatology(nearest_longitude, nearest_latitude, max_depth,
+                          cache_dir=None, source=None, workers=8):
+    """
+    Gets the GODAS climatology of a grid point from the cache, extracting it
+    from the yearly GODAS files if needed
+
+    Parameters
+    ----------
+    nearest_longitude : float
+        Longitude of the GODAS grid point
+    nearest_latitude : float
+        Latitude of the GODAS grid point
+    max_depth : float
+        Depth of the deepest logger
+    cache_dir : String
+        Cache directory
+    source : String
+        Source of the yearly GODAS files, see godas_year_path
+    workers : int
+        Number of yearly files read concurrently, see godas_executor
+
+    Returns
+    -------
+    file_name : string
+        Path of the extracted godas climatology data 
+    """
+    def download(file_name):
+        from tqdm import tqdm
+        print("Extracting climatology data, this may take some time...")
+        paths = [godas_year_path(year, source) for year in GODAS_YEARS]
+        executor, engine = godas_executor(paths[0], workers)
+        with executor:
+            futures = [executor.submit(extract_godas_year,
+                                       path,
+                                       nearest_longitude,
+                                       nearest_latitude,
+                                       engine)
+                       for path in paths]
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                pass
+        all_monthly_godas_extract = [future.result() for future in futures]
         full_godas_extract = xr.concat(all_monthly_godas_extract, dim='time')
         full_godas_extract = full_godas_extract.rename(level='depth')
-        full_godas_extract['pottmp'] = full_godas_extract.pottmp - 273.15
-        full_godas_extract.pottmp.to_dataset().to_netcdf('%s'%(file_name))
-    else:
-        print("Data already downloaded")
-    return file_name
+        full_godas_extract = full_godas_extract - 273.15
+        full_godas_extract.rename('pottmp').to_dataset().to_netcdf(file_name)
+
+    key = cache.climatology_key(nearest_longitude, nearest_latitude, max_depth)
+    return cache.get_climatology(key, download, cache_dir=cache_dir)
+
+def godas_year_path(year, source=None):
+    """
+    Path or URL of the GODAS potential temperature file of a year
+
+    Parameters
+    ----------
+    year : int
+        Year of the file
+    source : String
+        Either a directory holding local pottmp.YYYY.nc files, or a path or
+        URL template where %s is replaced by the year. If None, the 
+        COLDPULSE_GODAS_SOURCE environment variable, or the NOAA PSL 
+        OPeNDAP server if it is not set.
+
+    Returns
+    -------
+    path : String
+        Path or URL of the file
+    """
+    if source is None:
+        source = os.environ.get('COLDPULSE_GODAS_SOURCE', GODAS_OPENDAP_URL)
+    if '%s' in source:
+        return source%year
+    return os.path.join(source, 'pottmp.%s.nc'%year)
+
+def godas_executor(path, workers=8):
+    """
+    Executor and xarray engine reading yearly GODAS files concurrently
+
+    The default netCDF4 engine holds a lock shared by all the threads of a
+    process while it opens or reads a file, so threads only overlap the
+    rest of the work. Local files are still read by threads, as reading a
+    column only takes a few tens of milliseconds: the 40 files took 1.5 s
+    one after the other, 0.7 s with 8 threads and 17 s with 8 new processes
+    on one core. Over OPeNDAP, reads mostly wait for the server and use the
+    pydap engine, which has no such lock.
+
+    Parameters
+    ----------
+    path : String
+        Path or URL of a yearly GODAS file of the source
+    workers : int
+        Number of yearly files read concurrently
+
+    Returns
+    -------
+    executor : concurrent.futures.ThreadPoolExecutor
+        Executor of extract_godas_year
+    engine : String
+        Engine of xarray.open_dataset, None for the default one
+    """
+    if path.startswith(('http://', 'https://')):
+        return ThreadPoolExecutor(max_workers=workers), 'pydap'
+    return ThreadPoolExecutor(max_workers=workers), None
+
+def extract_godas_year(path, nearest_longitude, nearest_latitude, engine=None):
+    """
+    Extracts the potential temperature column of a grid point from a yearly
+    GODAS file. Only this column is read.
+
+    Parameters
+    ----------
+    path : String
+        Path or URL of the yearly GODAS file
+    nearest_longitude : float
+        Longitude of the GODAS grid point
+    nearest_latitude : float
+        Latitude of the GODAS grid point
+    engine : String
+        Engine of xarray.open_dataset, None for the default one
+
+    Returns
+    -------
+    column : xarray DataArray
+        Monthly potential temperature (K) with dimensions (time, level)
+    """
+    with xr.open_dataset(path, engine=engine) as monthly_godas:
+        column = monthly_godas.pottmp.sel(lon=nearest_longitude,
+                                          lat=nearest_latitude,
+                                          method='nearest').load()
+    return column.dropna('level')
     
-def make_tsi_threshold_from_climatology(darray, input_dir):
+def make_tsi_threshold_from_climatology(darray, input_dir, cache_dir=None,
+                                        source=None):
     """
     Compute TSI threshold using NCEP-GODAS, 40 year cimatological mean and std
 
+    The threshold is memoized in the cache for each GODAS grid point and set
+    of logger depths.
+
     Parameters
     ----------
     darray : xarray DataArray
         Input temperature data
-    lon : float
-        Longitude of the location studied
-    lat : float
-        Latitude of the location studied
+    input_dir : String
+        Path of the input directory
+    cache_dir : String
+        Cache directory, see coldpulse.cache.default_cache_dir
+    source : String
+        Source of the yearly GODAS files, see godas_year_path
+
+    Returns
+    -------
+    threshold : float
+        TSI threshold computed from NCEP-GODAS climatology
+
+    """
+    return station_threshold(float(darray.longitude.values),
+                             float(darray.latitude.values),
+                             darray.depth.values, cache_dir=cache_dir,
+                             source=source)
+
+def station_threshold(longitude, latitude, depths, cache_dir=None,
+                      source=None):
+    """
+    Compute the TSI threshold of a station from the NCEP-GODAS climatology
+    of its nearest grid point
+
+    Parameters
+    ----------
+    longitude : float
+        Longitude of the station
+    latitude : float
+        Latitude of the station
+    depths : numpy 1d array
+        Depths of the loggers
+    cache_dir : String
+        Cache directory, see coldpulse.cache.default_cache_dir
+    source : String
+        Source of the yearly GODAS files, see godas_year_path
 
     Returns
     -------
@@ -145,12 +346,366 @@ def make_tsi_threshold_from_climatology(darray, input_dir):
         TSI threshold computed from NCEP-GODAS climatology
 
     """
-    max_depth = darray.depth.max().values
-    longitude = darray.longitude.values
-    latitude = darray.latitude.values
-    godas_data_file_name = extract_data_online_godas(longitude, latitude, max_depth, input_dir)
-    godas_ocean_temp = xr.open_dataarray(godas_data_file_name)
-    local_temp = godas_ocean_temp.interp(depth=darray.depth)      
-    phi = compute_temperature_stratification_index(local_temp)
-    threshold = (phi.mean()-phi.std()).values
+    depths = np.asarray(depths, dtype=float)
+    nearest_longitude, nearest_latitude = find_nearest_nonnan_neigbour(longitude,
+                                                                       latitude,
+                                                                       depths.max())
+    return grid_point_threshold(nearest_longitude, nearest_latitude, depths,
+                                cache_dir=cache_dir, source=source)
+
+def start_station_threshold(input_dir, cache_dir=None, source=None):
+    """
+    Starts computing the GODAS threshold of the station of input_dir in a
+    background thread. The location and depths of the station are taken
+    from the names of its csv files, so that the climatology is looked up,
+    and downloaded if needed, while the files are read.
+
+    Parameters
+    ----------
+    input_dir : String
+        Path of the input directory which contains csv files
+    cache_dir : String
+        Cache directory, see coldpulse.cache.default_cache_dir
+    source : String
+        Source of the yearly GODAS files, see godas_year_path
+
+    Returns
+    -------
+    threshold : concurrent.futures.Future
+        Future TSI threshold, which make_tsi_threshold waits for. Errors
+        are raised when it is waited for.
+
+    """
+    list_csv_files, depths_dict, (location_id, longitude, latitude) = \
+        list_station_files(input_dir)
+    executor = ThreadPoolExecutor(max_workers=1,
+                                  thread_name_prefix='coldpulse-threshold')
+    threshold = executor.submit(station_threshold, longitude, latitude,
+                                logger_depths(list_csv_files, depths_dict),
+                                cache_dir=cache_dir, source=source)
+    # The thread ends once the threshold is computed
+    executor.shutdown(wait=False)
+    return threshold
+
+def stop_station_threshold(threshold):
+    """
+    Cancels a threshold of start_station_threshold which was not waited
+    for, as when reading the csv files failed. If it is already being
+    computed, waits for it so that no download is left running; its result
+    and errors are discarded. Other thresholds are ignored.
+
+    Parameters
+    ----------
+    threshold : String, float, numpy 1d array or Future
+        Threshold passed to make_tsi_threshold
+    """
+    if isinstance(threshold, Future) and not threshold.cancel():
+        wait([threshold])
+
+def make_tsi_thresholds_for_sites(darray, cache_dir=None, source=None):
+    """
+    Compute the TSI threshold of each site of a (site, depth, time)
+    DataArray from the NCEP-GODAS climatology. Sites sharing their nearest
+    GODAS grid point share their threshold, computed once.
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Input temperature data, with longitude and latitude coordinates
+        along the site dimension
+    cache_dir : String
+        Cache directory, see coldpulse.cache.default_cache_dir
+    source : String
+        Source of the yearly GODAS files, see godas_year_path
+
+    Returns
+    -------
+    thresholds : numpy 1d array
+        TSI threshold of each site
+
+    """
+    depths = darray.depth.values
+    nearest_longitudes, nearest_latitudes, distances = \
+        find_nearest_nonnan_neighbours(darray.longitude.values,
+                                       darray.latitude.values,
+                                       depths.max())
+    if (distances > 100).any():
+        print("!!!CAREFUL!!! The nearest GODAS gridpoint of %d sites is more "
+              "than 100km away, results may not be great."%(distances > 100).sum())
+    grid_points, site_grid_point = \
+        np.unique(np.stack([nearest_longitudes, nearest_latitudes], axis=-1),
+                  axis=0, return_inverse=True)
+    thresholds = np.array([grid_point_threshold(nearest_longitude,
+                                                nearest_latitude,
+                                                depths,
+                                                cache_dir=cache_dir,
+                                                source=source)
+                           for nearest_longitude, nearest_latitude in grid_points])
+    return thresholds[site_grid_point.reshape(-1)]
+
+def grid_point_threshold(nearest_longitude, nearest_latitude, depths,
+                         cache_dir=None, source=None):
+    """
+    TSI threshold of a set of logger depths at a GODAS grid point, mean
+    minus standard deviation of the TSI of its climatology. The threshold
+    is memoized in the cache.
+
+    Parameters
+    ----------
+    nearest_longitude : float
+        Longitude of the GODAS grid point
+    nearest_latitude : float
+        Latitude of the GODAS grid point
+    depths : numpy 1d array
+        Depths of the loggers
+    cache_dir : String
+        Cache directory, see coldpulse.cache.default_cache_dir
+    source : String
+        Source of the yearly GODAS files, see godas_year_path
+
+    Returns
+    -------
+    threshold : float
+        TSI threshold
+
+    """
+    max_depth = depths.max()
+    key = cache.climatology_key(nearest_longitude, nearest_latitude, max_depth)
+    threshold = cache.get_threshold(key, depths, cache_dir=cache_dir)
+    if threshold is not None:
+        return threshold
+    godas_data_file_name = get_godas_climatology(nearest_longitude, 
+                                                 nearest_latitude,
+                                                 max_depth,
+                                                 cache_dir=cache_dir,
+                                                 source=source)
+    with xr.open_dataarray(godas_data_file_name) as godas_ocean_temp:
+        local_temp = godas_ocean_temp.interp(depth=xr.DataArray(depths,
+                                                                dims='depth',
+                                                                coords=dict(depth=depths)))
+        phi = compute_temperature_stratification_index(local_temp)
+        threshold = float(phi.mean()-phi.std())
+    cache.store_threshold(key, depths, threshold, cache_dir=cache_dir)
     return threshold
+
+# =============================================================================
+# Thresholds from the record itself
+# =============================================================================
+
+def make_tsi_threshold(darray, input_dir, threshold='godas', phi=None,
+                       window_days=30):
+    """
+    TSI threshold of a record, from the NCEP-GODAS climatology or from the
+    TSI of the record itself, which needs no internet access
+
+    Parameters
+    ----------
+    darray : xarray DataArray
+        Input temperature data with dimensions (depth, time)
+    input_dir : String
+        Path of the input directory
+    threshold : String, float, numpy 1d array or Future
+        One of THRESHOLD_METHODS:
+        - 'godas': mean minus standard deviation of the TSI of the GODAS
+          climatology, see make_tsi_threshold_from_climatology,
+        - 'global': mean minus standard deviation of the TSI of the record,
+        - 'rolling': the same over a centered window of window_days days,
+          one threshold per time step,
+        - 'seasonal': the same over the time steps of all years within
+          window_days days of the day of year, one threshold per time step.
+        A float, or an array with one threshold per time step, is returned
+        as is, and the result of a Future from start_station_threshold is
+        waited for.
+    phi : numpy 1d array
+        Precomputed TSI of darray
+    window_days : float
+        Length of the window of 'rolling' and 'seasonal' thresholds in days
+
+    Returns
+    -------
+    threshold : float or numpy 1d array
+        TSI threshold, or threshold of each time step
+
+    """
+    if isinstance(threshold, Future):
+        return threshold.result()
+    if not isinstance(threshold, str):
+        return threshold
+    assert threshold in THRESHOLD_METHODS,\
+        "Unknown threshold %s, use one of %s or a number."%(threshold, THRESHOLD_METHODS)
+    if threshold == 'godas':
+        return make_tsi_threshold_from_climatology(darray, input_dir)
+    if phi is None:
+        darray = darray.transpose('depth', 'time')
+        phi = stratification_index(darray.values, darray.depth.values)
+    if threshold == 'global':
+        return record_threshold(phi)
+    if threshold == 'rolling':
+        time_step = darray.time.diff('time').values[0].astype('timedelta64[ns]').astype(np.int64)
+        window = max(int(round(window_days*86400e9/time_step)), 1)
+        return rolling_threshold(phi, window)
+    return seasonal_threshold(phi, darray.time.values, window_days=window_days)
+
+def record_threshold(phi):
+    """
+    TSI threshold of a record, mean minus standard deviation of its TSI
+
+    Parameters
+    ----------
+    phi : numpy 1d array
+        TSI of the record, NaN values being skipped
+
+    Returns
+    -------
+    threshold : float
+        TSI threshold
+    """
+    phi = np.asarray(phi, dtype=float)
+    mean, std = running_moments(phi, np.array([0]), np.array([phi.size]))
+    return float(mean[0] - std[0])
+
+def chunked_record_threshold(phi_chunks):
+    """
+    TSI threshold of a record read by chunks, mean minus standard deviation
+    of its TSI as record_threshold, up to rounding. The number of values,
+    mean and sum of squared deviations of each chunk are merged with those
+    of the previous ones, so only one chunk is in memory at once.
+
+    Parameters
+    ----------
+    phi_chunks : iterable of numpy 1d arrays
+        TSI of consecutive parts of the record, NaN values being skipped
+
+    Returns
+    -------
+    threshold : float
+        TSI threshold, NaN if there is no valid TSI value
+    """
+    count, mean, squared_deviations = 0, 0., 0.
+    for phi in phi_chunks:
+        phi = np.asarray(phi, dtype=float)
+        phi = phi[~np.isnan(phi)]
+        if phi.size == 0:
+            continue
+        chunk_mean = phi.mean()
+        delta = chunk_mean - mean
+        total = count + phi.size
+        mean += delta*phi.size/total
+        squared_deviations += ((phi - chunk_mean)**2).sum() \
+                            + delta*delta*count*phi.size/total
+        count = total
+    if count == 0:
+        return np.nan
+    return float(mean - np.sqrt(squared_deviations/count))
+
+def rolling_threshold(phi, window):
+    """
+    TSI threshold of each time step, mean minus standard deviation of the
+    TSI over a centered window. Computed in a single pass over phi whatever
+    the window length.
+
+    Parameters
+    ----------
+    phi : numpy 1d array
+        TSI of the record, NaN values being skipped
+    window : int
+        Number of time steps of the window. Windows are truncated at both
+        ends of the record.
+
+    Returns
+    -------
+    thresholds : numpy 1d array
+        TSI threshold of each time step, NaN if its window has no valid
+        TSI value
+    """
+    phi = np.asarray(phi, dtype=float)
+    size = phi.size
+    window_starts = np.clip(np.arange(size) - window//2, 0, size)
+    window_ends = np.clip(np.arange(size) + window - window//2, 0, size)
+    mean, std = running_moments(phi, window_starts, window_ends)
+    return mean - std
+
+def seasonal_threshold(phi, time, window_days=30):
+    """
+    TSI threshold of each time step, mean minus standard deviation of the
+    TSI of the time steps of all years within window_days days of its day
+    of year. Computed in a single pass over phi.
+
+    Parameters
+    ----------
+    phi : numpy 1d array
+        TSI of the record, NaN values being skipped
+    time : numpy 1d array
+        Time of each TSI value, as datetime64
+    window_days : int
+        Number of days of year pooled around each day of year
+
+    Returns
+    -------
+    thresholds : numpy 1d array
+        TSI threshold of each time step, NaN if no valid TSI value falls in
+        its window
+    """
+    phi = np.asarray(phi, dtype=float)
+    time = np.asarray(time, dtype='datetime64[ns]')
+    day_of_year = (time - time.astype('datetime64[Y]')).astype('timedelta64[D]').astype(int)
+    is_valid = ~np.isnan(phi)
+    offset = np.nanmean(phi) if is_valid.any() else 0.
+    values = np.where(is_valid, phi - offset, 0.)
+    daily_sums = np.stack([np.bincount(day_of_year, weights=weights, minlength=366)
+                           for weights in (is_valid, values, values*values)])
+    # Windows of days wrap around the end of the year
+    window_days = min(max(int(window_days), 1), 366)
+    days = np.arange(366)
+    window_starts = days - window_days//2
+    cumulative = np.concatenate([np.zeros((3, 1)),
+                                 np.cumsum(np.concatenate([daily_sums]*3, axis=1), axis=1)],
+                                axis=1)
+    window_sums = cumulative[:, window_starts + 366 + window_days] \
+                - cumulative[:, window_starts + 366]
+    mean, std = moments_from_sums(*window_sums)
+    return (mean + offset - std)[day_of_year]
+
+def running_moments(series, window_starts, window_ends):
+    """
+    Mean and standard deviation of the non NaN values of series over
+    windows, from cumulative sums of counts, values and squared values.
+    Values are centered on their mean first, so that the variance does not
+    lose precision when the mean is large compared to the variability.
+
+    Parameters
+    ----------
+    series : numpy 1d array
+        Values, NaN values being skipped
+    window_starts : numpy 1d array
+        Index of the first value of each window
+    window_ends : numpy 1d array
+        Index after the last value of each window
+
+    Returns
+    -------
+    mean : numpy 1d array
+        Mean of each window, NaN if it has no valid value
+    std : numpy 1d array
+        Population standard deviation of each window
+    """
+    is_valid = ~np.isnan(series)
+    offset = np.nanmean(series) if is_valid.any() else 0.
+    values = np.where(is_valid, series - offset, 0.)
+    cumulative = np.zeros((3, series.size + 1))
+    np.cumsum(is_valid, out=cumulative[0, 1:])
+    np.cumsum(values, out=cumulative[1, 1:])
+    np.cumsum(values*values, out=cumulative[2, 1:])
+    window_sums = cumulative[:, window_ends] - cumulative[:, window_starts]
+    mean, std = moments_from_sums(*window_sums)
+    return mean + offset, std
+
+def moments_from_sums(count, total, total_squares):
+    """
+    Mean and population standard deviation from the number of values, their
+    sum and the sum of their squares
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total/count
+        variance = np.maximum(total_squares/count - mean*mean, 0)
+    return mean, np.sqrt(variance)
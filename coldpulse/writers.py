@@ -0,0 +1,330 @@
+"""
+Writers of the outputs of a station.
+
+A writer receives the subpulse table, the pulse table and the series
+Dataset of a station and saves them:
+- DirectoryWriter saves each station in its own directory, with tables as
+  csv or Parquet and series as NetCDF4 or Zarr, compressed and chunked.
+- SiteStoreWriter appends every station to one shared store: Parquet
+  tables with a 'site' column and a Zarr store of series along a 'site'
+  dimension, laid out as a CF contiguous ragged array.
+- CollectingWriter keeps the outputs in memory, for another writer.
+With background=True, writes run in a thread so that they overlap with the
+processing of the next station.
+
+Parquet needs pyarrow or fastparquet, and Zarr needs zarr.
+"""
+import os
+import abc
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import xarray as xr
+from .outputs import dense_series_dataset, LOCATION_NAMES
+from . import cache
+
+TABLE_FORMATS = ['csv', 'parquet']
+SERIES_FORMATS = ['netcdf', 'zarr']
+
+
+class OutputWriter(abc.ABC):
+    """
+    Base class of writers, subclasses implement write_station
+
+    Parameters
+    ----------
+    background : bool
+        If True, write returns at once and the station is written in a
+        background thread, one station at a time. flush or close wait for
+        pending writes.
+    """
+    def __init__(self, background=False):
+        self.background = background
+        self.executor = None
+        self.pending = []
+
+    def write(self, input_dir, df_subpulse, df_pulse, ds_output):
+        """
+        Writes the outputs of a station
+
+        Parameters
+        ----------
+        input_dir   : String
+            Input directory of the station
+        df_subpulse : pandas DataFrame
+            Subpulse table
+        df_pulse    : pandas DataFrame
+            Pulse table
+        ds_output   : xarray Dataset
+            Series Dataset
+        """
+        if not self.background:
+            self.write_station(input_dir, df_subpulse, df_pulse, ds_output)
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        # Errors of earlier writes are raised as soon as they are known
+        done = [future for future in self.pending if future.done()]
+        self.pending = [future for future in self.pending if not future.done()]
+        for future in done:
+            future.result()
+        self.pending.append(self.executor.submit(self.write_station, input_dir,
+                                                 df_subpulse, df_pulse,
+                                                 ds_output))
+
+    @abc.abstractmethod
+    def write_station(self, input_dir, df_subpulse, df_pulse, ds_output):
+        """
+        Writes the outputs of a station at once, with the parameters of
+        write
+        """
+
+    def flush(self):
+        """
+        Waits for all pending writes, and raises the first error if any
+        """
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        """
+        Waits for all pending writes and stops the background thread
+        """
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def __getstate__(self):
+        # Writers are sent to worker processes without their thread
+        state = self.__dict__.copy()
+        state['executor'] = None
+        state['pending'] = []
+        return state
+
+class DirectoryWriter(OutputWriter):
+    """
+    Saves each station in a directory, [input_dir]_TSI_out by default
+
+    Parameters
+    ----------
+    dir_name      : String
+        Output directory of all stations. '[input_dir]_TSI_out' if None.
+    table_format  : String
+        'csv' or 'parquet'
+    series_format : String
+        'netcdf' or 'zarr'
+    complevel     : int
+        Compression level of the series, 0 for no compression. If None,
+        series are written with default settings, as save_output does.
+    chunk_size    : int
+        Chunk length of the series along time
+    background    : bool
+        Writes in a background thread, see OutputWriter
+    """
+    def __init__(self, dir_name=None, table_format='csv', series_format='netcdf',
+                 complevel=4, chunk_size=2**16, background=False):
+        OutputWriter.__init__(self, background=background)
+        assert table_format in TABLE_FORMATS,\
+            "Unknown table format %s, use one of %s."%(table_format, TABLE_FORMATS)
+        assert series_format in SERIES_FORMATS,\
+            "Unknown series format %s, use one of %s."%(series_format, SERIES_FORMATS)
+        self.dir_name = dir_name
+        self.table_format = table_format
+        self.series_format = series_format
+        self.complevel = complevel
+        self.chunk_size = chunk_size
+
+    def write_station(self, input_dir, df_subpulse, df_pulse, ds_output):
+        dir_name = self.dir_name
+        if dir_name is None:
+            dir_name = '%s_TSI_out'%os.path.normpath(input_dir)
+        os.makedirs(dir_name, exist_ok=True)
+        prefix = os.path.join(dir_name, station_name(input_dir))
+        write_table(df_pulse, '%s_pulse_stats_'%prefix, self.table_format)
+        write_table(df_subpulse, '%s_subpulse_stats_'%prefix, self.table_format)
+        encoding = series_encoding(ds_output, self.series_format,
+                                   self.complevel, self.chunk_size)
+        if self.series_format == 'netcdf':
+            ds_output.to_netcdf('%s_pulse_series_.nc'%prefix, encoding=encoding)
+        else:
+            ds_output.to_zarr('%s_pulse_series_.zarr'%prefix, mode='w',
+                              encoding=encoding)
+
+class SiteStoreWriter(OutputWriter):
+    """
+    Appends all stations to a shared store in the directory path:
+    - pulse_stats/[site].parquet and subpulse_stats/[site].parquet, tables
+      with a 'site' column, which can be read at once with
+      pandas.read_parquet('[path]/pulse_stats'). Sites are named by
+      site_key, and a station already in the store is not written again.
+    - series.zarr, with a 'site' dimension (site name, location, number of
+      time steps) and an 'obs' dimension holding the time steps of all
+      sites one after the other (CF contiguous ragged array). Temperature
+      data is not copied to the store.
+    Appends are made under a lock, so that stations processed in parallel
+    can share a store.
+
+    Parameters
+    ----------
+    path       : String
+        Directory of the store
+    chunk_size : int
+        Chunk length of the series along 'obs'
+    background : bool
+        Writes in a background thread, see OutputWriter
+    """
+    def __init__(self, path, chunk_size=2**16, background=False):
+        OutputWriter.__init__(self, background=background)
+        self.path = path
+        self.chunk_size = chunk_size
+
+    def write_station(self, input_dir, df_subpulse, df_pulse, ds_output):
+        if 'sample' in ds_output.dims:
+            ds_output = dense_series_dataset(ds_output)
+        site = site_key(input_dir, ds_output)
+        location = [float(ds_output[name]) if name in ds_output.coords else np.nan
+                    for name in ['longitude', 'latitude']]
+        ds_obs = xr.Dataset(dict([(name, ('obs', variable.values))
+                                  for name, variable in ds_output.data_vars.items()
+                                  if variable.dims == ('time',)]))
+        ds_obs['time'] = ('obs', ds_output.time.values)
+        ds_site = xr.Dataset(dict(site_name = ('site', np.array([site], dtype=object)),
+                                  longitude = ('site', location[:1]),
+                                  latitude = ('site', location[1:]),
+                                  row_size = ('site', [ds_obs.sizes['obs']])))
+        ds_site.row_size.attrs['sample_dimension'] = 'obs'
+        store = os.path.join(self.path, 'series.zarr')
+        os.makedirs(self.path, exist_ok=True)
+        with cache.cache_lock(self.path, name='series', stale_after=600):
+            table_paths = [os.path.join(self.path, name, site)
+                           for name in ['pulse_stats', 'subpulse_stats']]
+            assert not any(os.path.exists('%s.parquet'%path) for path in table_paths),\
+                "The station %s of %s is already in the store %s."%(site, input_dir,
+                                                                     self.path)
+            for path, dataframe in zip(table_paths, [df_pulse, df_subpulse]):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                write_table(dataframe.assign(site=site), path, 'parquet')
+            if os.path.exists(store):
+                ds_site.to_zarr(store, group='site', append_dim='site')
+                ds_obs.to_zarr(store, group='obs', append_dim='obs')
+            else:
+                ds_site.to_zarr(store, group='site', mode='w')
+                ds_obs.to_zarr(store, group='obs', mode='a',
+                               encoding=series_encoding(ds_obs, 'zarr', None,
+                                                        self.chunk_size))
+
+class CollectingWriter(OutputWriter):
+    """
+    Keeps the outputs of each station in its outputs list instead of
+    writing them, e.g. for a worker process to send them back to the
+    process which writes them, see batch.run_batch
+    """
+    def __init__(self):
+        OutputWriter.__init__(self)
+        self.outputs = []
+
+    def write_station(self, input_dir, df_subpulse, df_pulse, ds_output):
+        self.outputs.append((input_dir, df_subpulse, df_pulse, ds_output))
+
+def open_site_store(path):
+    """
+    Opens the series of a SiteStoreWriter store
+
+    Parameters
+    ----------
+    path : String
+        Directory of the store
+
+    Returns
+    -------
+    ds_site : xarray Dataset
+        Sites, with the number of time steps of each one in row_size
+    ds_obs  : xarray Dataset
+        Time steps of all sites, with a site_index variable
+    """
+    store = os.path.join(path, 'series.zarr')
+    ds_site = xr.open_zarr(store, group='site')
+    ds_obs = xr.open_zarr(store, group='obs')
+    site_index = np.repeat(np.arange(ds_site.sizes['site']), ds_site.row_size.values)
+    return ds_site, ds_obs.assign(site_index=('obs', site_index))
+
+# =============================================================================
+# Writer side functions
+# =============================================================================
+
+def station_name(input_dir):
+    """
+    Name of a station in output file names: the last component of its input
+    directory
+    """
+    return os.path.basename(os.path.normpath(input_dir))
+
+def site_key(input_dir, ds_output):
+    """
+    Name of a station in a shared store: locationID_longitude_latitude as
+    in the names of its csv files, or if ds_output has no location, the last
+    component of its input directory and a hash of its absolute path, so
+    that stations in directories of the same name do not collide
+    """
+    if all(name in ds_output.coords for name in LOCATION_NAMES):
+        return '%s_%s_%s'%tuple(ds_output[name].values.item()
+                                for name in LOCATION_NAMES)
+    digest = hashlib.sha256(os.path.abspath(input_dir).encode()).hexdigest()
+    return '%s_%s'%(station_name(input_dir), digest[:12])
+
+def write_table(dataframe, path, table_format):
+    """
+    Writes a table as [path].csv or [path].parquet
+    """
+    if table_format == 'csv':
+        dataframe.to_csv('%s.csv'%path)
+    else:
+        dataframe.to_parquet('%s.parquet'%path)
+
+def series_encoding(ds_output, series_format, complevel, chunk_size):
+    """
+    Encoding of the series Dataset: chunks of chunk_size time steps, and
+    zlib compression for NetCDF
+
+    Parameters
+    ----------
+    ds_output     : xarray Dataset
+        Series Dataset
+    series_format : String
+        'netcdf' or 'zarr'
+    complevel     : int
+        NetCDF zlib compression level, 0 for no compression. Default
+        encoding if None.
+    chunk_size    : int
+        Chunk length along the longest dimension of each variable
+
+    Returns
+    -------
+    encoding : dict
+        Encoding of each data variable
+    """
+    encoding = dict()
+    if series_format == 'netcdf' and complevel is None:
+        return encoding
+    for name, variable in ds_output.data_vars.items():
+        if variable.ndim == 0 or variable.dtype.kind not in 'fiub':
+            continue
+        longest = int(np.argmax(variable.shape))
+        chunks = list(variable.shape)
+        chunks[longest] = max(min(chunk_size, chunks[longest]), 1)
+        if series_format == 'netcdf':
+            encoding[name] = dict(zlib=complevel > 0, complevel=complevel,
+                                  chunksizes=tuple(chunks))
+        else:
+            encoding[name] = dict(chunks=tuple(chunks))
+    return encoding
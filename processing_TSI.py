@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
-from coldpulse import coldpulse
+from coldpulse import batch
 
 list_input_dir = ['run']
-for input_dir in list_input_dir:
-    coldpulse.upwelling_cold_pulses_detection(input_dir)
+if __name__ == '__main__':
+    batch.run_batch(list_input_dir, workers=None,
+                    manifest_path='coldpulse_manifest.csv')
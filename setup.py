@@ -20,16 +20,20 @@ setup(
     long_description_content_type="text/markdown",
     install_requires=['numpy', 'scipy', 'xarray', 
                       'pandas', 'netcdf4', 'pydap', 
-                      'dask', 'tqdm', 'h5netcdf',
-                      'haversine'],
+                      'dask', 'tqdm', 'h5netcdf'],
+    extras_require={'parquet': ['pyarrow'],
+                    'zarr': ['zarr']},
     url="https://github.com/rguilcas/coldpulses",
     include_package_data=True,
     package_data={'': ['data/*.nc']},
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests']),
+    entry_points={
+        'console_scripts': ['coldpulse-batch=coldpulse.batch:main'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
         "Operating System :: OS Independent",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.9',
 )
@@ -0,0 +1,7 @@
+"""
+Regression tests of the detection.
+
+The reference outputs in data/baseline.npz were computed by the original
+DataArray based detection on the synthetic moorings of reference.CASES, see
+make_reference.py. Run the tests with python -m pytest tests.
+"""
@@ -0,0 +1,10 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    """
+    Binary cache of the csv files of each test in its temporary directory
+    """
+    monkeypatch.setenv('COLDPULSE_CACHE_DIR', str(tmp_path/'cache'))
+    return tmp_path/'cache'
@@ -0,0 +1,87 @@
+"""
+Computes the reference outputs of the regression tests with the original
+DataArray based detection.
+
+The synthetic moorings are made with this version of coldpulse, then the
+detection of the checkout given on the command line is imported in its
+place:
+
+    python -m tests.make_reference path/to/original/checkout
+"""
+import os
+import sys
+import argparse
+import numpy as np
+from .reference import CASES, FLAG_VALUES, REFERENCE_PATH, make_case, flags_key
+
+
+def reference_arrays(darray, detection, outputs):
+    """
+    Reference outputs of a case, as stored in the reference file
+
+    Parameters
+    ----------
+    darray    : xarray DataArray
+        Temperature data
+    detection : module
+        coldpulse.detection of the original checkout
+    outputs   : module
+        coldpulse.outputs of the original checkout
+
+    Returns
+    -------
+    arrays : dict of numpy arrays
+        Reference outputs, see reference.load_reference
+    """
+    phi = detection.compute_temperature_stratification_index(darray)
+    threshold = float(phi.mean() - phi.std())
+    starts, ends = detection.get_potential_pulses_start_end_from_TSI(darray,
+                                                                    threshold=threshold)
+    arrays = dict(threshold=np.array(threshold), starts=starts, ends=ends)
+    for values in FLAG_VALUES:
+        arrays['starts_%s'%flags_key(values)] = \
+            detection.shift_starts(starts, ends, darray, phi, *values)
+    filtered_starts, filtered_ends = \
+        detection.remove_potential_pulse_if_not_from_bottom_logger(
+            arrays['starts_1101'], ends, darray, phi)
+    arrays['filtered_starts'] = filtered_starts
+    arrays['filtered_ends'] = filtered_ends
+    for values in FLAG_VALUES:
+        arrays['ends_%s'%flags_key(values)] = \
+            detection.shift_ends(filtered_ends, darray, phi, *values)
+    df_subpulse, ds_output, df_pulse = outputs.prepare_output(darray,
+                                                              filtered_starts,
+                                                              arrays['ends_1111'])
+    for table, dataframe in [('subpulses', df_subpulse), ('pulses', df_pulse)]:
+        for column in dataframe.columns:
+            values = dataframe[column].values
+            if values.dtype == object:
+                # Columns of mixed integers and NaN
+                values = values.astype(float)
+            arrays['%s/%s'%(table, column)] = values
+    arrays.update([('series/%s'%name, ds_output[name].values)
+                   for name in ['dch', 'drops', 'min_temp', 'pulse_temp']])
+    return arrays
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m tests.make_reference',
+        description='Computes the reference outputs of the regression tests.')
+    parser.add_argument('checkout',
+                        help='directory of the original coldpulse checkout')
+    arguments = parser.parse_args(argv)
+    darrays = dict([(name, make_case(name)) for name in CASES])
+    for module in [name for name in sys.modules
+                   if name == 'coldpulse' or name.startswith('coldpulse.')]:
+        del sys.modules[module]
+    sys.path.insert(0, os.path.abspath(arguments.checkout))
+    from coldpulse import detection, outputs
+    arrays = dict()
+    for name, darray in darrays.items():
+        arrays.update([('%s/%s'%(name, key), value) for key, value
+                       in reference_arrays(darray, detection, outputs).items()])
+    os.makedirs(os.path.dirname(REFERENCE_PATH), exist_ok=True)
+    np.savez_compressed(REFERENCE_PATH, **arrays)
+
+if __name__ == '__main__':
+    main()
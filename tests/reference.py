@@ -0,0 +1,102 @@
+"""
+Synthetic moorings of the regression tests and their reference outputs.
+"""
+import os
+import itertools
+from functools import lru_cache
+import numpy as np
+from coldpulse.synthetic import make_mooring
+
+REFERENCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'data', 'baseline.npz')
+# Keyword arguments of synthetic.make_mooring of each case
+CASES = dict(default = dict(n_samples=8000, seed=0),
+             missing = dict(n_samples=8000, seed=1, nan_fraction=0.002),
+             coarse = dict(n_samples=8000, seed=2, resolution=0.1),
+             chain = dict(n_samples=6000, seed=3,
+                          depths=tuple(np.arange(2., 34., 2.))))
+# Every combination of the four start or end criteria, in the order of
+# sweep.START_FLAGS and sweep.END_FLAGS
+FLAG_VALUES = list(itertools.product([True, False], repeat=4))
+TABLES = ['subpulses', 'pulses', 'series']
+
+
+def make_case(name):
+    """
+    Temperature data of a case
+
+    Parameters
+    ----------
+    name : String
+        Name of the case in CASES
+
+    Returns
+    -------
+    darray : xarray DataArray
+        Temperature data with dimensions (depth, time)
+    """
+    darray, pulses = make_mooring(**CASES[name])
+    return darray
+
+def flags_key(values):
+    """
+    Part of the reference keys naming a combination of criteria, e.g. '1101'
+    """
+    return ''.join('%d'%value for value in values)
+
+@lru_cache(maxsize=None)
+def load_reference(name):
+    """
+    Reference outputs of a case
+
+    Parameters
+    ----------
+    name : String
+        Name of the case in CASES
+
+    Returns
+    -------
+    reference : dict
+        'threshold', the TSI threshold, and arrays of indexes: 'starts' and
+        'ends' of the potential pulses, 'starts_[flags]' shifted with each
+        combination of start criteria, 'filtered_starts' and
+        'filtered_ends' after the bottom logger filter, 'ends_[flags]'
+        shifted with each combination of end criteria. 'subpulses',
+        'pulses' and 'series' are dicts of the columns of the subpulse and
+        pulse tables and of the instantaneous series.
+    """
+    prefix = '%s/'%name
+    reference = dict([(table, dict()) for table in TABLES])
+    with np.load(REFERENCE_PATH) as arrays:
+        for key in arrays.files:
+            if not key.startswith(prefix):
+                continue
+            parts = key[len(prefix):].split('/')
+            if len(parts) == 2:
+                reference[parts[0]][parts[1]] = arrays[key]
+            else:
+                reference[parts[0]] = arrays[key]
+    reference['threshold'] = float(reference['threshold'])
+    return reference
+
+def assert_columns_equal(actual, expected):
+    """
+    Checks that the columns of a table match those of a reference table:
+    exactly for indexes and times, to 1e-9 relative for floats
+
+    Parameters
+    ----------
+    actual   : pandas DataFrame or dict of arrays
+        Table checked, which can have more columns than expected
+    expected : dict of arrays
+        Reference table
+    """
+    for column, expected_values in expected.items():
+        values = np.asarray(actual[column])
+        assert values.shape == expected_values.shape,\
+            "%s: %s values instead of %s."%(column, values.shape, expected_values.shape)
+        if expected_values.dtype.kind == 'f':
+            np.testing.assert_allclose(values, expected_values, rtol=1e-9,
+                                       err_msg=column)
+        else:
+            np.testing.assert_array_equal(values, expected_values, err_msg=column)
@@ -0,0 +1,41 @@
+"""
+Runs whose loggers are resampled on the common time grid with each
+alignment strategy.
+"""
+import os
+import pandas as pd
+import pytest
+from coldpulse.coldpulse import upwelling_cold_pulses_detection, detect
+from coldpulse.inputs import prepare_darray
+from coldpulse.synthetic import make_mooring, write_mooring
+
+
+@pytest.fixture
+def input_dir(tmp_path):
+    """
+    Station whose bottom logger samples every 30 s and the others every 2 min
+    """
+    darray = make_mooring(n_samples=4000, seed=0)[0]
+    fast_darray = make_mooring(n_samples=16000, time_step=30, seed=0)[0]
+    input_dir = str(tmp_path/'station')
+    write_mooring(darray.isel(depth=slice(None, -1)), input_dir)
+    write_mooring(fast_darray.isel(depth=[-1]), input_dir)
+    return input_dir
+
+@pytest.mark.parametrize('strategy', ['interp', 'mean'])
+def test_strategy(input_dir, strategy):
+    upwelling_cold_pulses_detection(input_dir, threshold='global',
+                                    strategy=strategy)
+    path = '%s_TSI_out/%s_pulse_stats_.csv'%(input_dir, os.path.basename(input_dir))
+    pulses = pd.read_csv(path, index_col=0)
+    expected = detect(prepare_darray(input_dir, strategy=strategy),
+                      threshold='global').pulses
+    columns = expected.select_dtypes('number').columns
+    pd.testing.assert_frame_equal(pulses[columns].reset_index(drop=True),
+                                  expected[columns].reset_index(drop=True),
+                                  check_dtype=False, check_exact=False)
+
+def test_incremental_strategy(input_dir):
+    with pytest.raises(AssertionError):
+        upwelling_cold_pulses_detection(input_dir, incremental=True,
+                                        strategy='mean')
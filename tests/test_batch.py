@@ -0,0 +1,42 @@
+"""
+Batch runs whose worker processes die.
+"""
+import os
+import pandas as pd
+import pytest
+from coldpulse import batch
+
+
+def detection_or_crash(input_dir, **kwargs):
+    """
+    Stands for upwelling_cold_pulses_detection in worker processes, killing
+    its process for directories named crash
+    """
+    if os.path.basename(input_dir) == 'crash':
+        os._exit(1)
+    return True
+
+@pytest.mark.skipif(os.name != 'posix', reason='workers inherit the patch by fork')
+def test_dead_worker(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'upwelling_cold_pulses_detection', detection_or_crash)
+    list_input_dir = [str(tmp_path/name) for name in ['a', 'crash', 'b', 'c']]
+    manifest_path = str(tmp_path/'manifest.csv')
+    manifest = batch.run_batch(list_input_dir, workers=2,
+                               manifest_path=manifest_path)
+    assert manifest.input_dir.tolist() == list_input_dir
+    assert manifest.status[1] == 'failed'
+    assert manifest.error[1].startswith('BrokenProcessPool')
+    assert set(manifest.status) <= {'done', 'failed'}
+    saved = pd.read_csv(manifest_path)
+    assert saved.status.tolist() == manifest.status.tolist()
+    assert saved.error[1] == manifest.error[1]
+
+def test_strategy_option(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(batch, 'upwelling_cold_pulses_detection',
+                        lambda input_dir, **kwargs: calls.append(kwargs) or True)
+    batch.main([str(tmp_path/'a'), '-j', '1', '-q', '--strategy', 'mean',
+                '-m', str(tmp_path/'manifest.csv')])
+    assert calls[0]['strategy'] == 'mean'
+    with pytest.raises(SystemExit):
+        batch.main([str(tmp_path/'a'), '--strategy', 'nearest'])
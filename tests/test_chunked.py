@@ -0,0 +1,31 @@
+"""
+Chunked detection compared with the original detection and with low-memory
+outputs.
+"""
+import xarray as xr
+import pytest
+from coldpulse.chunked import get_output_chunked
+from coldpulse.outputs import get_output
+from .reference import make_case, load_reference, assert_columns_equal
+
+CHUNKED_CASES = ['default', 'missing']
+
+
+@pytest.mark.parametrize('name', CHUNKED_CASES)
+@pytest.mark.parametrize('chunk_size, context_length', [(2, 1),
+                                                        (97, 1),
+                                                        (500, 50),
+                                                        (3000, 720),
+                                                        (10000, 720)])
+def test_chunked(name, chunk_size, context_length):
+    darray = make_case(name)
+    reference = load_reference(name)
+    df_subpulse, ds_output, df_pulse = get_output_chunked(darray,
+                                                          chunk_size=chunk_size,
+                                                          context_length=context_length,
+                                                          threshold=reference['threshold'])
+    assert_columns_equal(df_subpulse, reference['subpulses'])
+    assert_columns_equal(df_pulse, reference['pulses'])
+    expected = get_output(darray, None, low_memory=True,
+                          threshold=reference['threshold'])[1]
+    xr.testing.assert_identical(ds_output, expected)
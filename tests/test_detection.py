@@ -0,0 +1,49 @@
+"""
+Detection stages and outputs compared with the original detection.
+"""
+import numpy as np
+import pytest
+from coldpulse import engine
+from coldpulse.features import DetectionFeatures
+from coldpulse.outputs import get_output
+from coldpulse.sweep import START_FLAGS, END_FLAGS
+from .reference import (CASES, FLAG_VALUES, make_case, load_reference,
+                        flags_key, assert_columns_equal)
+
+
+@pytest.fixture(scope='module', params=list(CASES))
+def case(request):
+    darray = make_case(request.param)
+    return darray, load_reference(request.param)
+
+def test_stages(case):
+    darray, reference = case
+    features = DetectionFeatures.from_darray(darray)
+    starts, ends = engine.potential_pulses(features, reference['threshold'])
+    np.testing.assert_array_equal(starts, reference['starts'])
+    np.testing.assert_array_equal(ends, reference['ends'])
+    for values in FLAG_VALUES:
+        shifted_starts = engine.shift_starts(features, starts,
+                                             **dict(zip(START_FLAGS, values)))
+        np.testing.assert_array_equal(shifted_starts,
+                                      reference['starts_%s'%flags_key(values)],
+                                      err_msg=flags_key(values))
+    filtered_starts, filtered_ends = \
+        engine.remove_if_not_from_bottom_logger(features,
+                                                reference['starts_1101'], ends)
+    np.testing.assert_array_equal(filtered_starts, reference['filtered_starts'])
+    np.testing.assert_array_equal(filtered_ends, reference['filtered_ends'])
+    for values in FLAG_VALUES:
+        shifted_ends = engine.shift_ends(features, filtered_ends,
+                                         **dict(zip(END_FLAGS, values)))
+        np.testing.assert_array_equal(shifted_ends,
+                                      reference['ends_%s'%flags_key(values)],
+                                      err_msg=flags_key(values))
+
+def test_get_output(case):
+    darray, reference = case
+    df_subpulse, ds_output, df_pulse = get_output(darray, None,
+                                                  threshold=reference['threshold'])
+    assert_columns_equal(df_subpulse, reference['subpulses'])
+    assert_columns_equal(df_pulse, reference['pulses'])
+    assert_columns_equal(ds_output, reference['series'])
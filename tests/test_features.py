@@ -0,0 +1,43 @@
+"""
+Single pass features of thermistor chains compared with one reduction per
+feature and with the original detection.
+"""
+import numpy as np
+import pytest
+from coldpulse import engine
+from coldpulse.features import DetectionFeatures, chain_reductions
+from .reference import CASES, make_case, load_reference
+
+FEATURE_NAMES = ['phi', 'column_min', 'column_max', 'bottom_is_min',
+                 'bottom_is_max', 'phi_diff', 'bottom_temperature_diff']
+
+
+@pytest.mark.parametrize('name', list(CASES))
+def test_chain(name):
+    darray = make_case(name)
+    features = DetectionFeatures.from_darray(darray, chain=True)
+    features_no_chain = DetectionFeatures.from_darray(darray, chain=False)
+    for feature_name in FEATURE_NAMES:
+        np.testing.assert_array_equal(getattr(features, feature_name),
+                                      getattr(features_no_chain, feature_name),
+                                      err_msg=feature_name)
+
+@pytest.mark.parametrize('block_size', [1, 7, 4096])
+def test_block_sizes(block_size):
+    darray = make_case('chain')
+    features = DetectionFeatures.from_darray(darray, chain=False)
+    reductions = chain_reductions(features.temperature, features.depths,
+                                  features.index_bottom_logger,
+                                  block_size=block_size)
+    for feature_name, values in zip(FEATURE_NAMES, reductions):
+        np.testing.assert_array_equal(values, getattr(features, feature_name),
+                                      err_msg=feature_name)
+
+@pytest.mark.parametrize('chain', [True, False])
+def test_chain_detection(chain):
+    darray = make_case('chain')
+    reference = load_reference('chain')
+    features = DetectionFeatures.from_darray(darray, chain=chain)
+    starts, ends = engine.detect_pulses(features, reference['threshold'])
+    np.testing.assert_array_equal(starts, reference['filtered_starts'])
+    np.testing.assert_array_equal(ends, reference['ends_1111'])
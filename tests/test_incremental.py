@@ -0,0 +1,94 @@
+"""
+Incremental runs over rows appended to csv files, compared with a single run
+on the same files.
+"""
+import os
+import pandas as pd
+import xarray as xr
+import pytest
+from coldpulse.coldpulse import upwelling_cold_pulses_detection
+from coldpulse.outputs import get_output
+from coldpulse.inputs import prepare_darray
+from coldpulse.synthetic import write_mooring
+from coldpulse.profiling import QUIET
+from .reference import make_case, load_reference, assert_columns_equal
+
+
+def write_rows(darray, input_dir, start, stop):
+    """
+    Writes the time steps start to stop of darray as csv files, appended
+    to those of the earlier time steps
+    """
+    if start == 0:
+        write_mooring(darray[:, :stop], input_dir)
+        return
+    full_dir = '%s_full'%input_dir
+    write_mooring(darray[:, :stop], full_dir)
+    for file_name in os.listdir(full_dir):
+        with open(os.path.join(full_dir, file_name)) as full_file:
+            lines = full_file.readlines()
+        with open(os.path.join(input_dir, file_name), 'a') as file:
+            file.writelines(lines[start + 1:])
+
+def read_tables(input_dir):
+    output_dir = '%s_TSI_out'%input_dir
+    station = os.path.basename(input_dir)
+    return [pd.read_csv(os.path.join(output_dir, '%s_%s_stats_.csv'%(station, table)),
+                        index_col=0)
+            for table in ['subpulse', 'pulse']]
+
+def assert_single_run(input_dir, threshold):
+    """
+    Checks the outputs of incremental runs against a single run on the
+    final csv files
+    """
+    df_subpulse, ds_output, df_pulse = get_output(prepare_darray(input_dir,
+                                                                 profiler=QUIET),
+                                                  input_dir, threshold=threshold)
+    for table, expected in zip(read_tables(input_dir), [df_subpulse, df_pulse]):
+        assert_columns_equal(table, dict([(column, expected[column].values)
+                                          for column in expected.columns
+                                          if not column.endswith('_time')]))
+    ds_incremental = xr.load_dataset(os.path.join('%s_TSI_out'%input_dir,
+                                                  'station_pulse_series_.nc'))
+    assert_columns_equal(ds_incremental, dict([(name, ds_output[name].values)
+                                               for name in ds_output.data_vars
+                                               if name != 'temperature']))
+
+@pytest.mark.parametrize('cuts, context_length, chunk_size', [([8000], 720, 1000),
+                                                              ([2, 2500, 5001, 8000], 720, None),
+                                                              ([3000, 3001, 8000], 1, None),
+                                                              ([4000, 8000], 200, 700)])
+def test_incremental(tmp_path, cuts, context_length, chunk_size):
+    # Values read from csv files can differ from those of darray in the last
+    # bit, so outputs are compared with a single run on the same files
+    darray = make_case('default')
+    threshold = load_reference('default')['threshold']
+    input_dir = str(tmp_path/'station')
+    for start, stop in zip([0] + cuts[:-1], cuts):
+        write_rows(darray, input_dir, start, stop)
+        upwelling_cold_pulses_detection(input_dir, incremental=True,
+                                        context_length=context_length,
+                                        chunk_size=chunk_size,
+                                        threshold=threshold,
+                                        profiler=QUIET)
+    assert_single_run(input_dir, threshold)
+
+@pytest.mark.parametrize('rewrite', ['edited', 'truncated'])
+def test_rewritten_files(tmp_path, rewrite):
+    darray = make_case('default')
+    threshold = load_reference('default')['threshold']
+    input_dir = str(tmp_path/'station')
+    write_rows(darray, input_dir, 0, 5000)
+    upwelling_cold_pulses_detection(input_dir, incremental=True,
+                                    threshold=threshold, profiler=QUIET)
+    if rewrite == 'edited':
+        # Same rows, with a pulse among the first ones
+        darray = darray.copy()
+        darray[-1, 10:60] -= 3.
+        write_rows(darray, input_dir, 0, 5000)
+    else:
+        write_rows(darray, input_dir, 0, 3000)
+    upwelling_cold_pulses_detection(input_dir, incremental=True,
+                                    threshold=threshold, profiler=QUIET)
+    assert_single_run(input_dir, threshold)
@@ -0,0 +1,23 @@
+"""
+Parsing of logger csv files.
+"""
+import numpy as np
+import pandas as pd
+from coldpulse.inputs import parse_times
+
+
+def test_mixed_time_formats():
+    strings = np.array(['2020-01-01 00:00:00', '2020-01-01 00:02:00',
+                        '2020-01-01T00:04:00', '01/01/2020 00:06',
+                        '2020-01-01 00:08:00.5'], dtype=object)
+    expected = pd.DatetimeIndex(['2020-01-01 00:00:00', '2020-01-01 00:02:00',
+                                 '2020-01-01 00:04:00', '2020-01-01 00:06:00',
+                                 '2020-01-01 00:08:00.5'])
+    np.testing.assert_array_equal(parse_times(strings),
+                                  expected.as_unit('ns').values)
+
+def test_single_time_format():
+    strings = np.array(['02/01/2020 10:00', '13/01/2020 10:00'], dtype=object)
+    np.testing.assert_array_equal(parse_times(strings, time_format='%d/%m/%Y %H:%M'),
+                                  np.array(['2020-01-02T10:00', '2020-01-13T10:00'],
+                                           dtype='datetime64[ns]'))
@@ -0,0 +1,37 @@
+"""
+Low-memory sparse outputs compared with the original detection.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+from coldpulse.outputs import get_output, dense_series_dataset
+from .reference import CASES, make_case, load_reference, assert_columns_equal
+
+
+@pytest.mark.parametrize('name', list(CASES))
+def test_low_memory(name):
+    darray = make_case(name)
+    reference = load_reference(name)
+    df_subpulse, ds_sparse, df_pulse = get_output(darray, None, low_memory=True,
+                                                  threshold=reference['threshold'])
+    assert_columns_equal(df_subpulse, reference['subpulses'])
+    assert_columns_equal(df_pulse, reference['pulses'])
+    ds_output = dense_series_dataset(ds_sparse)
+    np.testing.assert_array_equal(ds_output.time.values, darray.time.values)
+    for series_name, values in reference['series'].items():
+        np.testing.assert_array_equal(ds_output[series_name].values,
+                                      values.astype(np.float32),
+                                      err_msg=series_name)
+
+@pytest.mark.parametrize('time_step', ['250ms', '120s', '1h'])
+def test_time_axis(tmp_path, time_step):
+    darray = make_case('default')
+    darray['time'] = pd.date_range('2020-01-01 00:00:00.5', periods=darray.time.size,
+                                   freq=time_step)
+    ds_sparse = get_output(darray, None, low_memory=True, threshold='global')[1]
+    path = str(tmp_path/'series.nc')
+    ds_sparse.to_netcdf(path)
+    ds_output = dense_series_dataset(xr.load_dataset(path))
+    np.testing.assert_array_equal(ds_output.time.values,
+                                  darray.time.values.astype('datetime64[ns]'))
@@ -0,0 +1,73 @@
+"""
+Detection over many sites sharing a time axis, compared with the detection
+of each site alone.
+"""
+import numpy as np
+import pandas as pd
+import xarray as xr
+import pytest
+from coldpulse.coldpulse import detect
+from coldpulse.engine import SERIES_NAMES
+from coldpulse.sites import get_output_sites
+from coldpulse.synthetic import make_mooring, self_climatology_threshold
+
+NUMBER_SITES = 5
+
+
+@pytest.fixture(scope='module')
+def sites():
+    darrays = [make_mooring(n_samples=3000, seed=seed,
+                            nan_fraction=0.002 if seed % 2 else 0.)[0]
+               for seed in range(NUMBER_SITES)]
+    thresholds = np.array([self_climatology_threshold(darray) for darray in darrays])
+    darray = xr.concat([darray.drop_vars(['locationID', 'longitude', 'latitude'])
+                        for darray in darrays], dim='site')
+    darray = darray.assign_coords(site=['s%d'%index for index in range(NUMBER_SITES)],
+                                  longitude=('site', np.linspace(-170., -160., NUMBER_SITES)),
+                                  latitude=('site', np.full(NUMBER_SITES, 5.9)))
+    return darrays, thresholds, darray
+
+def test_low_memory_locations(sites):
+    darrays, thresholds, darray = sites
+    df_subpulse, ds_output, df_pulse = get_output_sites(darray, thresholds,
+                                                        site_chunk=2,
+                                                        low_memory=True)
+    for name in ['longitude', 'latitude']:
+        assert ds_output[name].dims == ('site',)
+        np.testing.assert_array_equal(ds_output[name].values, darray[name].values)
+    np.testing.assert_array_equal(np.unique(ds_output.site.values),
+                                  np.unique(df_subpulse.site.values))
+
+@pytest.mark.parametrize('low_memory', [False, True])
+def test_sites_match_detect(sites, low_memory):
+    darrays, thresholds, darray = sites
+    df_subpulse, ds_output, df_pulse = get_output_sites(darray, thresholds,
+                                                        site_chunk=2,
+                                                        low_memory=low_memory)
+    if low_memory:
+        lengths = ds_output.end_subpulse.values - ds_output.start_subpulse.values
+    for index, site_darray in enumerate(darrays):
+        site = 's%d'%index
+        output = detect(site_darray, threshold=thresholds[index],
+                        low_memory=low_memory)
+        for table, expected in [(df_subpulse, output.subpulses),
+                                (df_pulse, output.pulses)]:
+            table = table[table.site == site].drop(columns='site')
+            table = table.reset_index(drop=True)
+            if 'pulse_id' in table and len(table):
+                table['pulse_id'] -= table.pulse_id.min()
+            pd.testing.assert_frame_equal(table, expected.reset_index(drop=True),
+                                          check_dtype=False, check_index_type=False)
+        if not low_memory:
+            for name in SERIES_NAMES:
+                np.testing.assert_array_equal(ds_output[name].sel(site=site).values,
+                                              output.series[name].values,
+                                              err_msg=name)
+            continue
+        is_site = ds_output.site.values == site
+        is_site_sample = np.repeat(is_site, lengths)
+        for name in SERIES_NAMES:
+            values = ds_output[name].values
+            mask = is_site if ds_output[name].dims == ('subpulse',) else is_site_sample
+            np.testing.assert_array_equal(values[mask], output.series[name].values,
+                                          err_msg=name)
@@ -0,0 +1,42 @@
+"""
+Parameter sweeps compared with the original detection and across worker
+counts.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from coldpulse.sweep import sweep_darray, START_FLAGS, END_FLAGS
+from coldpulse.engine import DEFAULT_START_FLAGS, DEFAULT_END_FLAGS
+from .reference import make_case, load_reference
+
+
+@pytest.fixture(scope='module')
+def sweep():
+    darray = make_case('default')
+    reference = load_reference('default')
+    thresholds = [reference['threshold'], reference['threshold'] + 0.5]
+    results = sweep_darray(darray, thresholds, 'all', 'all', workers=1)
+    return darray, thresholds, results
+
+@pytest.mark.parametrize('workers', [2, 3])
+def test_workers(sweep, workers):
+    darray, thresholds, results = sweep
+    pd.testing.assert_frame_equal(sweep_darray(darray, thresholds, 'all', 'all',
+                                               workers=workers),
+                                  results)
+
+def test_default_configuration(sweep):
+    darray, thresholds, results = sweep
+    reference = load_reference('default')
+    is_default = results.threshold == reference['threshold']
+    for name in START_FLAGS:
+        is_default &= results['start_%s'%name] == DEFAULT_START_FLAGS[name]
+    for name in END_FLAGS:
+        is_default &= results['end_%s'%name] == DEFAULT_END_FLAGS[name]
+    row = results[is_default].iloc[0]
+    assert is_default.sum() == 1
+    assert row.number_pulses == reference['pulses']['start_pulse'].size
+    assert row.number_subpulses == reference['subpulses']['pulse_id'].size
+    np.testing.assert_allclose(row.dch_total,
+                               reference['subpulses']['dch_subpulse'].sum(),
+                               rtol=1e-9)
@@ -0,0 +1,39 @@
+"""
+Thresholds computed from the record itself.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pytest
+from coldpulse.features import stratification_index
+from coldpulse.synthetic import make_mooring
+from coldpulse.threshold import (make_tsi_threshold, rolling_threshold,
+                                 stop_station_threshold)
+
+
+@pytest.mark.parametrize('time_step, window', [('250ms', 120),
+                                               ('1s', 30),
+                                               ('2min', 15)])
+def test_rolling_time_step(time_step, window):
+    darray = make_mooring(n_samples=2000, seed=0)[0].transpose('depth', 'time')
+    darray = darray.assign_coords(time=pd.date_range('2020-01-01', periods=darray.time.size,
+                                                     freq=time_step))
+    window_days = window*pd.Timedelta(time_step)/pd.Timedelta('1D')
+    threshold = make_tsi_threshold(darray, None, threshold='rolling',
+                                   window_days=window_days)
+    phi = stratification_index(darray.values, darray.depth.values)
+    np.testing.assert_array_equal(threshold, rolling_threshold(phi, window))
+
+def test_stop_station_threshold():
+    def failing_threshold():
+        time.sleep(0.2)
+        raise OSError('GODAS unreachable')
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        running = executor.submit(failing_threshold)
+        pending = executor.submit(float, 1.)
+        stop_station_threshold(pending)
+        stop_station_threshold(running)
+        assert pending.cancelled()
+        assert running.done()
+    stop_station_threshold('godas')